@@ -1,10 +1,16 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Depends, Query, Request
+from fastapi import FastAPI, HTTPException, File, UploadFile, Depends, Query, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response
 from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime
+from email.utils import format_datetime, parsedate_to_datetime
 import os
+import json
+import time
+import asyncio
+import logging
 from dotenv import load_dotenv
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from auth.auth_service import (
@@ -13,11 +19,29 @@ from auth.auth_service import (
 )
 from auth.permissions import User, Role, Permission, check_permission, ROLE_DESCRIPTIONS
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import ExecutionTimeout, OperationFailure
+from services.pagination import parse_sort, build_sort, apply_cursor, encode_cursor, InvalidCursorError
+from services.json_codec import CodecJSONResponse, dumps as json_dumps, to_jsonable
+from services.versioning import VERSION_FIELD, VersionConflictError, current_version, etag_for, etag_matches, parse_if_match, version_query
+from services import change_tracker
+from services.dedup_index import ComplaintDedupIndex
+from services.similarity_index import DefectSimilarityIndex
+from services.search_index import KnowledgeSearchIndex, INDEXED_FIELDS as SEARCH_SOURCES
+from services.timeseries_service import create_series_store, InvalidSeriesQueryError
+from services.kpi_rollup_service import KPIRollupEngine, SOURCE_COLLECTIONS as ROLLUP_SOURCES, PERIODS as ROLLUP_PERIODS, DIMENSIONS as ROLLUP_DIMENSIONS
+from services.cache_service import TTLCache, LRUCache, ResultCache, create_invalidation_bus, parse_ttls
+from services.aggregation_service import run_aggregation, InvalidAggregationError
+from services.bulk_service import run_bulk, BulkOperationError
+from services.projection import build_projection, InvalidFieldsError
+from services.index_registry import ensure_indexes, index_usage_report, query_tracker, ENTITY_INDEXES
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Initialize FastAPI
-app = FastAPI(title="Quality Studio API", version="1.0.0")
+app = FastAPI(title="Quality Studio API", version="1.0.0", default_response_class=CodecJSONResponse)
 
 # CORS Configuration
 app.add_middleware(
@@ -26,17 +50,88 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 # MongoDB Connection
 MONGO_URL = os.environ.get("MONGO_URL")
 DB_NAME = os.environ.get("DB_NAME", "quality_studio")
 
+# Documents fetched per getMore round trip when streaming NDJSON
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 500))
+
+# Seconds /api/statistics results are reused; any entity write clears them
+STATISTICS_CACHE_TTL = float(os.environ.get("STATISTICS_CACHE_TTL", 30))
+
+# Serialized single-item responses kept per (collection, id)
+ENTITY_CACHE_SIZE = int(os.environ.get("ENTITY_CACHE_SIZE", 2000))
+ENTITY_CACHE_TTL = float(os.environ.get("ENTITY_CACHE_TTL", 60))
+
+# Serialized list/filter pages; per-collection TTLs as "kpis=300,process_runs=30" (0 disables)
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 60))
+RESULT_CACHE_TTLS = parse_ttls(os.environ.get("RESULT_CACHE_TTLS", ""))
+
+# BM25 hits handed to the LLM when a knowledge search asks for rerank=true
+SEARCH_RERANK_CANDIDATES = int(os.environ.get("SEARCH_RERANK_CANDIDATES", 20))
+
+# Descriptions accepted by one /api/ai/classify-defects/batch request
+CLASSIFY_BATCH_MAX_ITEMS = int(os.environ.get("CLASSIFY_BATCH_MAX_ITEMS", 5000))
+
+# Push change-stream deltas to WebSocket rooms (needs a replica set)
+CHANGE_STREAMS_ENABLED = os.environ.get("CHANGE_STREAMS_ENABLED", "true").lower() == "true"
+
 client = AsyncIOMotorClient(MONGO_URL)
 db = client[DB_NAME]
 
 # Set database for auth service
 set_database(db)
+change_tracker.set_database(db)
+
+@app.on_event("startup")
+async def create_indexes():
+    """Create the declared entity indexes (idempotent)"""
+    try:
+        await ensure_indexes(db)
+    except Exception as e:
+        logger.error(f"Index creation failed: {str(e)}")
+
+@app.on_event("startup")
+async def create_process_series():
+    """Create the optional process time-series collection"""
+    try:
+        await process_series.ensure_collection()
+    except Exception as e:
+        logger.error(f"Process series setup failed: {str(e)}")
+
+@app.on_event("startup")
+async def build_search_index():
+    """Index knowledge documents and SOPs for /api/ai/search-knowledge"""
+    try:
+        await search_index.load()
+    except Exception as e:
+        logger.error(f"Search index build failed: {str(e)}")
+
+@app.on_event("startup")
+async def build_similarity_index():
+    """Vectorize defect descriptions in the background; large corpora take a while"""
+    run_in_background(similarity_index.load(), "Similarity index build")
+
+@app.on_event("startup")
+async def build_dedup_index():
+    run_in_background(dedup_index.load(), "Dedup index build")
+
+@app.on_event("startup")
+async def start_invalidation_bus():
+    """Begin receiving cache invalidations from other workers"""
+    try:
+        await invalidation_bus.start()
+    except Exception as e:
+        logger.error(f"Cache invalidation bus failed to start: {str(e)}")
+
+@app.on_event("shutdown")
+async def stop_invalidation_bus():
+    await invalidation_bus.stop()
 
 # Security
 security = HTTPBearer(auto_error=False)
@@ -97,6 +192,7 @@ class BaseDBModel(BaseModel):
     id: Optional[str] = Field(None, alias="_id")
     created_date: Optional[datetime] = None
     updated_date: Optional[datetime] = None
+    doc_version: Optional[int] = None
     
     class Config:
         populate_by_name = True
@@ -221,89 +317,346 @@ class KPI(BaseDBModel):
     scrapRate: Optional[float] = None
     customerComplaints: Optional[int] = 0
 
+# Collection name -> entity model, for endpoints that take the collection as a parameter
+ENTITY_MODELS = {
+    "customer_complaints": CustomerComplaint,
+    "defect_tickets": DefectTicket,
+    "rca_records": RCARecord,
+    "capa_plans": CAPAPlan,
+    "process_runs": ProcessRun,
+    "golden_batches": GoldenBatch,
+    "sops": SOP,
+    "does": DoE,
+    "knowledge_documents": KnowledgeDocument,
+    "equipment": Equipment,
+    "file_upload_history": FileUploadHistory,
+    "kpis": KPI,
+}
+
+# Read caches invalidated by record_write
+statistics_cache = TTLCache(STATISTICS_CACHE_TTL)
+entity_cache = LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL, RESULT_CACHE_TTLS)
+
+# Carries write notices to every worker (CACHE_INVALIDATION_BUS=mongo for several workers)
+invalidation_bus = create_invalidation_bus(db)
+
+def apply_invalidation(collection_name: str, item_ids: Optional[List[str]]):
+    """Drop cached reads affected by a write; item_ids None means the whole collection"""
+    statistics_cache.invalidate()
+    result_cache.invalidate_collection(collection_name)
+    if item_ids is None:
+        entity_cache.invalidate()
+        return
+    for item_id in item_ids:
+        entity_cache.invalidate((collection_name, item_id))
+
+invalidation_bus.subscribe(apply_invalidation)
+
+# Daily/weekly/monthly KPI aggregates kept current by record_write
+kpi_rollups = KPIRollupEngine(db)
+
+# Per-parameter process run points (PROCESS_TIMESERIES_ENABLED=true)
+process_series = create_series_store(db)
+
+# Strong references so fire-and-forget tasks are not garbage collected mid-run
+background_tasks = set()
+
+def run_in_background(coro, description: str):
+    """Run derived-data maintenance after the response instead of adding to its latency"""
+    async def runner():
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"{description} failed: {str(e)}")
+    task = asyncio.create_task(runner())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+# BM25 index over knowledge documents and SOPs, built at startup
+search_index = KnowledgeSearchIndex(db)
+
+def refresh_search_index(collection_name: str, item_ids: Optional[List[str]]):
+    """Re-index written knowledge documents/SOPs (local writes and other workers' notices)"""
+    if collection_name in SEARCH_SOURCES:
+        run_in_background(search_index.refresh(collection_name, item_ids), "Search index refresh")
+
+invalidation_bus.subscribe(refresh_search_index)
+
+# Hashed TF-IDF vectors of defect descriptions for "similar past defects"
+similarity_index = DefectSimilarityIndex(db)
+
+def refresh_similarity_index(collection_name: str, item_ids: Optional[List[str]]):
+    if collection_name == "defect_tickets":
+        run_in_background(similarity_index.refresh(item_ids), "Similarity index refresh")
+
+invalidation_bus.subscribe(refresh_similarity_index)
+
+# MinHash/LSH signatures of complaints for duplicate detection
+dedup_index = ComplaintDedupIndex(db)
+
+def refresh_dedup_index(collection_name: str, item_ids: Optional[List[str]]):
+    if collection_name == "customer_complaints":
+        run_in_background(dedup_index.refresh(item_ids), "Dedup index refresh")
+
+invalidation_bus.subscribe(refresh_dedup_index)
+
 # Helper functions
+async def record_write(collection_name: str, item_ids: List[str] = None):
+    """Invalidate read caches and advance the collection's change counter after a write"""
+    await change_tracker.bump_version(collection_name)
+    await invalidation_bus.publish(collection_name, item_ids)
+    if item_ids and collection_name in ROLLUP_SOURCES:
+        run_in_background(kpi_rollups.apply(collection_name, item_ids), f"KPI rollup update for {collection_name}")
+    if item_ids and collection_name == "process_runs":
+        run_in_background(process_series.sync_runs(item_ids), "Process series sync")
+
+def api_doc(doc):
+    """Rename _id to id; CodecJSONResponse handles ObjectId/datetime/Decimal128 at any depth"""
+    if doc is None:
+        return None
+    if "_id" in doc:
+        doc["id"] = str(doc.pop("_id"))
+    return doc
+
 def serialize_doc(doc):
     """Convert MongoDB document to JSON-serializable dict, excluding _id"""
     if doc is None:
         return None
-    result = {}
-    for key, value in doc.items():
-        if key == "_id":
-            result["id"] = str(value)
-        elif isinstance(value, ObjectId):
-            result[key] = str(value)
-        elif isinstance(value, datetime):
-            result[key] = value.isoformat()
-        else:
-            result[key] = value
-    return result
+    return to_jsonable(api_doc(doc))
+
+async def get_page(collection_name: str, filters: dict = None, sort_by: str = None, limit: int = 100, cursor: str = None, fields: str = None):
+    """Fetch one keyset page: returns (items, next_cursor)"""
+    limit = max(limit, 1)
+    sort_field, direction = parse_sort(sort_by)
+    projection = build_projection(collection_name, fields, sort_field)
+    query_tracker.record(collection_name, filters, sort_field)
+    query = apply_cursor(filters or {}, cursor, sort_field, direction)
+    
+    mongo_cursor = db[collection_name].find(query, projection).sort(build_sort(sort_field, direction)).limit(limit + 1)
+    items = await mongo_cursor.to_list(length=limit + 1)
+    
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1], sort_field, direction)
+    return [api_doc(item) for item in items], next_cursor
+
+def stream_items(collection_name: str, filters: dict = None, sort_by: str = None, limit: int = 0, cursor: str = None, fields: str = None):
+    """Prepare an NDJSON stream: one JSON line per document, memory bounded by the cursor batch size.
+    
+    Bad cursors/fields raise here, before any bytes are sent.
+    """
+    sort_field, direction = parse_sort(sort_by)
+    projection = build_projection(collection_name, fields, sort_field)
+    query_tracker.record(collection_name, filters, sort_field)
+    query = apply_cursor(filters or {}, cursor, sort_field, direction)
+    
+    mongo_cursor = (
+        db[collection_name].find(query, projection)
+        .sort(build_sort(sort_field, direction))
+        .limit(limit)
+        .batch_size(STREAM_BATCH_SIZE)
+    )
+    
+    async def lines():
+        async for item in mongo_cursor:
+            yield json_dumps(api_doc(item)) + b"\n"
+    return lines()
+
+def not_modified(headers: Dict[str, str]):
+    return Response(status_code=304, headers=headers)
 
-async def get_items(collection_name: str, sort_by: str = None, limit: int = 100):
+async def list_page(request: Request, collection_name: str, filters: dict = None, sort_by: str = None, limit: int = 100, cursor: str = None, fields: str = None, format: str = None):
+    """Run a paginated query for a route, exposing the next page token as X-Next-Cursor.
+    
+    format=ndjson streams the whole result instead (limit=0 for no limit).
+    The ETag combines the collection's change counter with the canonical
+    query, so an If-None-Match revalidation of an unchanged collection returns
+    304 without running the query. The same tag keys result_cache, whose
+    entries any write to the collection supersedes.
+    """
+    if format not in (None, "json", "ndjson"):
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+    if limit < (0 if format == "ndjson" else 1):
+        raise HTTPException(status_code=400, detail="limit must be at least 1 (0 streams everything with format=ndjson)")
+    version = await change_tracker.current_version(collection_name)
+    etag = change_tracker.query_etag(collection_name, version, filters or {}, sort_by, limit, cursor, fields, format or "json")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(headers)
+    cached = result_cache.get(collection_name, version, etag) if format != "ndjson" else None
+    if cached is not None:
+        body, next_cursor = cached
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        return Response(body, media_type="application/json", headers=headers)
+    try:
+        if format == "ndjson":
+            return StreamingResponse(
+                stream_items(collection_name, filters, sort_by, limit, cursor, fields),
+                media_type="application/x-ndjson",
+                headers=headers
+            )
+        items, next_cursor = await get_page(collection_name, filters, sort_by, limit, cursor, fields)
+    except (InvalidCursorError, InvalidFieldsError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    body = json_dumps(items)
+    result_cache.set(collection_name, version, etag, (body, next_cursor), len(body))
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return Response(body, media_type="application/json", headers=headers)
+
+async def get_items(collection_name: str, sort_by: str = None, limit: int = 100, cursor: str = None):
     """Get all items from collection"""
-    if sort_by and sort_by.startswith("-"):
-        sort_order = [(sort_by[1:], -1)]
-    elif sort_by:
-        sort_order = [(sort_by, 1)]
-    else:
-        sort_order = [("created_date", -1)]
-    
-    cursor = db[collection_name].find({}).sort(sort_order).limit(limit)
-    items = await cursor.to_list(length=limit)
-    return [serialize_doc(item) for item in items]
-
-async def get_item_by_id(collection_name: str, item_id: str):
+    items, _ = await get_page(collection_name, {}, sort_by, limit, cursor)
+    return to_jsonable(items)
+
+async def get_item_by_id(collection_name: str, item_id: str, fields: str = None):
     """Get single item by ID"""
+    projection = build_projection(collection_name, fields)
+    if projection:
+        projection[VERSION_FIELD] = 1
     try:
-        item = await db[collection_name].find_one({"_id": ObjectId(item_id)})
-        return serialize_doc(item)
+        item = await db[collection_name].find_one({"_id": ObjectId(item_id)}, projection)
+        return api_doc(item)
     except:
         return None
 
+def validator_headers(item):
+    """ETag from the document version, Last-Modified from updated_date when present"""
+    headers = {"ETag": etag_for(item), "Cache-Control": "no-cache"}
+    updated = item.get("updated_date")
+    if isinstance(updated, datetime):
+        headers["Last-Modified"] = format_datetime(updated.replace(microsecond=0), usegmt=True)
+    return headers
+
+def item_response(item):
+    """Single-item response carrying the document version as a strong ETag"""
+    return CodecJSONResponse(item, headers=validator_headers(item))
+
+def is_fresh(request: Request, item) -> bool:
+    """Evaluate If-None-Match, falling back to If-Modified-Since (RFC 9110 precedence)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return etag_matches(if_none_match, etag_for(item))
+    since, updated = request.headers.get("if-modified-since"), item.get("updated_date")
+    if not since or not isinstance(updated, datetime):
+        return False
+    try:
+        since_date = parsedate_to_datetime(since).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return False
+    return updated.replace(microsecond=0) <= since_date
+
+def cache_entry(item):
+    """What entity_cache keeps per item: (validators, JSON body, response headers)"""
+    validators = {VERSION_FIELD: item.get(VERSION_FIELD), "updated_date": item.get("updated_date")}
+    return validators, json_dumps(item), validator_headers(item)
+
+async def cached_item_or_404(request: Request, collection_name: str, item_id: str):
+    """Full-document reads go through entity_cache; write paths invalidate it via record_write"""
+    key = (collection_name, item_id)
+    entry = entity_cache.get(key)
+    if entry is None:
+        token = entity_cache.token()
+        item = await get_item_by_id(collection_name, item_id)
+        if not item:
+            raise HTTPException(status_code=404, detail="Item not found")
+        entry = cache_entry(item)
+        entity_cache.set(key, entry, token)
+    validators, body, headers = entry
+    if is_fresh(request, validators):
+        return not_modified(headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+async def item_or_404(request: Request, collection_name: str, item_id: str, fields: str = None):
+    """Fetch a single item for a route, mapping bad projections to 400 and misses to 404.
+    
+    Projected conditional requests first read only the version fields; a
+    match returns 304 without loading the document body.
+    """
+    if fields is None:
+        return await cached_item_or_404(request, collection_name, item_id)
+    if request.headers.get("if-none-match") or request.headers.get("if-modified-since"):
+        try:
+            probe = await db[collection_name].find_one({"_id": ObjectId(item_id)}, {VERSION_FIELD: 1, "updated_date": 1})
+        except Exception:
+            probe = None
+        if probe and is_fresh(request, probe):
+            return not_modified(validator_headers(probe))
+    try:
+        item = await get_item_by_id(collection_name, item_id, fields)
+    except InvalidFieldsError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return item_response(item)
+
 async def create_item(collection_name: str, item_data: dict):
     """Create a new item in collection"""
-    item_data["created_date"] = datetime.utcnow()
-    item_data["updated_date"] = datetime.utcnow()
+    now = datetime.utcnow()
+    item_data["created_date"] = now
+    item_data["updated_date"] = now
+    item_data[VERSION_FIELD] = 1
     # Remove id field if present
     item_data.pop("id", None)
     item_data.pop("_id", None)
-    result = await db[collection_name].insert_one(item_data)
-    created_item = await db[collection_name].find_one({"_id": result.inserted_id})
-    return serialize_doc(created_item)
+    # insert_one adds the generated _id to item_data, so no read-back is needed
+    await db[collection_name].insert_one(item_data)
+    await record_write(collection_name, [str(item_data["_id"])])
+    return api_doc(item_data)
 
-async def update_item(collection_name: str, item_id: str, update_data: dict):
-    """Update an item"""
+async def update_item(collection_name: str, item_id: str, update_data: dict, expected_version: int = None):
+    """Update an item in a single round trip, optionally only if it is still at expected_version"""
     update_data["updated_date"] = datetime.utcnow()
     update_data.pop("id", None)
     update_data.pop("_id", None)
+    update_data.pop(VERSION_FIELD, None)
     try:
-        await db[collection_name].update_one(
-            {"_id": ObjectId(item_id)},
-            {"$set": update_data}
-        )
-        return await get_item_by_id(collection_name, item_id)
+        query = {"_id": ObjectId(item_id)}
     except:
         return None
+    if expected_version is not None:
+        query[VERSION_FIELD] = version_query(expected_version)
+    
+    updated = await db[collection_name].find_one_and_update(
+        query,
+        {"$set": update_data, "$inc": {VERSION_FIELD: 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
+        if expected_version is not None and await db[collection_name].count_documents({"_id": query["_id"]}, limit=1):
+            raise VersionConflictError("Item was modified by another user")
+        return None
+    await record_write(collection_name, [item_id])
+    return api_doc(updated)
+
+async def update_or_404(collection_name: str, item_id: str, update_data: dict, if_match: str = None):
+    """Apply a PUT for a route: 412 on a stale If-Match, 404 if the item is missing"""
+    try:
+        updated = await update_item(collection_name, item_id, update_data, parse_if_match(if_match))
+    except VersionConflictError as e:
+        raise HTTPException(status_code=412, detail=str(e))
+    if not updated:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return item_response(updated)
 
 async def delete_item(collection_name: str, item_id: str):
     """Delete an item"""
     try:
         result = await db[collection_name].delete_one({"_id": ObjectId(item_id)})
-        return result.deleted_count > 0
     except:
         return False
+    if result.deleted_count > 0:
+        await record_write(collection_name, [item_id])
+        return True
+    return False
 
-async def filter_items(collection_name: str, filters: dict, sort_by: str = None, limit: int = 100):
+async def filter_items(collection_name: str, filters: dict, sort_by: str = None, limit: int = 100, cursor: str = None):
     """Filter items based on criteria"""
-    if sort_by and sort_by.startswith("-"):
-        sort_order = [(sort_by[1:], -1)]
-    elif sort_by:
-        sort_order = [(sort_by, 1)]
-    else:
-        sort_order = [("created_date", -1)]
-    
-    cursor = db[collection_name].find(filters).sort(sort_order).limit(limit)
-    items = await cursor.to_list(length=limit)
-    return [serialize_doc(item) for item in items]
+    items, _ = await get_page(collection_name, filters, sort_by, limit, cursor)
+    return to_jsonable(items)
 
 # API Routes
 @app.get("/")
@@ -459,28 +812,27 @@ async def get_demo_users():
 
 # CustomerComplaint endpoints
 @app.get("/api/customer_complaints", tags=["CustomerComplaint"])
-async def list_customer_complaints(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("customer_complaints", sort, limit)
+async def list_customer_complaints(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "customer_complaints", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/customer_complaints", tags=["CustomerComplaint"])
 async def create_customer_complaint(item: CustomerComplaint):
+    """Create a complaint; the response lists likely duplicates under possibleDuplicates"""
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("customer_complaints", item_dict)
+    matches = dedup_index.duplicates_of(item_dict)
+    created = await create_item("customer_complaints", item_dict)
+    dedup_index.add(created["id"], created)
+    created["possibleDuplicates"] = await describe_duplicates(matches)
+    return item_response(created)
 
 @app.get("/api/customer_complaints/{item_id}", tags=["CustomerComplaint"])
-async def get_customer_complaint(item_id: str):
-    item = await get_item_by_id("customer_complaints", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_customer_complaint(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "customer_complaints", item_id, fields)
 
 @app.put("/api/customer_complaints/{item_id}", tags=["CustomerComplaint"])
-async def update_customer_complaint(item_id: str, item: CustomerComplaint):
+async def update_customer_complaint(item_id: str, item: CustomerComplaint, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("customer_complaints", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("customer_complaints", item_id, item_dict, if_match)
 
 @app.delete("/api/customer_complaints/{item_id}", tags=["CustomerComplaint"])
 async def delete_customer_complaint(item_id: str):
@@ -490,33 +842,69 @@ async def delete_customer_complaint(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/customer_complaints/filter", tags=["CustomerComplaint"])
-async def filter_customer_complaints(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("customer_complaints", filters, sort, limit)
+async def filter_customer_complaints(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "customer_complaints", filters, sort, limit, cursor, fields, format)
+
+async def describe_duplicates(matches):
+    """Attach ticket number, customer and status to (id, score) matches"""
+    if not matches:
+        return []
+    docs = await db.customer_complaints.find(
+        {"_id": {"$in": [ObjectId(item_id) for item_id, _ in matches]}},
+        {"ticketNumber": 1, "customerName": 1, "productType": 1, "status": 1, "dateLogged": 1}
+    ).to_list(length=None)
+    by_id = {str(doc["_id"]): api_doc(doc) for doc in docs}
+    return [{**by_id[item_id], "score": round(score, 4)} for item_id, score in matches if item_id in by_id]
+
+@app.get("/api/customer_complaints/duplicates/report", tags=["CustomerComplaint"])
+async def complaint_duplicates_report():
+    """Groups of likely duplicate complaints across the collection (MinHash/LSH)"""
+    groups = dedup_index.report()
+    details = await describe_duplicates([(item_id, group["max_score"]) for group in groups for item_id in group["ids"]])
+    by_id = {detail["id"]: detail for detail in details}
+    return {
+        "threshold": dedup_index.threshold,
+        "bands": dedup_index.lsh.bands,
+        "rows": dedup_index.lsh.rows,
+        "indexed": len(dedup_index.lsh),
+        "groups": [
+            {
+                "max_score": group["max_score"],
+                "complaints": [
+                    {key: value for key, value in by_id[item_id].items() if key != "score"}
+                    for item_id in group["ids"] if item_id in by_id
+                ],
+            }
+            for group in groups
+        ],
+    }
+
+@app.get("/api/customer_complaints/{item_id}/duplicates", tags=["CustomerComplaint"])
+async def complaint_duplicates(item_id: str):
+    """Likely duplicates of an existing complaint"""
+    matches = dedup_index.duplicates_of_id(item_id)
+    if not matches and not await get_item_by_id("customer_complaints", item_id, "id"):
+        raise HTTPException(status_code=404, detail="Item not found")
+    return await describe_duplicates(matches)
 
 # DefectTicket endpoints
 @app.get("/api/defect_tickets", tags=["DefectTicket"])
-async def list_defect_tickets(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("defect_tickets", sort, limit)
+async def list_defect_tickets(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "defect_tickets", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/defect_tickets", tags=["DefectTicket"])
 async def create_defect_ticket(item: DefectTicket):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("defect_tickets", item_dict)
+    return item_response(await create_item("defect_tickets", item_dict))
 
 @app.get("/api/defect_tickets/{item_id}", tags=["DefectTicket"])
-async def get_defect_ticket(item_id: str):
-    item = await get_item_by_id("defect_tickets", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_defect_ticket(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "defect_tickets", item_id, fields)
 
 @app.put("/api/defect_tickets/{item_id}", tags=["DefectTicket"])
-async def update_defect_ticket(item_id: str, item: DefectTicket):
+async def update_defect_ticket(item_id: str, item: DefectTicket, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("defect_tickets", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("defect_tickets", item_id, item_dict, if_match)
 
 @app.delete("/api/defect_tickets/{item_id}", tags=["DefectTicket"])
 async def delete_defect_ticket(item_id: str):
@@ -526,33 +914,61 @@ async def delete_defect_ticket(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/defect_tickets/filter", tags=["DefectTicket"])
-async def filter_defect_tickets(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("defect_tickets", filters, sort, limit)
+async def filter_defect_tickets(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "defect_tickets", filters, sort, limit, cursor, fields, format)
+
+# Fields shown for each similar defect
+SIMILAR_DEFECT_FIELDS = {
+    "ticketId": 1, "dateTime": 1, "line": 1, "defectType": 1, "severity": 1,
+    "status": 1, "description": 1, "rootCause": 1,
+}
+
+@app.get("/api/defect_tickets/{item_id}/similar", tags=["DefectTicket"])
+async def similar_defect_tickets(item_id: str, k: int = Query(10, ge=1, le=100), min_score: float = 0.0):
+    """Past defects with the most similar descriptions (cosine over hashed TF-IDF), with root cause and linked CAPAs"""
+    started = time.perf_counter()
+    neighbours = similarity_index.neighbours(item_id, k, min_score)
+    search_time_ms = round((time.perf_counter() - started) * 1000, 2)
+    if not neighbours:
+        if not await get_item_by_id("defect_tickets", item_id, "id"):
+            raise HTTPException(status_code=404, detail="Item not found")
+        return {"id": item_id, "results": [], "search_time_ms": search_time_ms}
+    
+    ids = [neighbour_id for neighbour_id, _ in neighbours]
+    tickets, capas = await asyncio.gather(
+        db.defect_tickets.find({"_id": {"$in": [ObjectId(i) for i in ids]}}, SIMILAR_DEFECT_FIELDS).to_list(length=None),
+        db.capa_plans.find({"defectTicketId": {"$in": ids}}, {"defectTicketId": 1, "approvalState": 1}).to_list(length=None)
+    )
+    by_id = {str(ticket["_id"]): api_doc(ticket) for ticket in tickets}
+    capas_by_ticket: Dict[str, List[Dict[str, Any]]] = {}
+    for capa in capas:
+        capas_by_ticket.setdefault(capa.pop("defectTicketId"), []).append(api_doc(capa))
+    
+    results = [
+        {**by_id[neighbour_id], "score": score, "capaPlans": capas_by_ticket.get(neighbour_id, [])}
+        for neighbour_id, score in neighbours
+        if neighbour_id in by_id
+    ]
+    return {"id": item_id, "results": results, "search_time_ms": search_time_ms}
 
 # RCARecord endpoints
 @app.get("/api/rca_records", tags=["RCARecord"])
-async def list_rca_records(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("rca_records", sort, limit)
+async def list_rca_records(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "rca_records", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/rca_records", tags=["RCARecord"])
 async def create_rca_record(item: RCARecord):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("rca_records", item_dict)
+    return item_response(await create_item("rca_records", item_dict))
 
 @app.get("/api/rca_records/{item_id}", tags=["RCARecord"])
-async def get_rca_record(item_id: str):
-    item = await get_item_by_id("rca_records", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_rca_record(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "rca_records", item_id, fields)
 
 @app.put("/api/rca_records/{item_id}", tags=["RCARecord"])
-async def update_rca_record(item_id: str, item: RCARecord):
+async def update_rca_record(item_id: str, item: RCARecord, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("rca_records", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("rca_records", item_id, item_dict, if_match)
 
 @app.delete("/api/rca_records/{item_id}", tags=["RCARecord"])
 async def delete_rca_record(item_id: str):
@@ -562,33 +978,27 @@ async def delete_rca_record(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/rca_records/filter", tags=["RCARecord"])
-async def filter_rca_records(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("rca_records", filters, sort, limit)
+async def filter_rca_records(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "rca_records", filters, sort, limit, cursor, fields, format)
 
 # CAPAPlan endpoints
 @app.get("/api/capa_plans", tags=["CAPAPlan"])
-async def list_capa_plans(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("capa_plans", sort, limit)
+async def list_capa_plans(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "capa_plans", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/capa_plans", tags=["CAPAPlan"])
 async def create_capa_plan(item: CAPAPlan):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("capa_plans", item_dict)
+    return item_response(await create_item("capa_plans", item_dict))
 
 @app.get("/api/capa_plans/{item_id}", tags=["CAPAPlan"])
-async def get_capa_plan(item_id: str):
-    item = await get_item_by_id("capa_plans", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_capa_plan(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "capa_plans", item_id, fields)
 
 @app.put("/api/capa_plans/{item_id}", tags=["CAPAPlan"])
-async def update_capa_plan(item_id: str, item: CAPAPlan):
+async def update_capa_plan(item_id: str, item: CAPAPlan, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("capa_plans", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("capa_plans", item_id, item_dict, if_match)
 
 @app.delete("/api/capa_plans/{item_id}", tags=["CAPAPlan"])
 async def delete_capa_plan(item_id: str):
@@ -598,33 +1008,27 @@ async def delete_capa_plan(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/capa_plans/filter", tags=["CAPAPlan"])
-async def filter_capa_plans(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("capa_plans", filters, sort, limit)
+async def filter_capa_plans(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "capa_plans", filters, sort, limit, cursor, fields, format)
 
 # ProcessRun endpoints
 @app.get("/api/process_runs", tags=["ProcessRun"])
-async def list_process_runs(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("process_runs", sort, limit)
+async def list_process_runs(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "process_runs", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/process_runs", tags=["ProcessRun"])
 async def create_process_run(item: ProcessRun):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("process_runs", item_dict)
+    return item_response(await create_item("process_runs", item_dict))
 
 @app.get("/api/process_runs/{item_id}", tags=["ProcessRun"])
-async def get_process_run(item_id: str):
-    item = await get_item_by_id("process_runs", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_process_run(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "process_runs", item_id, fields)
 
 @app.put("/api/process_runs/{item_id}", tags=["ProcessRun"])
-async def update_process_run(item_id: str, item: ProcessRun):
+async def update_process_run(item_id: str, item: ProcessRun, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("process_runs", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("process_runs", item_id, item_dict, if_match)
 
 @app.delete("/api/process_runs/{item_id}", tags=["ProcessRun"])
 async def delete_process_run(item_id: str):
@@ -634,33 +1038,27 @@ async def delete_process_run(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/process_runs/filter", tags=["ProcessRun"])
-async def filter_process_runs(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("process_runs", filters, sort, limit)
+async def filter_process_runs(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "process_runs", filters, sort, limit, cursor, fields, format)
 
 # GoldenBatch endpoints
 @app.get("/api/golden_batches", tags=["GoldenBatch"])
-async def list_golden_batches(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("golden_batches", sort, limit)
+async def list_golden_batches(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "golden_batches", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/golden_batches", tags=["GoldenBatch"])
 async def create_golden_batch(item: GoldenBatch):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("golden_batches", item_dict)
+    return item_response(await create_item("golden_batches", item_dict))
 
 @app.get("/api/golden_batches/{item_id}", tags=["GoldenBatch"])
-async def get_golden_batch(item_id: str):
-    item = await get_item_by_id("golden_batches", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_golden_batch(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "golden_batches", item_id, fields)
 
 @app.put("/api/golden_batches/{item_id}", tags=["GoldenBatch"])
-async def update_golden_batch(item_id: str, item: GoldenBatch):
+async def update_golden_batch(item_id: str, item: GoldenBatch, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("golden_batches", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("golden_batches", item_id, item_dict, if_match)
 
 @app.delete("/api/golden_batches/{item_id}", tags=["GoldenBatch"])
 async def delete_golden_batch(item_id: str):
@@ -670,33 +1068,27 @@ async def delete_golden_batch(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/golden_batches/filter", tags=["GoldenBatch"])
-async def filter_golden_batches(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("golden_batches", filters, sort, limit)
+async def filter_golden_batches(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "golden_batches", filters, sort, limit, cursor, fields, format)
 
 # SOP endpoints
 @app.get("/api/sops", tags=["SOP"])
-async def list_sops(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("sops", sort, limit)
+async def list_sops(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "sops", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/sops", tags=["SOP"])
 async def create_sop(item: SOP):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("sops", item_dict)
+    return item_response(await create_item("sops", item_dict))
 
 @app.get("/api/sops/{item_id}", tags=["SOP"])
-async def get_sop(item_id: str):
-    item = await get_item_by_id("sops", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_sop(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "sops", item_id, fields)
 
 @app.put("/api/sops/{item_id}", tags=["SOP"])
-async def update_sop(item_id: str, item: SOP):
+async def update_sop(item_id: str, item: SOP, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("sops", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("sops", item_id, item_dict, if_match)
 
 @app.delete("/api/sops/{item_id}", tags=["SOP"])
 async def delete_sop(item_id: str):
@@ -706,33 +1098,27 @@ async def delete_sop(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/sops/filter", tags=["SOP"])
-async def filter_sops(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("sops", filters, sort, limit)
+async def filter_sops(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "sops", filters, sort, limit, cursor, fields, format)
 
 # DoE endpoints
 @app.get("/api/does", tags=["DoE"])
-async def list_does(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("does", sort, limit)
+async def list_does(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "does", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/does", tags=["DoE"])
 async def create_doe(item: DoE):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("does", item_dict)
+    return item_response(await create_item("does", item_dict))
 
 @app.get("/api/does/{item_id}", tags=["DoE"])
-async def get_doe(item_id: str):
-    item = await get_item_by_id("does", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_doe(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "does", item_id, fields)
 
 @app.put("/api/does/{item_id}", tags=["DoE"])
-async def update_doe(item_id: str, item: DoE):
+async def update_doe(item_id: str, item: DoE, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("does", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("does", item_id, item_dict, if_match)
 
 @app.delete("/api/does/{item_id}", tags=["DoE"])
 async def delete_doe(item_id: str):
@@ -742,33 +1128,27 @@ async def delete_doe(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/does/filter", tags=["DoE"])
-async def filter_does(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("does", filters, sort, limit)
+async def filter_does(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "does", filters, sort, limit, cursor, fields, format)
 
 # KnowledgeDocument endpoints
 @app.get("/api/knowledge_documents", tags=["KnowledgeDocument"])
-async def list_knowledge_documents(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("knowledge_documents", sort, limit)
+async def list_knowledge_documents(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "knowledge_documents", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/knowledge_documents", tags=["KnowledgeDocument"])
 async def create_knowledge_document(item: KnowledgeDocument):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("knowledge_documents", item_dict)
+    return item_response(await create_item("knowledge_documents", item_dict))
 
 @app.get("/api/knowledge_documents/{item_id}", tags=["KnowledgeDocument"])
-async def get_knowledge_document(item_id: str):
-    item = await get_item_by_id("knowledge_documents", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_knowledge_document(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "knowledge_documents", item_id, fields)
 
 @app.put("/api/knowledge_documents/{item_id}", tags=["KnowledgeDocument"])
-async def update_knowledge_document(item_id: str, item: KnowledgeDocument):
+async def update_knowledge_document(item_id: str, item: KnowledgeDocument, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("knowledge_documents", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("knowledge_documents", item_id, item_dict, if_match)
 
 @app.delete("/api/knowledge_documents/{item_id}", tags=["KnowledgeDocument"])
 async def delete_knowledge_document(item_id: str):
@@ -778,33 +1158,27 @@ async def delete_knowledge_document(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/knowledge_documents/filter", tags=["KnowledgeDocument"])
-async def filter_knowledge_documents(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("knowledge_documents", filters, sort, limit)
+async def filter_knowledge_documents(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "knowledge_documents", filters, sort, limit, cursor, fields, format)
 
 # Equipment endpoints
 @app.get("/api/equipment", tags=["Equipment"])
-async def list_equipment(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("equipment", sort, limit)
+async def list_equipment(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "equipment", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/equipment", tags=["Equipment"])
 async def create_equipment(item: Equipment):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("equipment", item_dict)
+    return item_response(await create_item("equipment", item_dict))
 
 @app.get("/api/equipment/{item_id}", tags=["Equipment"])
-async def get_equipment(item_id: str):
-    item = await get_item_by_id("equipment", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_equipment(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "equipment", item_id, fields)
 
 @app.put("/api/equipment/{item_id}", tags=["Equipment"])
-async def update_equipment(item_id: str, item: Equipment):
+async def update_equipment(item_id: str, item: Equipment, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("equipment", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("equipment", item_id, item_dict, if_match)
 
 @app.delete("/api/equipment/{item_id}", tags=["Equipment"])
 async def delete_equipment(item_id: str):
@@ -814,25 +1188,22 @@ async def delete_equipment(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/equipment/filter", tags=["Equipment"])
-async def filter_equipment(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("equipment", filters, sort, limit)
+async def filter_equipment(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "equipment", filters, sort, limit, cursor, fields, format)
 
 # FileUploadHistory endpoints
 @app.get("/api/file_upload_history", tags=["FileUploadHistory"])
-async def list_file_upload_history(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("file_upload_history", sort, limit)
+async def list_file_upload_history(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "file_upload_history", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/file_upload_history", tags=["FileUploadHistory"])
 async def create_file_upload_history(item: FileUploadHistory):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("file_upload_history", item_dict)
+    return item_response(await create_item("file_upload_history", item_dict))
 
 @app.get("/api/file_upload_history/{item_id}", tags=["FileUploadHistory"])
-async def get_file_upload_history(item_id: str):
-    item = await get_item_by_id("file_upload_history", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_file_upload_history(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "file_upload_history", item_id, fields)
 
 @app.delete("/api/file_upload_history/{item_id}", tags=["FileUploadHistory"])
 async def delete_file_upload_history(item_id: str):
@@ -843,28 +1214,22 @@ async def delete_file_upload_history(item_id: str):
 
 # KPI endpoints
 @app.get("/api/kpis", tags=["KPI"])
-async def list_kpis(sort: Optional[str] = None, limit: int = 100):
-    return await get_items("kpis", sort, limit)
+async def list_kpis(request: Request, sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "kpis", {}, sort, limit, cursor, fields, format)
 
 @app.post("/api/kpis", tags=["KPI"])
 async def create_kpi(item: KPI):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    return await create_item("kpis", item_dict)
+    return item_response(await create_item("kpis", item_dict))
 
 @app.get("/api/kpis/{item_id}", tags=["KPI"])
-async def get_kpi(item_id: str):
-    item = await get_item_by_id("kpis", item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return item
+async def get_kpi(request: Request, item_id: str, fields: Optional[str] = None):
+    return await item_or_404(request, "kpis", item_id, fields)
 
 @app.put("/api/kpis/{item_id}", tags=["KPI"])
-async def update_kpi(item_id: str, item: KPI):
+async def update_kpi(item_id: str, item: KPI, if_match: Optional[str] = Header(None)):
     item_dict = item.model_dump(exclude={"id"}, exclude_none=False)
-    updated = await update_item("kpis", item_id, item_dict)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated
+    return await update_or_404("kpis", item_id, item_dict, if_match)
 
 @app.delete("/api/kpis/{item_id}", tags=["KPI"])
 async def delete_kpi(item_id: str):
@@ -874,8 +1239,8 @@ async def delete_kpi(item_id: str):
     return {"message": "Item deleted successfully"}
 
 @app.post("/api/kpis/filter", tags=["KPI"])
-async def filter_kpis(filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100):
-    return await filter_items("kpis", filters, sort, limit)
+async def filter_kpis(request: Request, filters: Dict[str, Any], sort: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, format: Optional[str] = None):
+    return await list_page(request, "kpis", filters, sort, limit, cursor, fields, format)
 
 # File upload endpoint
 @app.post("/api/upload", tags=["Files"])
@@ -899,34 +1264,251 @@ async def batch_create(collection: str, items: List[Dict[str, Any]]):
         item["updated_date"] = datetime.utcnow()
     
     result = await db[collection].insert_many(items)
+    await record_write(collection, [str(id) for id in result.inserted_ids])
     return {"inserted_count": len(result.inserted_ids), "ids": [str(id) for id in result.inserted_ids]}
 
+@app.post("/api/bulk/{collection}", tags=["Batch"])
+async def bulk_write(collection: str, data: Dict[str, Any]):
+    """Mixed insert/update/upsert/delete operations in one request
+    
+    Body: {"operations": [{"op": "insert", "document": {...}},
+                          {"op": "update", "id": "...", "document": {...}},
+                          {"op": "upsert", "filter": {"runId": "..."}, "document": {...}},
+                          {"op": "delete", "id": "..."}]}
+    Each document is validated against the collection's entity model; a bad
+    operation is reported in its result entry without failing the others.
+    """
+    model = ENTITY_MODELS.get(collection)
+    if not model:
+        raise HTTPException(status_code=404, detail=f"Unknown collection: {collection}")
+    operations = data.get("operations")
+    if not isinstance(operations, list):
+        raise HTTPException(status_code=400, detail="operations must be a list")
+    
+    try:
+        outcome = await run_bulk(db[collection], operations, model)
+    except BulkOperationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    written = [r for r in outcome["results"] if r["status"] == "ok"]
+    await record_write(collection, [r["id"] for r in written if r.get("id")])
+    if any(r.get("id") is None for r in written):
+        # A matched upsert whose document could not be identified
+        await invalidation_bus.publish(collection, None)
+    return outcome
+
+@app.post("/api/{collection}/aggregate", tags=["Analytics"])
+async def aggregate_collection(collection: str, spec: Dict[str, Any]):
+    """Server-side group-by for dashboard charts
+    
+    Body: {"match": {...}, "groupBy": ["line"], "dateBucket": {"field": "dateTime", "unit": "week"},
+           "metrics": [{"op": "count"}, {"op": "avg", "field": "cpk"},
+                       {"op": "percentile", "field": "cpk", "p": 0.95}],
+           "sort": "period", "limit": 500}
+    percentile and median need MongoDB 7.0+; older servers answer 400.
+    """
+    if collection not in ENTITY_MODELS:
+        raise HTTPException(status_code=404, detail=f"Unknown collection: {collection}")
+    try:
+        rows = await run_aggregation(db[collection], spec)
+    except InvalidAggregationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail="Aggregation exceeded its time limit")
+    except OperationFailure as e:
+        # The spec compiled but the server rejected it (e.g. a zone its tz database lacks)
+        raise HTTPException(status_code=400, detail=f"Aggregation rejected by the database: {(e.details or {}).get('errmsg', str(e))}")
+    return CodecJSONResponse(rows)
+
 # Statistics endpoint
+STATISTICS_COLLECTIONS = [
+    ("customer_complaints", "CustomerComplaint"),
+    ("defect_tickets", "DefectTicket"),
+    ("rca_records", "RCARecord"),
+    ("capa_plans", "CAPAPlan"),
+    ("process_runs", "ProcessRun"),
+    ("golden_batches", "GoldenBatch"),
+    ("sops", "SOP"),
+    ("does", "DoE"),
+    ("knowledge_documents", "KnowledgeDocument"),
+    ("equipment", "Equipment"),
+    ("file_upload_history", "FileUploadHistory"),
+    ("kpis", "KPI")
+]
+
+# Per-field counts returned under "breakdowns"
+STATISTICS_BREAKDOWNS = {
+    "defect_tickets": ["status", "severity"],
+    "customer_complaints": ["status", "severity"],
+    "capa_plans": ["approvalState"],
+}
+
+async def count_collection(collection_name: str, exact: bool) -> int:
+    if exact:
+        return await db[collection_name].count_documents({})
+    return await db[collection_name].estimated_document_count()
+
+async def breakdown_collection(collection_name: str, fields: List[str]) -> Dict[str, Dict[str, int]]:
+    """Counts per value of each field, in one pass over the collection"""
+    pipeline = [{"$facet": {
+        field: [{"$group": {"_id": f"${field}", "count": {"$sum": 1}}}]
+        for field in fields
+    }}]
+    result = await db[collection_name].aggregate(pipeline).to_list(length=1)
+    facets = result[0] if result else {}
+    return {
+        field: {str(row["_id"]) if row["_id"] is not None else "unset": row["count"] for row in facets.get(field, [])}
+        for field in fields
+    }
+
 @app.get("/api/statistics", tags=["Analytics"])
-async def get_statistics():
-    """Get overall statistics"""
-    collections = [
-        ("customer_complaints", "CustomerComplaint"),
-        ("defect_tickets", "DefectTicket"),
-        ("rca_records", "RCARecord"),
-        ("capa_plans", "CAPAPlan"),
-        ("process_runs", "ProcessRun"),
-        ("golden_batches", "GoldenBatch"),
-        ("sops", "SOP"),
-        ("does", "DoE"),
-        ("knowledge_documents", "KnowledgeDocument"),
-        ("equipment", "Equipment"),
-        ("file_upload_history", "FileUploadHistory"),
-        ("kpis", "KPI")
-    ]
-    stats = {}
-    for coll_name, display_name in collections:
-        count = await db[coll_name].count_documents({})
-        stats[display_name] = count
+async def get_statistics(exact: bool = False):
+    """Get overall statistics
+    
+    Totals use collection metadata (estimated_document_count) unless exact=true.
+    Results are cached for STATISTICS_CACHE_TTL seconds and cleared by writes.
+    """
+    cached = statistics_cache.get(exact)
+    if cached is not None:
+        return cached
+    
+    names = {coll_name: display_name for coll_name, display_name in STATISTICS_COLLECTIONS}
+    counts, breakdowns = await asyncio.gather(
+        asyncio.gather(*(count_collection(coll_name, exact) for coll_name in names)),
+        asyncio.gather(*(breakdown_collection(coll_name, fields) for coll_name, fields in STATISTICS_BREAKDOWNS.items()))
+    )
+    
+    stats = dict(zip(names.values(), counts))
+    stats["breakdowns"] = {
+        names[coll_name]: breakdown
+        for coll_name, breakdown in zip(STATISTICS_BREAKDOWNS, breakdowns)
+    }
+    statistics_cache.set(exact, stats)
     return stats
 
+@app.get("/api/kpi-rollups", tags=["Analytics"])
+async def get_kpi_rollups(
+    period: str = "day",
+    dimension: str = "all",
+    key: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(500, ge=1, le=5000)
+):
+    """Precomputed defect PPM, first-pass yield, on-time CAPA and complaint counts
+    
+    period: day | week | month; dimension: all | line | shift (key picks one line/shift).
+    """
+    if period not in ROLLUP_PERIODS:
+        raise HTTPException(status_code=400, detail=f"period must be one of {', '.join(ROLLUP_PERIODS)}")
+    if dimension not in ROLLUP_DIMENSIONS:
+        raise HTTPException(status_code=400, detail=f"dimension must be one of {', '.join(ROLLUP_DIMENSIONS)}")
+    return await kpi_rollups.query(period, dimension, key, start, end, limit)
+
+@app.get("/api/process-series", tags=["Analytics"])
+async def get_process_series(
+    parameter: str,
+    group: str = "parameters",
+    line: Optional[str] = None,
+    materialType: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    points: int = 500,
+    method: str = "lttb"
+):
+    """Downsampled trend of one process parameter (or qualityMetrics entry with group=qualityMetrics)
+    
+    Returns at most `points` [timestamp, value] pairs, via LTTB or min/max
+    bucketing, whatever the length of the time range.
+    """
+    try:
+        return await process_series.query(parameter, group, line, materialType, start, end, points, method)
+    except InvalidSeriesQueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/admin/process-series/rebuild", tags=["Admin"])
+async def rebuild_process_series(current_user: Dict = Depends(require_role("admin"))):
+    """Repopulate the process time-series collection from process_runs"""
+    return await process_series.rebuild()
+
+@app.post("/api/admin/kpi-rollups/rebuild", tags=["Admin"])
+async def rebuild_kpi_rollups(current_user: Dict = Depends(require_role("admin"))):
+    """Recompute kpi_rollups from defects, CAPA plans, process runs and complaints"""
+    return await kpi_rollups.rebuild()
+
+# Index administration
+@app.get("/api/admin/cache", tags=["Admin"])
+async def get_cache_report(current_user: Dict = Depends(require_role("admin"))):
+    """Hit rates and sizes of the in-process read caches on this worker"""
+    return {
+        "entity": entity_cache.stats(),
+        "results": result_cache.stats(),
+        "invalidation_bus": type(invalidation_bus).__name__,
+    }
+
+@app.get("/api/admin/indexes", tags=["Admin"])
+async def get_index_report(current_user: Dict = Depends(require_role("admin"))):
+    """Declared indexes, $indexStats usage and recent query shapes no index covered"""
+    return {
+        "declared": {
+            coll: [[list(key) for key in keys] for keys in specs]
+            for coll, specs in ENTITY_INDEXES.items()
+        },
+        "usage": await index_usage_report(db),
+        "uncovered_queries": query_tracker.uncovered_report(),
+        "recent_queries": list(query_tracker.recent)[-50:]
+    }
+
 # AI Service Endpoints (using GPT-5.2)
-from services import ai_service
+from services import ai_service, defect_rules
+from services.ai_gateway import gateway as ai_gateway
+from services.ai_job_queue import AIJobQueue, InvalidJobError, ATTACH_TARGETS, COMPLETED, attachment_for, serialize_job
+
+ai_service.set_database(db)
+
+@app.on_event("startup")
+async def create_ai_cache_index():
+    try:
+        await ai_service.ensure_cache_index()
+    except Exception as e:
+        logger.error(f"LLM cache index creation failed: {str(e)}")
+
+# Keyword rules answering confident classifications without the model
+@app.on_event("startup")
+async def load_defect_rules():
+    try:
+        await defect_rules.load_rules(db)
+    except Exception as e:
+        logger.error(f"Defect rules failed to load: {str(e)}")
+
+def reload_defect_rules(collection_name: str, item_ids: Optional[List[str]]):
+    """Recompile after another worker edited the rules"""
+    if collection_name == defect_rules.RULES_COLLECTION:
+        run_in_background(defect_rules.load_rules(db), "Defect rules reload")
+
+invalidation_bus.subscribe(reload_defect_rules)
+
+# Queued AI work (services/ai_job_queue.py)
+ai_jobs = AIJobQueue(db)
+
+@app.on_event("startup")
+async def start_ai_jobs():
+    """Requeue jobs orphaned by a previous process and start the workers"""
+    try:
+        await ai_jobs.start()
+    except Exception as e:
+        logger.error(f"AI job queue failed to start: {str(e)}")
+
+@app.on_event("shutdown")
+async def stop_ai_jobs():
+    await ai_jobs.stop()
+
+def use_ai_cache(data: Dict[str, Any]) -> bool:
+    """Requests send {"bypassCache": true} to force a fresh completion"""
+    return not data.get("bypassCache", False)
+
+def use_fast_path(data: Dict[str, Any]) -> bool:
+    """Requests send {"forceModel": true} to skip the keyword-rule fast path"""
+    return not data.get("forceModel", False)
 
 @app.post("/api/ai/rca-suggestions", tags=["AI"])
 async def get_ai_rca_suggestions(data: Dict[str, Any]):
@@ -935,7 +1517,7 @@ async def get_ai_rca_suggestions(data: Dict[str, Any]):
     defect_type = data.get("defectType", "unknown")
     severity = data.get("severity", "minor")
     
-    suggestions = await ai_service.get_rca_suggestions(defect_description, defect_type, severity)
+    suggestions = await ai_service.get_rca_suggestions(defect_description, defect_type, severity, use_cache=use_ai_cache(data))
     return suggestions
 
 @app.post("/api/ai/classify-defect", tags=["AI"])
@@ -944,16 +1526,33 @@ async def classify_defect(data: Dict[str, Any]):
     description = data.get("description", "")
     image_url = data.get("imageUrl")
     
-    classification = await ai_service.classify_defect(description, image_url)
+    classification = await ai_service.classify_defect(description, image_url, use_cache=use_ai_cache(data), use_fast_path=use_fast_path(data))
     return classification
 
+@app.post("/api/ai/classify-defects/batch", tags=["AI"])
+async def classify_defects_batch(data: Dict[str, Any]):
+    """Classify many defect descriptions in chunked prompts
+    
+    Body: {"descriptions": ["...", "..."]}; results are returned in input order.
+    """
+    descriptions = data.get("descriptions")
+    if not isinstance(descriptions, list) or not all(isinstance(d, str) for d in descriptions):
+        raise HTTPException(status_code=400, detail="descriptions must be a list of strings")
+    if len(descriptions) > CLASSIFY_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {CLASSIFY_BATCH_MAX_ITEMS} descriptions per request")
+    
+    started = time.perf_counter()
+    batch = await ai_service.classify_defects_batch(descriptions, use_cache=use_ai_cache(data), use_fast_path=use_fast_path(data))
+    batch["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return batch
+
 @app.post("/api/ai/generate-capa", tags=["AI"])
 async def generate_capa_actions(data: Dict[str, Any]):
     """Generate CAPA actions based on root cause using GPT-5.2"""
     root_cause = data.get("rootCause", "")
     defect_type = data.get("defectType", "")
     
-    capa = await ai_service.generate_capa_actions(root_cause, defect_type)
+    capa = await ai_service.generate_capa_actions(root_cause, defect_type, use_cache=use_ai_cache(data))
     return capa
 
 @app.post("/api/ai/predict-trend", tags=["AI"])
@@ -961,25 +1560,76 @@ async def predict_defect_trend(data: Dict[str, Any]):
     """Predict defect trends using GPT-5.2"""
     historical_defects = data.get("historicalDefects", [])
     
-    prediction = await ai_service.predict_defect_trend(historical_defects)
+    prediction = await ai_service.predict_defect_trend(historical_defects, use_cache=use_ai_cache(data))
     return prediction
 
+# Fields search_knowledge_base reads from each candidate document
+RERANK_FIELDS = {"title": 1, "category": 1, "tags": 1, "content": 1}
+
 @app.post("/api/ai/search-knowledge", tags=["AI"])
 async def search_knowledge(data: Dict[str, Any]):
-    """Semantic knowledge base search using GPT-5.2"""
+    """Knowledge base search: BM25 over knowledge documents and SOPs
+    
+    Body: {"query": "...", "limit": 10, "collections": ["sops"], "rerank": false}
+    rerank=true additionally lets GPT-5.2 reorder the top SEARCH_RERANK_CANDIDATES hits.
+    """
     query = data.get("query", "")
+    limit = data.get("limit", 10)
+    collections = data.get("collections")
+    if not isinstance(query, str):
+        raise HTTPException(status_code=400, detail="query must be a string")
+    if isinstance(limit, bool) or not isinstance(limit, int):
+        raise HTTPException(status_code=400, detail="limit must be an integer")
+    if collections is not None and (
+        not isinstance(collections, list) or not all(name in SEARCH_SOURCES for name in collections)
+    ):
+        raise HTTPException(status_code=400, detail=f"collections must be a list of: {', '.join(SEARCH_SOURCES)}")
+    limit = max(1, min(limit, 100))
+    started = time.perf_counter()
     
-    documents = await get_items("knowledge_documents", limit=1000)
+    candidates = SEARCH_RERANK_CANDIDATES if data.get("rerank") else limit
+    hits, total = search_index.search(query, max(limit, candidates), collections)
+    results = {
+        "results": hits[:limit],
+        "total_matches": total,
+        "search_time_ms": round((time.perf_counter() - started) * 1000, 2),
+        "model": "bm25",
+    }
+    if not data.get("rerank") or not hits:
+        return results
     
-    results = await ai_service.search_knowledge_base(query, documents)
-    return results
+    # One $in lookup per collection, then back into BM25 order
+    ids_by_collection: Dict[str, List[ObjectId]] = {}
+    for hit in hits:
+        ids_by_collection.setdefault(hit["collection"], []).append(ObjectId(hit["id"]))
+    found = {}
+    for collection_name, ids in ids_by_collection.items():
+        async for doc in db[collection_name].find({"_id": {"$in": ids}}, RERANK_FIELDS):
+            found[(collection_name, str(doc["_id"]))] = doc
+    documents = [
+        serialize_doc(found[(hit["collection"], hit["id"])])
+        for hit in hits if (hit["collection"], hit["id"]) in found
+    ]
+    reranked = await ai_service.search_knowledge_base(query, documents, use_cache=use_ai_cache(data))
+    if reranked.get("model") == "fallback":
+        return results
+    reranked["total_matches"] = total
+    return reranked
+
+async def sse_events(events):
+    """Format (event, data) pairs as Server-Sent Events"""
+    async for event, payload in events:
+        yield b"event: " + event.encode() + b"\ndata: " + json_dumps(payload) + b"\n\n"
 
 @app.post("/api/ai/invoke-llm", tags=["AI"])
-async def invoke_llm(data: Dict[str, Any]):
+async def invoke_llm(request: Request, data: Dict[str, Any]):
     """Generic LLM invocation endpoint for frontend integrations
     
     This replaces the Base44 integrations.Core.InvokeLLM functionality.
     Supports structured prompts with optional JSON schema for responses.
+    With {"stream": true} (or Accept: text/event-stream) the completion is sent
+    as Server-Sent Events: start, chunk ({"text"}) as tokens arrive, then done
+    ({"response", "parsed"}) or error.
     """
     prompt = data.get("prompt", "")
     response_json_schema = data.get("response_json_schema", None)
@@ -988,46 +1638,124 @@ async def invoke_llm(data: Dict[str, Any]):
     if not prompt:
         return {"error": "Prompt is required", "response": None}
     
+    if data.get("stream") or "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            sse_events(ai_service.stream_llm(prompt, response_json_schema, use_cache=use_ai_cache(data))),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
     try:
-        from emergentintegrations.llm.chat import LlmChat, UserMessage
-        import uuid
-        
-        EMERGENT_LLM_KEY = os.environ.get("EMERGENT_LLM_KEY")
-        
-        # Build system message based on whether JSON schema is expected
-        system_message = "You are a helpful AI assistant for quality management tasks."
-        if response_json_schema:
-            system_message += f"\n\nYou must respond in valid JSON format matching this schema:\n{json.dumps(response_json_schema, indent=2)}"
-        
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"invoke-{uuid.uuid4()}",
-            system_message=system_message
-        ).with_model("openai", "gpt-5.2")
-        
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
-        
-        # Try to parse as JSON if schema was provided
-        if response_json_schema:
-            try:
-                response_text = response.strip()
-                if response_text.startswith("```json"):
-                    response_text = response_text[7:]
-                if response_text.startswith("```"):
-                    response_text = response_text[3:]
-                if response_text.endswith("```"):
-                    response_text = response_text[:-3]
-                return json.loads(response_text.strip())
-            except json.JSONDecodeError:
-                return {"response": response, "model": "gpt-5.2"}
-        else:
-            return {"response": response, "model": "gpt-5.2"}
-            
+        return await ai_service.invoke_llm(prompt, response_json_schema, use_cache=use_ai_cache(data))
     except Exception as e:
         logger.error(f"LLM invocation error: {str(e)}")
         return {"error": str(e), "response": None, "model": "error"}
 
+@app.get("/api/ai/metrics", tags=["AI"])
+async def ai_metrics():
+    """LLM response cache, in-flight coalescing, gateway (latency / circuit breaker), keyword fast path and job queue metrics"""
+    return {
+        "cache": ai_service.cache_stats(),
+        "coalescing": ai_service.coalesce_stats(),
+        "gateway": ai_gateway.stats(),
+        "fast_path": ai_service.fast_path_stats(),
+        "jobs": await ai_jobs.stats(),
+    }
+
+@app.post("/api/ai/jobs", tags=["AI"], status_code=202)
+async def submit_ai_job(data: Dict[str, Any], current_user: Dict = Depends(get_current_user_optional)):
+    """Queue an AI job instead of waiting for it
+    
+    Body: {"kind": "rca|capa|classify|invoke|chain", "params": {...},
+           "target": {"collection": "rca_records", "id": "..."}}
+    params match the synchronous endpoint of the same kind; chain takes
+    {"steps": [{"prompt", "response_json_schema"}]}. Progress and completion are
+    pushed to the submitting user and to the WebSocket room ai_job:<id>.
+    """
+    try:
+        job = await ai_jobs.submit(
+            data.get("kind"), data.get("params") or {}, data.get("target"),
+            current_user.get("id") if current_user else None
+        )
+    except InvalidJobError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return serialize_job(job)
+
+@app.get("/api/ai/jobs", tags=["AI"])
+async def list_ai_jobs(targetId: str, limit: int = 50):
+    """Jobs requested for one RCA / CAPA record, newest first"""
+    return [serialize_job(job) for job in await ai_jobs.for_target(targetId, max(1, min(limit, 200)))]
+
+@app.get("/api/ai/jobs/{job_id}", tags=["AI"])
+async def get_ai_job(job_id: str):
+    job = await ai_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return serialize_job(job)
+
+# Attempts at merging a job result into a record that other writes keep changing
+ATTACH_RETRIES = 3
+
+@app.post("/api/ai/jobs/{job_id}/attach", tags=["AI"])
+async def attach_ai_job(job_id: str, data: Optional[Dict[str, Any]] = None):
+    """Write a completed job's result onto its RCA record (aiSuggestions) or CAPA plan
+    (actions appended after the plan's own, tagged {"source": "ai", "aiJobId"})
+    
+    Body (optional): {"id": "..."} to attach to a different record of the same collection.
+    """
+    job = await ai_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != COMPLETED:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    collection_name = ATTACH_TARGETS.get(job["kind"])
+    item_id = (data or {}).get("id") or (job.get("target") or {}).get("id")
+    if not collection_name or not item_id:
+        raise HTTPException(status_code=400, detail="Job has no record to attach to")
+    if not ObjectId.is_valid(item_id):
+        raise HTTPException(status_code=404, detail="Record not found")
+    # Merge with the record as read; a concurrent edit in between means re-reading it
+    for _ in range(ATTACH_RETRIES):
+        record = await db[collection_name].find_one({"_id": ObjectId(item_id)})
+        if not record:
+            raise HTTPException(status_code=404, detail="Record not found")
+        try:
+            updated = await update_item(collection_name, item_id, attachment_for(job, record), current_version(record))
+        except VersionConflictError:
+            continue
+        if not updated:
+            raise HTTPException(status_code=404, detail="Record not found")
+        return item_response(updated)
+    raise HTTPException(status_code=409, detail="Record kept changing while attaching; try again")
+
+@app.get("/api/admin/defect-rules", tags=["Admin"])
+async def get_defect_rules(current_user: Dict = Depends(require_role("admin"))):
+    """Keyword rules per defect type ({defect_type: {keyword: weight}})"""
+    return {"rules": defect_rules.classifier.rules, "threshold": ai_service.CLASSIFY_FAST_PATH_THRESHOLD}
+
+@app.put("/api/admin/defect-rules", tags=["Admin"])
+async def update_defect_rules(data: Dict[str, Any], current_user: Dict = Depends(require_role("admin"))):
+    """Replace the keyword rules; every worker recompiles them"""
+    try:
+        rules = await defect_rules.save_rules(db, data.get("rules"))
+    except defect_rules.InvalidRulesError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await invalidation_bus.publish(defect_rules.RULES_COLLECTION)
+    return {"rules": rules, "threshold": ai_service.CLASSIFY_FAST_PATH_THRESHOLD}
+
+@app.delete("/api/admin/defect-rules", tags=["Admin"])
+async def reset_defect_rules(current_user: Dict = Depends(require_role("admin"))):
+    """Go back to the built-in keyword rules"""
+    rules = await defect_rules.reset_rules(db)
+    await invalidation_bus.publish(defect_rules.RULES_COLLECTION)
+    return {"rules": rules, "threshold": ai_service.CLASSIFY_FAST_PATH_THRESHOLD}
+
+@app.delete("/api/admin/ai-cache", tags=["Admin"])
+async def clear_ai_cache(function: Optional[str] = None, current_user: Dict = Depends(require_role("admin"))):
+    """Drop cached LLM completions (optionally for one function, e.g. classify)"""
+    deleted = await ai_service.clear_cache(function)
+    return {"deleted": deleted}
+
 # ============== FILE UPLOAD ENDPOINTS ==============
 from services.file_upload_service import save_upload_file, save_multiple_files, delete_file, list_files
 from fastapi.responses import FileResponse
@@ -1178,6 +1906,19 @@ async def send_email_notification(
 # ============== WEBSOCKET REAL-TIME NOTIFICATIONS ==============
 from services.websocket_service import manager, send_notification, NotificationType
 from fastapi import WebSocket, WebSocketDisconnect
+from services.change_stream_service import ChangeStreamWatcher
+
+change_watcher = ChangeStreamWatcher(db)
+
+@app.on_event("startup")
+async def start_change_watcher():
+    """Fan out defect/complaint/RCA/CAPA/KPI changes to subscribed rooms (entity:<collection>)"""
+    if CHANGE_STREAMS_ENABLED:
+        await change_watcher.start()
+
+@app.on_event("shutdown")
+async def stop_change_watcher():
+    await change_watcher.stop()
 
 @app.websocket("/ws/notifications")
 async def websocket_notifications(websocket: WebSocket, user_id: Optional[str] = None):
@@ -1281,10 +2022,28 @@ async def export_complaints_excel(current_user: Dict = Depends(get_current_user_
         headers={"Content-Disposition": "attachment; filename=complaints_export.xlsx"}
     )
 
+async def kpi_export_rows(period: Optional[str], limit: int):
+    """Manually entered KPIs, or precomputed rollups (all lines) when period is given"""
+    if period is None:
+        return await get_items("kpis", "-recordDate", limit)
+    if period not in ROLLUP_PERIODS:
+        raise HTTPException(status_code=400, detail=f"period must be one of {', '.join(ROLLUP_PERIODS)}")
+    rows = await kpi_rollups.query(period, "all", limit=limit)
+    return to_jsonable([
+        {
+            "recordDate": row["periodStart"],
+            "firstPassYield": row.get("firstPassYield"),
+            "defectPPM": row.get("defectPPM"),
+            "onTimeCAPA": row.get("onTimeCAPA"),
+            "customerComplaints": row.get("complaints", 0),
+        }
+        for row in reversed(rows)
+    ])
+
 @app.get("/api/export/kpis/pdf", tags=["Export"])
-async def export_kpis_pdf(current_user: Dict = Depends(get_current_user_optional)):
-    """Export KPIs report as PDF"""
-    kpis = await get_items("kpis", "-recordDate", 365)
+async def export_kpis_pdf(period: Optional[str] = None, current_user: Dict = Depends(get_current_user_optional)):
+    """Export KPIs report as PDF (period=day|week|month exports the rollups instead)"""
+    kpis = await kpi_export_rows(period, 365)
     pdf_bytes = pdf_exporter.create_kpi_report(kpis)
     
     return StreamingResponse(
@@ -1294,9 +2053,9 @@ async def export_kpis_pdf(current_user: Dict = Depends(get_current_user_optional
     )
 
 @app.get("/api/export/kpis/excel", tags=["Export"])
-async def export_kpis_excel(current_user: Dict = Depends(get_current_user_optional)):
-    """Export KPIs as Excel spreadsheet"""
-    kpis = await get_items("kpis", "-recordDate", 1000)
+async def export_kpis_excel(period: Optional[str] = None, current_user: Dict = Depends(get_current_user_optional)):
+    """Export KPIs as Excel spreadsheet (period=day|week|month exports the rollups instead)"""
+    kpis = await kpi_export_rows(period, 1000)
     excel_bytes = excel_exporter.create_kpi_export(kpis)
     
     return StreamingResponse(
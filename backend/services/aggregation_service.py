@@ -0,0 +1,261 @@
+# Aggregation Service for QualityStudio
+# Compiles a small, whitelisted group-by spec into a MongoDB aggregation pipeline
+
+import os
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from services.projection import FIELD_NAME
+
+AGGREGATION_MAX_TIME_MS = int(os.environ.get("AGGREGATION_MAX_TIME_MS", 15000))
+MAX_GROUPS = 10000
+
+COMPARISON_OPS = {"$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin", "$exists"}
+RANGE_OPS = {"$gt", "$gte", "$lt", "$lte"}
+LOGICAL_OPS = {"$and", "$or"}
+DATE_UNITS = {"minute", "hour", "day", "week", "month", "quarter", "year"}
+METRIC_OPS = {"count", "sum", "avg", "min", "max", "percentile", "median"}
+# $percentile / $median accumulators exist from MongoDB 7.0; older servers get a 400
+PERCENTILE_OPS = {"percentile", "median"}
+PERCENTILE_MIN_SERVER_VERSION = (7, 0)
+
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?(Z|[+-]\d{2}:\d{2})?$")
+OUTPUT_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+# Fixed offsets $dateTrunc accepts next to Olson names: +05:30, -0800, +02
+UTC_OFFSET = re.compile(r"^[+-]\d{2}(:?\d{2})?$")
+
+
+class InvalidAggregationError(ValueError):
+    """Raised when an aggregation spec uses something outside the whitelist"""
+
+
+def _field(name: Any) -> str:
+    if not isinstance(name, str) or not FIELD_NAME.match(name):
+        raise InvalidAggregationError(f"Invalid field name: {name}")
+    return name
+
+
+def _output_name(name: Any) -> str:
+    if not isinstance(name, str) or not OUTPUT_NAME.match(name):
+        raise InvalidAggregationError(f"Invalid output name: {name}")
+    return name
+
+
+def _scalar(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        raise InvalidAggregationError("Filter values must be scalars")
+    return value
+
+
+def _date_or_value(value: Any) -> Any:
+    """Range bounds arrive as JSON strings; compare them as dates when they look like ISO dates"""
+    if isinstance(value, str) and ISO_DATE.match(value):
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return value
+
+
+def compile_match(spec: Any) -> Dict[str, Any]:
+    if not isinstance(spec, dict):
+        raise InvalidAggregationError("match must be an object")
+    compiled = {}
+    for key, value in spec.items():
+        if key in LOGICAL_OPS:
+            if not isinstance(value, list) or not value:
+                raise InvalidAggregationError(f"{key} needs a non-empty list")
+            compiled[key] = [compile_match(clause) for clause in value]
+            continue
+
+        field = _field(key)
+        if not isinstance(value, dict):
+            compiled[field] = _scalar(value)
+            continue
+
+        conditions = {}
+        for op, operand in value.items():
+            if op not in COMPARISON_OPS:
+                raise InvalidAggregationError(f"Operator not allowed: {op}")
+            if op in ("$in", "$nin"):
+                if not isinstance(operand, list):
+                    raise InvalidAggregationError(f"{op} needs a list")
+                conditions[op] = [_scalar(item) for item in operand]
+            elif op == "$exists":
+                conditions[op] = bool(operand)
+            elif op in RANGE_OPS:
+                conditions[op] = _date_or_value(_scalar(operand))
+            else:
+                conditions[op] = _scalar(operand)
+        compiled[field] = conditions
+    return compiled
+
+
+def _group_fields(spec: Any) -> List[Tuple[str, str]]:
+    """groupBy entries: "line" or {"field": "qualityMetrics.grade", "as": "grade"}"""
+    if spec is None:
+        return []
+    if not isinstance(spec, list):
+        raise InvalidAggregationError("groupBy must be a list")
+    fields = []
+    for entry in spec:
+        if isinstance(entry, dict):
+            field = _field(entry.get("field"))
+            alias = _output_name(entry.get("as", field.replace(".", "_")))
+        else:
+            field = _field(entry)
+            alias = _output_name(field.replace(".", "_"))
+        fields.append((field, alias))
+    return fields
+
+
+def _timezone(value: Any) -> str:
+    if isinstance(value, str) and UTC_OFFSET.match(value):
+        return value
+    try:
+        ZoneInfo(value)
+    except (ZoneInfoNotFoundError, TypeError, ValueError):
+        raise InvalidAggregationError(f"Unknown timezone: {value}")
+    return value
+
+
+def _date_bucket(spec: Any) -> Tuple[str, Dict[str, Any]]:
+    if not isinstance(spec, dict):
+        raise InvalidAggregationError("dateBucket must be an object")
+    unit = spec.get("unit", "day")
+    if unit not in DATE_UNITS:
+        raise InvalidAggregationError(f"Unsupported date unit: {unit}")
+    bin_size = spec.get("binSize", 1)
+    if not isinstance(bin_size, int) or bin_size < 1:
+        raise InvalidAggregationError("binSize must be a positive integer")
+    trunc = {
+        "date": f"${_field(spec.get('field'))}",
+        "unit": unit,
+        "binSize": bin_size,
+        "timezone": _timezone(spec.get("timezone", "UTC")),
+    }
+    if unit == "week":
+        trunc["startOfWeek"] = str(spec.get("startOfWeek", "monday"))
+    return _output_name(spec.get("as", "period")), {"$dateTrunc": trunc}
+
+
+def _metrics(spec: Any) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Returns ($group accumulators, post-group expressions for each output)"""
+    spec = spec or [{"op": "count"}]
+    if not isinstance(spec, list):
+        raise InvalidAggregationError("metrics must be a list")
+    accumulators, outputs = {}, {}
+    for metric in spec:
+        if not isinstance(metric, dict) or metric.get("op") not in METRIC_OPS:
+            raise InvalidAggregationError(f"metric op must be one of {', '.join(sorted(METRIC_OPS))}")
+        op = metric["op"]
+        if op == "count":
+            name = _output_name(metric.get("as", "count"))
+            accumulators[name] = {"$sum": 1}
+            outputs[name] = f"${name}"
+            continue
+
+        field = _field(metric.get("field"))
+        name = _output_name(metric.get("as", f"{op}_{field.replace('.', '_')}"))
+        if op in ("sum", "avg", "min", "max"):
+            accumulators[name] = {f"${op}": f"${field}"}
+            outputs[name] = f"${name}"
+        elif op == "median":
+            accumulators[name] = {"$median": {"input": f"${field}", "method": "approximate"}}
+            outputs[name] = f"${name}"
+        else:
+            p = metric.get("p", 0.5)
+            if not isinstance(p, (int, float)) or not 0 <= p <= 1:
+                raise InvalidAggregationError("percentile p must be between 0 and 1")
+            accumulators[name] = {"$percentile": {"input": f"${field}", "p": [p], "method": "approximate"}}
+            outputs[name] = {"$arrayElemAt": [f"${name}", 0]}
+    return accumulators, outputs
+
+
+def _sort(spec: Any, outputs: List[str], default: List[str]) -> Dict[str, int]:
+    """"-count" / "period" / ["line", "-count"]"""
+    if spec is None:
+        return {name: 1 for name in default} or {outputs[0]: -1}
+    entries = spec if isinstance(spec, list) else [spec]
+    order = {}
+    for entry in entries:
+        if not isinstance(entry, str):
+            raise InvalidAggregationError("sort entries must be strings")
+        direction = -1 if entry.startswith("-") else 1
+        name = entry.lstrip("-")
+        if name not in outputs:
+            raise InvalidAggregationError(f"Cannot sort on {name}; not an output column")
+        order[name] = direction
+    return order
+
+
+def compile_pipeline(spec: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Build the pipeline for an aggregation spec:
+
+    {"match": {...}, "groupBy": ["line"], "dateBucket": {"field": "dateTime", "unit": "week"},
+     "metrics": [{"op": "count"}, {"op": "avg", "field": "cpk"}], "sort": "period", "limit": 500}
+    """
+    if not isinstance(spec, dict):
+        raise InvalidAggregationError("Aggregation spec must be an object")
+
+    pipeline = []
+    if spec.get("match"):
+        pipeline.append({"$match": compile_match(spec["match"])})
+
+    group_id = {alias: f"${field}" for field, alias in _group_fields(spec.get("groupBy"))}
+    keys = list(group_id)
+    if spec.get("dateBucket"):
+        alias, expression = _date_bucket(spec["dateBucket"])
+        group_id[alias] = expression
+        keys.insert(0, alias)
+
+    accumulators, outputs = _metrics(spec.get("metrics"))
+    if set(accumulators) & set(group_id):
+        raise InvalidAggregationError("Metric names must differ from group names")
+
+    pipeline.append({"$group": {"_id": group_id or None, **accumulators}})
+    pipeline.append({"$project": {
+        "_id": 0,
+        **{key: f"$_id.{key}" for key in keys},
+        **outputs,
+    }})
+
+    pipeline.append({"$sort": _sort(spec.get("sort"), keys + list(outputs), keys)})
+
+    limit = spec.get("limit", 1000)
+    if not isinstance(limit, int) or not 0 < limit <= MAX_GROUPS:
+        raise InvalidAggregationError(f"limit must be between 1 and {MAX_GROUPS}")
+    pipeline.append({"$limit": limit})
+    return pipeline
+
+
+_server_version: Optional[Tuple[int, ...]] = None
+
+
+async def server_version(db) -> Tuple[int, ...]:
+    """MongoDB server version, asked once per process"""
+    global _server_version
+    if _server_version is None:
+        info = await db.command("buildInfo")
+        _server_version = tuple(info["versionArray"][:2])
+    return _server_version
+
+
+async def check_server_support(db, spec: Dict[str, Any]):
+    """Reject percentile/median metrics the connected server cannot compute"""
+    used = {metric.get("op") for metric in spec.get("metrics") or [] if isinstance(metric, dict)} & PERCENTILE_OPS
+    if not used:
+        return
+    version = await server_version(db)
+    if version < PERCENTILE_MIN_SERVER_VERSION:
+        required = ".".join(map(str, PERCENTILE_MIN_SERVER_VERSION))
+        raise InvalidAggregationError(
+            f"{' and '.join(sorted(used))} metrics need MongoDB {required} or later "
+            f"(server is {'.'.join(map(str, version))})"
+        )
+
+
+async def run_aggregation(collection, spec: Dict[str, Any]) -> List[Dict[str, Any]]:
+    pipeline = compile_pipeline(spec)
+    await check_server_support(collection.database, spec)
+    cursor = collection.aggregate(pipeline, allowDiskUse=True, maxTimeMS=AGGREGATION_MAX_TIME_MS)
+    return await cursor.to_list(length=None)
@@ -0,0 +1,226 @@
+# AI Gateway for QualityStudio
+# Every model call goes through one gateway per worker, which applies:
+# - a bulkhead: at most AI_MAX_CONCURRENCY calls in flight. A caller that
+#   cannot get a slot within AI_QUEUE_TIMEOUT seconds is turned away.
+# - a deadline per call.
+# - a circuit breaker: after AI_BREAKER_FAILURES consecutive failures, calls
+#   are refused for AI_BREAKER_RESET seconds. One probe call then decides
+#   whether the circuit closes again.
+# Refused calls raise AIUnavailableError without waiting. Callers answer them
+# from local rules, so a slow provider cannot tie up the worker.
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+AI_MAX_CONCURRENCY = int(os.environ.get("AI_MAX_CONCURRENCY", 8))
+AI_QUEUE_TIMEOUT = float(os.environ.get("AI_QUEUE_TIMEOUT", 1))
+AI_BREAKER_FAILURES = int(os.environ.get("AI_BREAKER_FAILURES", 5))
+AI_BREAKER_RESET = float(os.environ.get("AI_BREAKER_RESET", 30))
+
+# Latency samples kept per function for percentiles
+LATENCY_WINDOW = 200
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class AIUnavailableError(RuntimeError):
+    """Raised when the gateway refuses a call (circuit open or bulkhead full)"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker with a single half-open probe"""
+
+    def __init__(self, failure_threshold: int = AI_BREAKER_FAILURES, reset_seconds: float = AI_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.times_opened = 0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info("AI circuit closed")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self.probing = False
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.times_opened += 1
+                logger.warning(f"AI circuit opened after {self.consecutive_failures} consecutive failures")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """A half-open probe that ended without a verdict (e.g. cancelled)"""
+        self.probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        retry_in = None
+        if self.state == OPEN:
+            retry_in = round(max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at)), 1)
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "reset_seconds": self.reset_seconds,
+            "times_opened": self.times_opened,
+            "retry_in_seconds": retry_in,
+        }
+
+
+class CallMetrics:
+    """Outcome counters and recent latencies for one function"""
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def stats(self) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+
+        def percentile(p: float) -> Optional[float]:
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 1)
+
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "max": percentile(1.0)},
+        }
+
+
+class AIGateway:
+    """Bulkhead + deadline + circuit breaker around model calls"""
+
+    def __init__(self, max_concurrency: int = AI_MAX_CONCURRENCY, queue_timeout: float = AI_QUEUE_TIMEOUT,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+        self.metrics: Dict[str, CallMetrics] = {}
+
+    def _metrics(self, function: str) -> CallMetrics:
+        if function not in self.metrics:
+            self.metrics[function] = CallMetrics()
+        return self.metrics[function]
+
+    async def _admit(self, metrics: CallMetrics):
+        """Pass the breaker and take a bulkhead slot, or raise AIUnavailableError"""
+        if not self.breaker.allow():
+            metrics.rejected += 1
+            raise AIUnavailableError("AI circuit open")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            metrics.rejected += 1
+            self.breaker.release_probe()
+            raise AIUnavailableError(f"AI bulkhead full ({self.max_concurrency} calls in flight)")
+        self.active += 1
+        metrics.calls += 1
+
+    def _release(self, metrics: CallMetrics, started: float):
+        metrics.latencies.append((time.perf_counter() - started) * 1000)
+        self.active -= 1
+        self._slots.release()
+
+    async def call(self, function: str, factory: Callable[[], Awaitable[Any]], deadline: float) -> Any:
+        """Run factory() under the gateway's limits; raises AIUnavailableError when refused"""
+        metrics = self._metrics(function)
+        await self._admit(metrics)
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(factory(), deadline)
+        except asyncio.TimeoutError:
+            metrics.timeouts += 1
+            self.breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            self.breaker.release_probe()
+            raise
+        except Exception:
+            metrics.failures += 1
+            self.breaker.record_failure()
+            raise
+        else:
+            self.breaker.record_success()
+            return result
+        finally:
+            self._release(metrics, started)
+
+    async def stream(self, function: str, open_stream: Callable[[], AsyncIterator[Any]], deadline: float) -> AsyncIterator[Any]:
+        """Like call() for a streamed completion; the deadline covers the whole stream"""
+        metrics = self._metrics(function)
+        await self._admit(metrics)
+        started = time.perf_counter()
+        ends_at = time.monotonic() + deadline
+        try:
+            chunks = open_stream().__aiter__()
+            while True:
+                remaining = ends_at - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), remaining)
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except asyncio.TimeoutError:
+            metrics.timeouts += 1
+            self.breaker.record_failure()
+            raise
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client went away mid-stream; says nothing about provider health
+            self.breaker.release_probe()
+            raise
+        except Exception:
+            metrics.failures += 1
+            self.breaker.record_failure()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            self._release(metrics, started)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "breaker": self.breaker.stats(),
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queue_timeout_seconds": self.queue_timeout,
+            "functions": {function: metrics.stats() for function, metrics in self.metrics.items()},
+        }
+
+
+gateway = AIGateway()
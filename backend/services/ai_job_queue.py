@@ -0,0 +1,345 @@
+# AI Job Queue for QualityStudio
+# Long-running AI work (RCA and CAPA generation, multi-step InvokeLLM chains)
+# is queued in the ai_jobs collection and processed by a small pool of
+# workers in each server process. Jobs are claimed with an atomic
+# find_one_and_update, so several processes can share one queue; results
+# stay on the job document, from where they can be attached to the
+# RCA / CAPA record they were requested for.
+# Running jobs send a heartbeat; a job whose worker stops sending it is
+# requeued, or failed once it has used up its attempts.
+
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from services import ai_service
+from services.json_codec import to_jsonable
+from services.websocket_service import send_notification, NotificationType
+
+logger = logging.getLogger(__name__)
+
+JOBS_COLLECTION = "ai_jobs"
+
+# Concurrent jobs per server process
+AI_JOB_WORKERS = int(os.environ.get("AI_JOB_WORKERS", 2))
+# Seconds an idle worker waits before looking for jobs queued by other processes
+AI_JOB_POLL_INTERVAL = float(os.environ.get("AI_JOB_POLL_INTERVAL", 5))
+# Running jobs refresh updated_date this often while their worker is alive
+AI_JOB_HEARTBEAT_INTERVAL = float(os.environ.get("AI_JOB_HEARTBEAT_INTERVAL", 30))
+# A running job without a heartbeat for this long is assumed orphaned by a dead process
+AI_JOB_STALE_AFTER = float(os.environ.get("AI_JOB_STALE_AFTER", 150))
+AI_JOB_MAX_ATTEMPTS = int(os.environ.get("AI_JOB_MAX_ATTEMPTS", 3))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# Collections a job result can be attached to, per job kind
+ATTACH_TARGETS = {
+    "rca": "rca_records",
+    "capa": "capa_plans",
+}
+
+MAX_CHAIN_STEPS = 20
+
+
+class InvalidJobError(ValueError):
+    """Raised for unknown job kinds or missing parameters"""
+
+
+def job_room(job_id: str) -> str:
+    """WebSocket room receiving progress and completion of one job"""
+    return f"ai_job:{job_id}"
+
+
+def _checked(result: Any, step: str = "AI call") -> Any:
+    """Raise for a fallback or error answer, so the job is retried and then
+    marked failed instead of completing with placeholder output"""
+    if isinstance(result, dict) and result.get("model") in ("fallback", "error"):
+        raise RuntimeError(f"{step} failed: {result.get('error') or 'model unavailable'}")
+    return result
+
+
+async def _run_rca(params: Dict[str, Any], progress) -> Any:
+    return _checked(await ai_service.get_rca_suggestions(
+        params.get("description", ""), params.get("defectType", "unknown"), params.get("severity", "minor")
+    ))
+
+
+async def _run_capa(params: Dict[str, Any], progress) -> Any:
+    return _checked(await ai_service.generate_capa_actions(params.get("rootCause", ""), params.get("defectType", "")))
+
+
+async def _run_classify(params: Dict[str, Any], progress) -> Any:
+    return _checked(await ai_service.classify_defect(params.get("description", ""), params.get("imageUrl")))
+
+
+async def _run_invoke(params: Dict[str, Any], progress) -> Any:
+    return _checked(await ai_service.invoke_llm(params["prompt"], params.get("response_json_schema")))
+
+
+async def _run_chain(params: Dict[str, Any], progress) -> Any:
+    """Run InvokeLLM steps in order; "{previous}" in a prompt is replaced by the prior result"""
+    steps = params["steps"]
+    results: List[Any] = []
+    for index, step in enumerate(steps):
+        prompt = step["prompt"]
+        if results and "{previous}" in prompt:
+            prompt = prompt.replace("{previous}", json.dumps(results[-1], default=str))
+        result = _checked(await ai_service.invoke_llm(prompt, step.get("response_json_schema")), f"Step {index + 1}")
+        results.append(result)
+        await progress(index + 1, len(steps))
+    return {"steps": results, "final": results[-1]}
+
+
+JOB_KINDS: Dict[str, Callable[[Dict[str, Any], Callable[[int, int], Awaitable[None]]], Awaitable[Any]]] = {
+    "rca": _run_rca,
+    "capa": _run_capa,
+    "classify": _run_classify,
+    "invoke": _run_invoke,
+    "chain": _run_chain,
+}
+
+
+def validate_job(kind: str, params: Dict[str, Any], target: Optional[Dict[str, Any]]):
+    if kind not in JOB_KINDS:
+        raise InvalidJobError(f"kind must be one of {', '.join(JOB_KINDS)}")
+    if not isinstance(params, dict):
+        raise InvalidJobError("params must be an object")
+    if kind == "invoke" and not params.get("prompt"):
+        raise InvalidJobError("params.prompt is required")
+    if kind == "chain":
+        steps = params.get("steps")
+        if not isinstance(steps, list) or not steps or len(steps) > MAX_CHAIN_STEPS:
+            raise InvalidJobError(f"params.steps must list 1-{MAX_CHAIN_STEPS} steps")
+        if not all(isinstance(step, dict) and step.get("prompt") for step in steps):
+            raise InvalidJobError("Every step needs a prompt")
+    if target is not None:
+        if target.get("collection") != ATTACH_TARGETS.get(kind):
+            raise InvalidJobError(f"{kind} results cannot be attached to {target.get('collection')}")
+        if not ObjectId.is_valid(target.get("id", "")):
+            raise InvalidJobError("target.id is not a valid id")
+
+
+def attachment_for(job: Dict[str, Any], record: Dict[str, Any]) -> Dict[str, Any]:
+    """Fields to write on the target record for a completed job
+
+    CAPA actions are appended after the plan's own actions, tagged with the
+    job id; entries from an earlier attach of the same job are replaced, so
+    attaching twice does not duplicate them.
+    """
+    result = job.get("result") or {}
+    if job["kind"] == "rca":
+        return {"aiSuggestions": result.get("suggestions", [])}
+    if job["kind"] == "capa":
+        job_id = str(job["_id"])
+        fields = {}
+        for field, key in (("correctiveActions", "corrective_actions"), ("preventiveActions", "preventive_actions")):
+            kept = [
+                action for action in record.get(field) or []
+                if not (isinstance(action, dict) and action.get("aiJobId") == job_id)
+            ]
+            fields[field] = kept + [{"action": action, "source": "ai", "aiJobId": job_id} for action in result.get(key, [])]
+        return fields
+    raise InvalidJobError(f"{job['kind']} results cannot be attached")
+
+
+def serialize_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    doc = {key: value for key, value in job.items() if key != "_id"}
+    doc["id"] = str(job["_id"])
+    return to_jsonable(doc)
+
+
+class AIJobQueue:
+    """Mongo-persisted job queue with an in-process worker pool"""
+
+    def __init__(self, db, workers: int = AI_JOB_WORKERS):
+        self.db = db
+        self.workers = workers
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._running: set = set()
+
+    @property
+    def jobs(self):
+        return self.db[JOBS_COLLECTION]
+
+    async def ensure_indexes(self):
+        await self.jobs.create_index([("status", 1), ("created_date", 1)])
+        await self.jobs.create_index([("target.id", 1), ("created_date", -1)])
+
+    async def submit(self, kind: str, params: Dict[str, Any], target: Optional[Dict[str, Any]] = None,
+                     created_by: Optional[str] = None) -> Dict[str, Any]:
+        validate_job(kind, params, target)
+        now = datetime.utcnow()
+        job = {
+            "kind": kind,
+            "params": params,
+            "target": target,
+            "status": QUEUED,
+            "attempts": 0,
+            "progress": None,
+            "result": None,
+            "error": None,
+            "created_by": created_by,
+            "created_date": now,
+            "updated_date": now,
+        }
+        await self.jobs.insert_one(job)
+        self._wake.set()
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        if not ObjectId.is_valid(job_id):
+            return None
+        return await self.jobs.find_one({"_id": ObjectId(job_id)})
+
+    async def for_target(self, target_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+        return await self.jobs.find({"target.id": target_id}).sort("created_date", -1).limit(limit).to_list(length=limit)
+
+    async def requeue_stale(self) -> int:
+        """Put jobs whose worker stopped sending heartbeats back in the queue.
+
+        Jobs that have used up their attempts are failed instead, so a job
+        that keeps taking its worker down is not retried forever.
+        """
+        now = datetime.utcnow()
+        stale = {"status": RUNNING, "updated_date": {"$lt": now - timedelta(seconds=AI_JOB_STALE_AFTER)}}
+        exhausted = await self.jobs.find({**stale, "attempts": {"$gte": AI_JOB_MAX_ATTEMPTS}}, {"_id": 1}).to_list(length=None)
+        for candidate in exhausted:
+            job = await self.jobs.find_one_and_update(
+                {"_id": candidate["_id"], **stale},
+                {"$set": {"status": FAILED, "error": "Worker stopped responding", "updated_date": now}},
+                return_document=ReturnDocument.AFTER
+            )
+            if job:
+                logger.warning(f"AI job {job['_id']} failed: worker stopped responding on its last attempt")
+                await self._notify(job, NotificationType.AI_JOB_FAILED, "AI job failed",
+                                   f"{job['kind']} job failed: worker stopped responding", "high")
+
+        result = await self.jobs.update_many(
+            {**stale, "attempts": {"$lt": AI_JOB_MAX_ATTEMPTS}},
+            {"$set": {"status": QUEUED, "updated_date": now}}
+        )
+        if result.modified_count:
+            logger.warning(f"Requeued {result.modified_count} stale AI jobs")
+        return result.modified_count
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        return await self.jobs.find_one_and_update(
+            {"status": QUEUED},
+            {"$set": {"status": RUNNING, "started_date": now, "updated_date": now}, "$inc": {"attempts": 1}},
+            sort=[("created_date", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _notify(self, job: Dict[str, Any], notification_type: str, title: str, message: str, priority: str):
+        job_id = str(job["_id"])
+        data = {"jobId": job_id, "kind": job["kind"], "status": job["status"], "target": job.get("target"),
+                "progress": job.get("progress")}
+        await send_notification(notification_type, title, message, data=data, room=job_room(job_id), priority=priority)
+        if job.get("created_by"):
+            await send_notification(notification_type, title, message, data=data,
+                                    user_ids=[job["created_by"]], priority=priority)
+
+    async def _heartbeat(self, job_id: ObjectId):
+        """Keep a running job's updated_date fresh so requeue_stale leaves it alone"""
+        while True:
+            await asyncio.sleep(AI_JOB_HEARTBEAT_INTERVAL)
+            try:
+                await self.jobs.update_one({"_id": job_id, "status": RUNNING}, {"$set": {"updated_date": datetime.utcnow()}})
+            except Exception as e:
+                logger.error(f"AI job {job_id} heartbeat failed: {str(e)}")
+
+    async def _process(self, job: Dict[str, Any]):
+        job_id = job["_id"]
+
+        async def progress(done: int, total: int):
+            job["progress"] = {"done": done, "total": total}
+            await self.jobs.update_one({"_id": job_id}, {"$set": {"progress": job["progress"], "updated_date": datetime.utcnow()}})
+            await self._notify(job, NotificationType.AI_JOB_PROGRESS, "AI job progress",
+                               f"{job['kind']} job: step {done} of {total}", "low")
+
+        beating = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            result = await JOB_KINDS[job["kind"]](job["params"], progress)
+        except Exception as e:
+            logger.error(f"AI job {job_id} failed: {str(e)}")
+            retry = job["attempts"] < AI_JOB_MAX_ATTEMPTS
+            job["status"] = QUEUED if retry else FAILED
+            await self.jobs.update_one({"_id": job_id}, {"$set": {
+                "status": job["status"], "error": str(e), "updated_date": datetime.utcnow()
+            }})
+            if retry:
+                self._wake.set()
+            else:
+                await self._notify(job, NotificationType.AI_JOB_FAILED, "AI job failed",
+                                   f"{job['kind']} job failed: {str(e)}", "high")
+            return
+        finally:
+            beating.cancel()
+
+        now = datetime.utcnow()
+        job["status"] = COMPLETED
+        await self.jobs.update_one({"_id": job_id}, {"$set": {
+            "status": COMPLETED, "result": result, "error": None, "completed_date": now, "updated_date": now
+        }})
+        await self._notify(job, NotificationType.AI_JOB_COMPLETED, "AI job completed",
+                           f"{job['kind']} job finished", "normal")
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"AI job claim failed: {str(e)}")
+                job = None
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), AI_JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    # Quiet moment: also recover jobs left behind by a crashed process
+                    try:
+                        await self.requeue_stale()
+                    except Exception as e:
+                        logger.error(f"AI job requeue failed: {str(e)}")
+                continue
+            self._running.add(job["_id"])
+            try:
+                await self._process(job)
+            except Exception as e:
+                logger.error(f"AI job {job['_id']} could not be recorded: {str(e)}")
+            finally:
+                self._running.discard(job["_id"])
+
+    async def start(self):
+        await self.ensure_indexes()
+        await self.requeue_stale()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"AI job queue started with {self.workers} workers")
+
+    async def stop(self):
+        """Cancel the workers and hand their unfinished jobs back to the queue"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._running:
+            await self.jobs.update_many(
+                {"_id": {"$in": list(self._running)}, "status": RUNNING},
+                {"$set": {"status": QUEUED, "updated_date": datetime.utcnow()}, "$inc": {"attempts": -1}}
+            )
+            self._running.clear()
+
+    async def stats(self) -> Dict[str, int]:
+        rows = await self.jobs.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]).to_list(length=None)
+        return {row["_id"]: row["count"] for row in rows}
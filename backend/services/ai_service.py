@@ -1,24 +1,296 @@
 # AI Service for Quality Studio using OpenAI GPT-5.2
 # Uses Emergent LLM Key for API access
+#
+# Completions are cached by (function, model, normalized prompt hash): an
+# in-memory LRU in front of the llm_cache collection, whose TTL index expires
+# entries after LLM_CACHE_TTL seconds. Only responses that parse as expected
+# are stored, so a malformed answer is retried on the next call.
+#
+# Identical requests that miss the cache while a call is already running
+# join that call instead of starting another (single flight).
+#
+# classify_defect first tries the compiled keyword rules in
+# services/defect_rules.py and only calls the model below
+# CLASSIFY_FAST_PATH_THRESHOLD.
+#
+# Model calls pass through services/ai_gateway.py. While it refuses calls
+# (circuit open, bulkhead full) the deterministic rules in ai_service_mock
+# answer instead, labelled model: fallback.
 
 import os
+import re
+import asyncio
 import json
 import uuid
+import hashlib
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
 from dotenv import load_dotenv
 from emergentintegrations.llm.chat import LlmChat, UserMessage
+from pymongo import ASCENDING
+
+from services import ai_service_mock, defect_rules
+from services.ai_gateway import AIUnavailableError, gateway
+from services.cache_service import LRUCache, parse_ttls
 
 load_dotenv()
 
 EMERGENT_LLM_KEY = os.environ.get("EMERGENT_LLM_KEY")
 
-async def get_rca_suggestions(defect_description: str, defect_type: str, severity: str) -> dict:
+MODEL_PROVIDER = "openai"
+MODEL_NAME = "gpt-5.2"
+
+# Seconds a completion is reused (0 disables caching)
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", 7 * 24 * 3600))
+# Completions kept in process memory in front of the collection
+LLM_CACHE_SIZE = int(os.environ.get("LLM_CACHE_SIZE", 1000))
+
+# Seconds a model call may take; per-function overrides as "rca=90,classify=20"
+LLM_CALL_TIMEOUT = float(os.environ.get("LLM_CALL_TIMEOUT", 60))
+LLM_CALL_TIMEOUTS = parse_ttls(os.environ.get("LLM_CALL_TIMEOUTS", ""))
+
+CACHE_COLLECTION = "llm_cache"
+
+# Chat client method yielding completion chunks, used by stream_llm when present
+STREAM_METHOD = os.environ.get("LLM_STREAM_METHOD", "stream_message")
+
+db = None
+
+response_cache = LRUCache(LLM_CACHE_SIZE, LLM_CACHE_TTL)
+cache_counters = {"memory_hits": 0, "db_hits": 0, "misses": 0, "bypassed": 0}
+
+# Classifications answered by the keyword rules vs. passed on to the model
+fast_path_counters = {"rules": 0, "model": 0}
+
+# Model calls currently running, by cache key; identical requests join them
+in_flight: Dict[str, asyncio.Future] = {}
+coalesce_counters = {"leaders": 0, "followers": 0, "timeouts": 0, "errors": 0}
+
+# Keyword-rule confidence at which classify_defect answers without the model
+CLASSIFY_FAST_PATH_THRESHOLD = float(os.environ.get("CLASSIFY_FAST_PATH_THRESHOLD", 0.85))
+
+# Descriptions packed into one prompt by classify_defects_batch
+CLASSIFY_BATCH_SIZE = int(os.environ.get("CLASSIFY_BATCH_SIZE", 20))
+# Batch prompts sent to the model at the same time
+CLASSIFY_BATCH_CONCURRENCY = int(os.environ.get("CLASSIFY_BATCH_CONCURRENCY", 4))
+
+DEFECT_TYPE_GUIDE = """- bubbles_voids: Air bubbles, voids, or trapped gas
+- delamination: Layer separation, peeling, adhesion failure
+- scratches: Surface scratches, marks, handling damage
+- haze: Cloudiness, reduced clarity, optical defects
+- orange_peel: Surface texture issues
+- fisheyes: Circular defects from contamination
+- gels_contamination: Foreign material, contamination"""
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def set_database(database):
+    """Set the database instance for the persistent response cache"""
+    global db
+    db = database
+
+
+async def ensure_cache_index():
+    """TTL index so MongoDB removes expired completions"""
+    if db is not None:
+        await db[CACHE_COLLECTION].create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
+
+def cache_key(function: str, system_message: str, prompt: str) -> str:
+    """Hash of the function, model and whitespace-normalized prompt"""
+    normalized = WHITESPACE.sub(" ", f"{system_message}\n{prompt}").strip()
+    digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+    return f"{function}:{MODEL_NAME}:{digest}"
+
+
+def parse_json_response(response: str) -> Any:
+    """Strip markdown code fences and parse; raises json.JSONDecodeError"""
+    response_text = response.strip()
+    if response_text.startswith("```json"):
+        response_text = response_text[7:]
+    if response_text.startswith("```"):
+        response_text = response_text[3:]
+    if response_text.endswith("```"):
+        response_text = response_text[:-3]
+    return json.loads(response_text.strip())
+
+
+def _cacheable(response: str, expects_json: bool) -> bool:
+    if not expects_json:
+        return bool(response)
+    try:
+        parse_json_response(response)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+
+def _chat(function: str, system_message: str) -> LlmChat:
+    return LlmChat(
+        api_key=EMERGENT_LLM_KEY,
+        session_id=f"{function}-{uuid.uuid4()}",
+        system_message=system_message
+    ).with_model(MODEL_PROVIDER, MODEL_NAME)
+
+
+async def _send(function: str, system_message: str, prompt: str) -> str:
+    chat = _chat(function, system_message)
+    return await gateway.call(function, lambda: chat.send_message(UserMessage(text=prompt)), timeout_for(function))
+
+
+def local_fallback(result: dict, error: Exception) -> dict:
+    """Label a rule-based answer from ai_service_mock as the fallback model"""
+    return {**result, "model": "fallback", "error": str(error)}
+
+
+async def _cached(key: str) -> Optional[str]:
+    """Cached response from memory, then the collection (counted as hits)"""
+    cached = response_cache.get(key)
+    if cached is not None:
+        cache_counters["memory_hits"] += 1
+        return cached
+    if db is not None:
+        doc = await db[CACHE_COLLECTION].find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}})
+        if doc:
+            cache_counters["db_hits"] += 1
+            response_cache.set(key, doc["response"])
+            return doc["response"]
+    return None
+
+
+async def _store(function: str, key: str, response: str, expects_json: bool):
+    if LLM_CACHE_TTL <= 0 or not _cacheable(response, expects_json):
+        return
+    response_cache.set(key, response)
+    if db is not None:
+        now = datetime.utcnow()
+        await db[CACHE_COLLECTION].replace_one(
+            {"_id": key},
+            {
+                "function": function,
+                "model": MODEL_NAME,
+                "response": response,
+                "created_date": now,
+                "expires_at": now + timedelta(seconds=LLM_CACHE_TTL),
+            },
+            upsert=True
+        )
+
+
+async def _fetch(function: str, system_message: str, prompt: str, key: str, expects_json: bool) -> str:
+    response = await _send(function, system_message, prompt)
+    await _store(function, key, response, expects_json)
+    return response
+
+
+def timeout_for(function: str) -> float:
+    return LLM_CALL_TIMEOUTS.get(function, LLM_CALL_TIMEOUT)
+
+
+def _settle(key: str, task: asyncio.Future):
+    """Forget a finished flight and count its outcome (also marks the exception retrieved)"""
+    if in_flight.get(key) is task:
+        del in_flight[key]
+    if task.cancelled():
+        return
+    if isinstance(task.exception(), asyncio.TimeoutError):
+        coalesce_counters["timeouts"] += 1
+    elif task.exception() is not None:
+        coalesce_counters["errors"] += 1
+
+
+async def _single_flight(key: str, function: str, factory: Callable[[], Awaitable[str]]) -> str:
+    """Run factory once per key; concurrent callers await the same task.
+
+    The gateway applies the function's deadline to the model call. Callers
+    await the task through asyncio.shield, so a client that disconnects
+    (cancelling its request) leaves the call running for everyone else and
+    for the cache.
+    """
+    task = in_flight.get(key)
+    if task is None:
+        coalesce_counters["leaders"] += 1
+        task = asyncio.ensure_future(factory())
+        in_flight[key] = task
+        task.add_done_callback(lambda done: _settle(key, done))
+    else:
+        coalesce_counters["followers"] += 1
+    return await asyncio.shield(task)
+
+
+async def _complete(function: str, system_message: str, prompt: str,
+                    expects_json: bool = True, use_cache: bool = True) -> str:
+    """Raw model response, served from the cache or a matching in-flight call when possible"""
+    key = cache_key(function, system_message, prompt)
+    if not use_cache or LLM_CACHE_TTL <= 0:
+        cache_counters["bypassed"] += 1
+    else:
+        cached = await _cached(key)
+        if cached is not None:
+            return cached
+        cache_counters["misses"] += 1
+
+    return await _single_flight(key, function, lambda: _fetch(function, system_message, prompt, key, expects_json))
+
+
+def fast_classification(description: str) -> Optional[dict]:
+    """Keyword-rule classification when it reaches CLASSIFY_FAST_PATH_THRESHOLD"""
+    local = defect_rules.classify(description)
+    if local is not None and local["confidence"] >= CLASSIFY_FAST_PATH_THRESHOLD:
+        fast_path_counters["rules"] += 1
+        return local
+    fast_path_counters["model"] += 1
+    return None
+
+
+def fast_path_stats() -> Dict[str, Any]:
+    total = fast_path_counters["rules"] + fast_path_counters["model"]
+    return {
+        **fast_path_counters,
+        "rules_rate": round(fast_path_counters["rules"] / total, 4) if total else None,
+        "threshold": CLASSIFY_FAST_PATH_THRESHOLD,
+        "keywords": len(defect_rules.classifier.keywords),
+    }
+
+
+def cache_stats() -> Dict[str, Any]:
+    hits = cache_counters["memory_hits"] + cache_counters["db_hits"]
+    lookups = hits + cache_counters["misses"]
+    return {
+        **cache_counters,
+        "hit_rate": round(hits / lookups, 4) if lookups else None,
+        "ttl_seconds": LLM_CACHE_TTL,
+        "memory": response_cache.stats(),
+    }
+
+
+def coalesce_stats() -> Dict[str, Any]:
+    calls = coalesce_counters["leaders"] + coalesce_counters["followers"]
+    return {
+        **coalesce_counters,
+        "in_flight": len(in_flight),
+        "coalesce_rate": round(coalesce_counters["followers"] / calls, 4) if calls else None,
+        "timeout_seconds": LLM_CALL_TIMEOUT,
+        "timeouts_by_function": LLM_CALL_TIMEOUTS,
+    }
+
+
+async def clear_cache(function: Optional[str] = None) -> int:
+    """Drop cached completions, all of them or one function's"""
+    response_cache.invalidate()
+    if db is None:
+        return 0
+    query = {"function": function} if function else {}
+    result = await db[CACHE_COLLECTION].delete_many(query)
+    return result.deleted_count
+
+
+async def get_rca_suggestions(defect_description: str, defect_type: str, severity: str, use_cache: bool = True) -> dict:
     """Generate AI-powered RCA suggestions based on defect data using GPT-5.2"""
     
     try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"rca-{uuid.uuid4()}",
-            system_message="""You are an expert Quality Engineer specializing in Root Cause Analysis (RCA) for manufacturing defects in window films and polymer processing.
+        system_message = """You are an expert Quality Engineer specializing in Root Cause Analysis (RCA) for manufacturing defects in window films and polymer processing.
 
 Your task is to analyze defect information and provide structured root cause suggestions.
 
@@ -32,7 +304,6 @@ Always respond in valid JSON format with this structure:
         "recommended_actions": ["action 1", "action 2", "action 3", "action 4"]
     }
 }"""
-        ).with_model("openai", "gpt-5.2")
         
         prompt = f"""Analyze this manufacturing defect and provide root cause suggestions:
 
@@ -45,21 +316,11 @@ Focus on: material issues, process parameters, equipment conditions, and environ
 
 Respond ONLY with valid JSON."""
 
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+        response = await _complete("rca", system_message, prompt, use_cache=use_cache)
         
         # Try to parse the JSON response
         try:
-            # Clean up response if needed
-            response_text = response.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            
-            result = json.loads(response_text.strip())
+            result = parse_json_response(response)
             result["model"] = "gpt-5.2"
             return result
         except json.JSONDecodeError:
@@ -84,6 +345,8 @@ Respond ONLY with valid JSON."""
                 },
                 "raw_response": response
             }
+    except (AIUnavailableError, asyncio.TimeoutError) as e:
+        return local_fallback(ai_service_mock.get_rca_suggestions(defect_description, defect_type, severity), e)
     except Exception as e:
         # Fallback to mock response if API fails
         return {
@@ -108,25 +371,21 @@ Respond ONLY with valid JSON."""
         }
 
 
-async def classify_defect(description: str, image_url: str = None) -> dict:
-    """AI-powered defect classification using GPT-5.2"""
+async def classify_defect(description: str, image_url: str = None, use_cache: bool = True,
+                          use_fast_path: bool = True) -> dict:
+    """AI-powered defect classification using GPT-5.2 (keyword rules first)"""
+    
+    local = fast_classification(description) if use_fast_path else None
+    if local is not None:
+        return local
     
     try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"classify-{uuid.uuid4()}",
-            system_message="""You are an expert Quality Inspector specializing in defect classification for window films and polymer products.
+        system_message = """You are an expert Quality Inspector specializing in defect classification for window films and polymer products.
 
 Your task is to classify defects based on descriptions.
 
 Common defect types in window film/polymer manufacturing:
-- bubbles_voids: Air bubbles, voids, or trapped gas
-- delamination: Layer separation, peeling, adhesion failure
-- scratches: Surface scratches, marks, handling damage
-- haze: Cloudiness, reduced clarity, optical defects
-- orange_peel: Surface texture issues
-- fisheyes: Circular defects from contamination
-- gels_contamination: Foreign material, contamination
+""" + DEFECT_TYPE_GUIDE + """
 
 Always respond in valid JSON format:
 {
@@ -135,7 +394,6 @@ Always respond in valid JSON format:
     "severity_suggestion": "minor|major|critical",
     "reasoning": "explanation"
 }"""
-        ).with_model("openai", "gpt-5.2")
         
         prompt = f"""Classify this manufacturing defect:
 
@@ -149,19 +407,10 @@ Based on the description, determine:
 
 Respond ONLY with valid JSON."""
 
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+        response = await _complete("classify", system_message, prompt, use_cache=use_cache)
         
         try:
-            response_text = response.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            
-            result = json.loads(response_text.strip())
+            result = parse_json_response(response)
             result["model"] = "gpt-5.2"
             return result
         except json.JSONDecodeError:
@@ -173,6 +422,8 @@ Respond ONLY with valid JSON."""
                 "model": "gpt-5.2",
                 "raw_response": response
             }
+    except (AIUnavailableError, asyncio.TimeoutError) as e:
+        return local_fallback(ai_service_mock.classify_defect(description, image_url), e)
     except Exception as e:
         return {
             "defect_type": "unknown",
@@ -183,14 +434,103 @@ Respond ONLY with valid JSON."""
         }
 
 
-async def generate_capa_actions(root_cause: str, defect_type: str) -> dict:
+BATCH_CLASSIFY_SYSTEM_MESSAGE = """You are an expert Quality Inspector specializing in defect classification for window films and polymer products.
+
+You will receive a numbered list of defect descriptions. Classify every one of them.
+
+Common defect types in window film/polymer manufacturing:
+""" + DEFECT_TYPE_GUIDE + """
+
+Always respond in valid JSON format, with one entry per input index:
+{
+    "results": [
+        {"index": 0, "defect_type": "type_name", "confidence": 0.85, "severity_suggestion": "minor|major|critical", "reasoning": "explanation"}
+    ]
+}"""
+
+
+def _batch_entries(response: str, size: int) -> Dict[int, dict]:
+    """Well-formed classifications by index from a batch response"""
+    try:
+        parsed = parse_json_response(response)
+    except json.JSONDecodeError:
+        return {}
+    entries = parsed.get("results") if isinstance(parsed, dict) else parsed
+    found = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict) or not isinstance(entry.get("defect_type"), str):
+            continue
+        index = entry.pop("index", None)
+        if isinstance(index, int) and 0 <= index < size and index not in found:
+            entry["model"] = MODEL_NAME
+            found[index] = entry
+    return found
+
+
+async def classify_defects_batch(descriptions: list, use_cache: bool = True, use_fast_path: bool = True) -> Dict[str, Any]:
+    """Classify many descriptions with CLASSIFY_BATCH_SIZE per prompt.
+
+    Identical descriptions are classified once, and those the keyword rules
+    settle never reach the model. Chunks run at most
+    CLASSIFY_BATCH_CONCURRENCY at a time; any item missing or malformed in
+    its chunk's answer is retried alone through classify_defect. Results
+    keep the input order.
+    """
+    unique = list(dict.fromkeys(descriptions))
+    classified: Dict[str, dict] = {}
+    if use_fast_path:
+        for text in unique:
+            local = fast_classification(text)
+            if local is not None:
+                classified[text] = local
+    remaining = [text for text in unique if text not in classified]
+    chunks = [remaining[i:i + CLASSIFY_BATCH_SIZE] for i in range(0, len(remaining), CLASSIFY_BATCH_SIZE)]
+    limit = asyncio.Semaphore(max(1, CLASSIFY_BATCH_CONCURRENCY))
+    retried = []
+
+    async def run_chunk(chunk: list):
+        listing = "\n".join(f"[{index}] {WHITESPACE.sub(' ', text).strip()}" for index, text in enumerate(chunk))
+        prompt = f"""Classify each of these {len(chunk)} manufacturing defects:
+
+{listing}
+
+For every index, determine the most likely defect type, your confidence (0.0-1.0),
+the suggested severity (minor, major, critical) and brief reasoning.
+
+Respond ONLY with valid JSON."""
+        async with limit:
+            try:
+                response = await _complete("classify_batch", BATCH_CLASSIFY_SYSTEM_MESSAGE, prompt, use_cache=use_cache)
+                entries = _batch_entries(response, len(chunk))
+            except Exception:
+                entries = {}
+        for index, text in enumerate(chunk):
+            if index in entries:
+                classified[text] = entries[index]
+        missing = [text for index, text in enumerate(chunk) if index not in entries]
+        retried.extend(missing)
+        await asyncio.gather(*(run_single(text) for text in missing))
+
+    async def run_single(text: str):
+        async with limit:
+            classified[text] = await classify_defect(text, use_cache=use_cache, use_fast_path=False)
+
+    await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+    return {
+        "results": [dict(classified[text]) for text in descriptions],
+        "count": len(descriptions),
+        "unique": len(unique),
+        "fast_path": len(unique) - len(remaining),
+        "chunks": len(chunks),
+        "individual_fallbacks": len(retried),
+    }
+
+
+async def generate_capa_actions(root_cause: str, defect_type: str, use_cache: bool = True) -> dict:
     """Generate CAPA actions based on root cause using GPT-5.2"""
     
     try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"capa-{uuid.uuid4()}",
-            system_message="""You are a Quality Engineering expert specializing in CAPA (Corrective and Preventive Action) planning for manufacturing.
+        system_message = """You are a Quality Engineering expert specializing in CAPA (Corrective and Preventive Action) planning for manufacturing.
 
 Your task is to generate specific, actionable CAPA plans based on identified root causes.
 
@@ -204,7 +544,6 @@ Always respond in valid JSON format:
     "suggested_owner": "team/role name",
     "estimated_completion": "timeframe"
 }"""
-        ).with_model("openai", "gpt-5.2")
         
         prompt = f"""Generate a CAPA plan for:
 
@@ -222,19 +561,10 @@ Provide:
 
 Respond ONLY with valid JSON."""
 
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+        response = await _complete("capa", system_message, prompt, use_cache=use_cache)
         
         try:
-            response_text = response.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            
-            result = json.loads(response_text.strip())
+            result = parse_json_response(response)
             result["model"] = "gpt-5.2"
             return result
         except json.JSONDecodeError:
@@ -258,6 +588,8 @@ Respond ONLY with valid JSON."""
                 "model": "gpt-5.2",
                 "raw_response": response
             }
+    except (AIUnavailableError, asyncio.TimeoutError) as e:
+        return local_fallback(ai_service_mock.generate_capa_actions(root_cause, defect_type), e)
     except Exception as e:
         return {
             "corrective_actions": [
@@ -281,14 +613,11 @@ Respond ONLY with valid JSON."""
         }
 
 
-async def predict_defect_trend(historical_defects: list) -> dict:
+async def predict_defect_trend(historical_defects: list, use_cache: bool = True) -> dict:
     """Predict future defect trends based on historical data using GPT-5.2"""
     
     try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"trend-{uuid.uuid4()}",
-            system_message="""You are a Quality Data Analyst expert in defect trend analysis and prediction.
+        system_message = """You are a Quality Data Analyst expert in defect trend analysis and prediction.
 
 Analyze defect patterns and provide trend predictions.
 
@@ -299,7 +628,6 @@ Always respond in valid JSON format:
     "confidence": 0.75,
     "recommended_actions": ["action 1", "action 2", "action 3"]
 }"""
-        ).with_model("openai", "gpt-5.2")
         
         defect_summary = json.dumps(historical_defects[:20]) if historical_defects else "No data available"
         
@@ -316,19 +644,10 @@ Provide:
 
 Respond ONLY with valid JSON."""
 
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+        response = await _complete("trend", system_message, prompt, use_cache=use_cache)
         
         try:
-            response_text = response.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            
-            result = json.loads(response_text.strip())
+            result = parse_json_response(response)
             result["model"] = "gpt-5.2"
             return result
         except json.JSONDecodeError:
@@ -344,6 +663,8 @@ Respond ONLY with valid JSON."""
                 ],
                 "model": "gpt-5.2"
             }
+    except (AIUnavailableError, asyncio.TimeoutError) as e:
+        return local_fallback(ai_service_mock.predict_defect_trend(historical_defects), e)
     except Exception as e:
         return {
             "trend": "insufficient_data",
@@ -357,14 +678,11 @@ Respond ONLY with valid JSON."""
         }
 
 
-async def search_knowledge_base(query: str, documents: list) -> dict:
+async def search_knowledge_base(query: str, documents: list, use_cache: bool = True) -> dict:
     """Semantic knowledge base search using GPT-5.2"""
     
     try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"search-{uuid.uuid4()}",
-            system_message="""You are a Quality Knowledge Base search assistant.
+        system_message = """You are a Quality Knowledge Base search assistant.
 
 Your task is to find the most relevant documents from a knowledge base based on the search query.
 
@@ -376,7 +694,6 @@ Return results in valid JSON format:
     "total_matches": 5,
     "search_time_ms": 45
 }"""
-        ).with_model("openai", "gpt-5.2")
         
         # Prepare document summaries for search
         doc_summaries = []
@@ -399,19 +716,10 @@ Return top 5 most relevant results with matched terms.
 
 Respond ONLY with valid JSON."""
 
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+        response = await _complete("search", system_message, prompt, use_cache=use_cache)
         
         try:
-            response_text = response.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            
-            result = json.loads(response_text.strip())
+            result = parse_json_response(response)
             result["model"] = "gpt-5.2"
             return result
         except json.JSONDecodeError:
@@ -459,11 +767,107 @@ Respond ONLY with valid JSON."""
         }
 
 
+def _invoke_system_message(response_json_schema: Optional[Dict[str, Any]]) -> str:
+    # Build system message based on whether JSON schema is expected
+    system_message = "You are a helpful AI assistant for quality management tasks."
+    if response_json_schema:
+        system_message += f"\n\nYou must respond in valid JSON format matching this schema:\n{json.dumps(response_json_schema, indent=2)}"
+    return system_message
+
+
+async def invoke_llm(prompt: str, response_json_schema: Optional[Dict[str, Any]] = None, use_cache: bool = True) -> Any:
+    """Free-form completion; parsed JSON when a response schema is given"""
+    
+    system_message = _invoke_system_message(response_json_schema)
+    try:
+        response = await _complete("invoke", system_message, prompt,
+                                   expects_json=bool(response_json_schema), use_cache=use_cache)
+    except (AIUnavailableError, asyncio.TimeoutError) as e:
+        # No local rules for free-form prompts
+        return {"error": str(e), "response": None, "model": "fallback"}
+    
+    # Try to parse as JSON if schema was provided
+    if response_json_schema:
+        try:
+            return parse_json_response(response)
+        except json.JSONDecodeError:
+            return {"response": response, "model": MODEL_NAME}
+    return {"response": response, "model": MODEL_NAME}
+
+
+def _chunk_text(chunk: Any) -> str:
+    return chunk if isinstance(chunk, str) else getattr(chunk, "text", None) or str(chunk)
+
+
+async def stream_llm(prompt: str, response_json_schema: Optional[Dict[str, Any]] = None,
+                     use_cache: bool = True) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """invoke_llm as (event, data) pairs: start, chunk..., then done or error.
+
+    Tokens are forwarded as the model produces them when the chat client
+    offers STREAM_METHOD; otherwise (and for cache hits) the whole answer
+    arrives as one chunk after the start event. done carries the full text,
+    plus `parsed` when a response schema was given.
+    """
+    system_message = _invoke_system_message(response_json_schema)
+    expects_json = bool(response_json_schema)
+    key = cache_key("invoke", system_message, prompt)
+    yield "start", {"model": MODEL_NAME}
+
+    try:
+        chat = _chat("invoke", system_message)
+        stream_method = getattr(chat, STREAM_METHOD, None)
+        cached = None
+        if use_cache and LLM_CACHE_TTL > 0:
+            cached = await _cached(key)
+            if cached is None:
+                cache_counters["misses"] += 1
+        else:
+            cache_counters["bypassed"] += 1
+
+        if cached is not None:
+            response = cached
+            yield "chunk", {"text": response}
+        elif stream_method is None:
+            response = await _single_flight(key, "invoke", lambda: _fetch("invoke", system_message, prompt, key, expects_json))
+            yield "chunk", {"text": response}
+        else:
+            parts = []
+            async for chunk in gateway.stream("invoke", lambda: stream_method(UserMessage(text=prompt)), timeout_for("invoke")):
+                text = _chunk_text(chunk)
+                parts.append(text)
+                yield "chunk", {"text": text}
+            response = "".join(parts)
+            await _store("invoke", key, response, expects_json)
+    except (AIUnavailableError, asyncio.TimeoutError) as e:
+        yield "error", {"error": str(e) or "AI call timed out", "model": "fallback"}
+        return
+    except Exception as e:
+        yield "error", {"error": str(e), "model": "error"}
+        return
+
+    done: Dict[str, Any] = {"response": response, "model": MODEL_NAME}
+    if response_json_schema:
+        try:
+            done["parsed"] = parse_json_response(response)
+        except json.JSONDecodeError:
+            done["parsed"] = None
+    yield "done", done
+
+
 # Export all functions
 __all__ = [
+    'set_database',
+    'ensure_cache_index',
+    'cache_stats',
+    'coalesce_stats',
+    'fast_path_stats',
+    'clear_cache',
     'get_rca_suggestions',
     'classify_defect',
+    'classify_defects_batch',
     'generate_capa_actions',
     'predict_defect_trend',
-    'search_knowledge_base'
+    'search_knowledge_base',
+    'invoke_llm',
+    'stream_llm'
 ]
@@ -0,0 +1,202 @@
+# Bulk Write Service for QualityStudio
+# Validates mixed insert/update/upsert/delete operations against the entity
+# model and executes them as chunked unordered bulk_write calls
+
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from bson import ObjectId
+from pydantic import BaseModel, ValidationError
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+from services.versioning import VERSION_FIELD
+
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 1000))
+MAX_BULK_OPERATIONS = int(os.environ.get("MAX_BULK_OPERATIONS", 50000))
+
+OPERATIONS = ("insert", "update", "upsert", "delete")
+
+# Fields the server manages; never accepted from callers
+SERVER_FIELDS = ("id", "_id", "created_date", "updated_date", VERSION_FIELD)
+
+
+class BulkOperationError(ValueError):
+    """A single operation is malformed or fails model validation"""
+
+
+def _object_id(value: Any) -> ObjectId:
+    try:
+        return ObjectId(value)
+    except Exception:
+        raise BulkOperationError(f"Invalid id: {value}")
+
+
+def _validate(model: Type[BaseModel], document: Any) -> BaseModel:
+    if not isinstance(document, dict):
+        raise BulkOperationError("document must be an object")
+    try:
+        return model.model_validate(document)
+    except ValidationError as e:
+        raise BulkOperationError(str(e))
+
+
+def _upsert_filter(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """Upsert keys must be plain equality matches, e.g. {"runId": "R-1001"}"""
+    if not isinstance(spec, dict) or not spec:
+        raise BulkOperationError("upsert needs an id or a non-empty filter")
+    for key, value in spec.items():
+        if key.startswith("$") or isinstance(value, dict):
+            raise BulkOperationError("upsert filter only supports field equality")
+    return spec
+
+
+def build_request(operation: Dict[str, Any], model: Type[BaseModel], now: datetime) -> Tuple[Any, Optional[ObjectId]]:
+    """Turn one API operation into a pymongo write model and the target _id (if known)"""
+    if not isinstance(operation, dict):
+        raise BulkOperationError("operation must be an object")
+    op = operation.get("op")
+    if op not in OPERATIONS:
+        raise BulkOperationError(f"Unknown op: {op}. Expected one of {', '.join(OPERATIONS)}")
+
+    if op == "delete":
+        item_id = _object_id(operation.get("id"))
+        return DeleteOne({"_id": item_id}), item_id
+
+    entity = _validate(model, operation.get("document"))
+    full = entity.model_dump(exclude=set(SERVER_FIELDS), exclude_none=False)
+
+    if op == "insert":
+        item_id = ObjectId()
+        document = {**full, "_id": item_id, "created_date": now, "updated_date": now, VERSION_FIELD: 1}
+        return InsertOne(document), item_id
+
+    # update/upsert only $set the fields the caller actually sent
+    changes = entity.model_dump(exclude=set(SERVER_FIELDS), exclude_unset=True)
+    changes["updated_date"] = now
+    update = {"$set": changes, "$inc": {VERSION_FIELD: 1}}
+
+    if op == "update":
+        item_id = _object_id(operation.get("id"))
+        return UpdateOne({"_id": item_id}, update), item_id
+
+    if operation.get("id") is not None:
+        item_id = _object_id(operation["id"])
+        query = {"_id": item_id}
+    else:
+        item_id = None
+        query = _upsert_filter(operation.get("filter"))
+    defaults = {key: value for key, value in full.items() if key not in changes and key not in query}
+    update["$setOnInsert"] = {**defaults, "created_date": now}
+    return UpdateOne(query, update, upsert=True), item_id
+
+
+async def _existing_ids(collection, ids: List[ObjectId]) -> set:
+    if not ids:
+        return set()
+    docs = await collection.find({"_id": {"$in": ids}}, {"_id": 1}).to_list(length=None)
+    return {doc["_id"] for doc in docs}
+
+
+async def _resolve_matched(collection, pending: List[Tuple[Dict[str, Any], Dict[str, Any]]]):
+    """Fill in the _id of filter upserts that updated an existing document
+
+    bulk_write only reports the ids of inserted upserts. A filter matching
+    exactly one document identifies it; otherwise (several matches, array
+    values) the id stays None and the caller invalidates the whole collection.
+    """
+    if not pending:
+        return
+    fields = {key for query, _ in pending for key in query}
+    docs = await collection.find(
+        {"$or": [query for query, _ in pending]}, {field: 1 for field in fields}
+    ).to_list(length=None)
+    # Index the matched documents once per distinct set of filter keys
+    by_keys: Dict[Tuple[str, ...], Dict[Tuple, List[ObjectId]]] = {}
+    for query, _ in pending:
+        by_keys.setdefault(tuple(sorted(query)), {})
+    for keys, index in by_keys.items():
+        for doc in docs:
+            values = tuple(doc.get(key) for key in keys)
+            if all(value.__hash__ is not None for value in values):
+                index.setdefault(values, []).append(doc["_id"])
+
+    for query, entry in pending:
+        keys = tuple(sorted(query))
+        values = tuple(query[key] for key in keys)
+        if any(isinstance(value, list) for value in values):
+            continue
+        matched = by_keys[keys].get(values, [])
+        if len(matched) == 1:
+            entry["id"] = str(matched[0])
+
+
+async def _run_chunk(collection, chunk: List[Tuple[int, Dict[str, Any]]], model, results: List[Dict[str, Any]]):
+    now = datetime.utcnow()
+    built, operation_filters = [], {}
+    for index, operation in chunk:
+        try:
+            request, item_id = build_request(operation, model, now)
+            built.append((index, operation["op"], request, item_id))
+            if operation["op"] == "upsert" and item_id is None:
+                operation_filters[index] = operation["filter"]
+        except BulkOperationError as e:
+            op = operation.get("op") if isinstance(operation, dict) else None
+            results[index] = {"index": index, "op": op, "status": "invalid", "error": str(e)}
+
+    # bulk_write only reports aggregate counts, so check update/delete
+    # targets up front to give each operation its own not_found status
+    targeted = [item_id for _, op, _, item_id in built if op in ("update", "delete")]
+    existing = await _existing_ids(collection, targeted)
+
+    requests, positions, filter_upserts = [], [], []
+    for index, op, request, item_id in built:
+        if op in ("update", "delete") and item_id not in existing:
+            results[index] = {"index": index, "op": op, "status": "not_found", "id": str(item_id)}
+            continue
+        results[index] = {"index": index, "op": op, "status": "ok", "id": str(item_id) if item_id else None}
+        requests.append(request)
+        positions.append(index)
+        if index in operation_filters:
+            filter_upserts.append((operation_filters[index], results[index]))
+
+    if not requests:
+        return
+
+    try:
+        outcome = await collection.bulk_write(requests, ordered=False)
+        upserted = outcome.upserted_ids or {}
+        write_errors = []
+    except BulkWriteError as e:
+        upserted = {item["index"]: item["_id"] for item in e.details.get("upserted", [])}
+        write_errors = e.details.get("writeErrors", [])
+
+    for request_index, upserted_id in upserted.items():
+        entry = results[positions[request_index]]
+        entry["id"] = str(upserted_id)
+        entry["upserted"] = True
+    for error in write_errors:
+        entry = results[positions[error["index"]]]
+        entry["status"] = "error"
+        entry["error"] = error.get("errmsg", "Write failed")
+
+    await _resolve_matched(collection, [
+        (query, entry) for query, entry in filter_upserts if entry["status"] == "ok" and entry["id"] is None
+    ])
+
+
+async def run_bulk(collection, operations: List[Dict[str, Any]], model: Type[BaseModel]) -> Dict[str, Any]:
+    """Execute operations in chunks of BULK_CHUNK_SIZE and report per-operation status"""
+    if len(operations) > MAX_BULK_OPERATIONS:
+        raise BulkOperationError(f"At most {MAX_BULK_OPERATIONS} operations per request")
+
+    results: List[Dict[str, Any]] = [None] * len(operations)
+    indexed = list(enumerate(operations))
+    for start in range(0, len(indexed), BULK_CHUNK_SIZE):
+        await _run_chunk(collection, indexed[start:start + BULK_CHUNK_SIZE], model, results)
+
+    summary: Dict[str, int] = {}
+    for entry in results:
+        summary[entry["status"]] = summary.get(entry["status"], 0) + 1
+    return {"results": results, "summary": summary}
@@ -0,0 +1,303 @@
+# Cache Service for QualityStudio
+# Small in-process caches for hot read paths, invalidated by the write path,
+# plus an invalidation bus that carries write notices between workers
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Dictionary cache whose entries expire after ttl_seconds"""
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[Hashable, Tuple[float, Any]] = {}
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Drop one key, or everything when key is None"""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+class LRUCache:
+    """Bounded LRU cache with per-entry TTL and hit/miss counters.
+
+    Readers take a token() before loading from the database and store with
+    set(..., token=...); if an invalidation happened in between the value is
+    dropped, so a slow read cannot re-insert a document a write just replaced.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def token(self) -> int:
+        return self._epoch
+
+    def set(self, key: Hashable, value: Any, token: Optional[int] = None):
+        if self.max_entries <= 0 or (token is not None and token != self._epoch):
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Drop one key, or everything when key is None"""
+        self._epoch += 1
+        self.invalidations += 1
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+def parse_ttls(spec: str) -> Dict[str, float]:
+    """'kpis=300,process_runs=30' -> {"kpis": 300.0, "process_runs": 30.0}"""
+    ttls = {}
+    for part in (spec or "").split(","):
+        if not part.strip():
+            continue
+        name, _, seconds = part.partition("=")
+        ttls[name.strip()] = float(seconds)
+    return ttls
+
+
+class ResultCache:
+    """Query results (serialized) grouped by collection, bounded by total bytes.
+
+    Every entry carries the collection generation it was computed at. Seeing
+    a newer generation drops the collection's older entries, so any write to
+    a collection invalidates its results on every worker that reads the
+    shared counter. Least recently used entries are evicted once max_bytes
+    is exceeded.
+    """
+
+    def __init__(self, max_bytes: int, default_ttl: float, ttls: Optional[Dict[str, float]] = None):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[float, int, Any, int]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl_for(self, collection_name: str) -> float:
+        return self.ttls.get(collection_name, self.default_ttl)
+
+    def _observe(self, collection_name: str, generation: int) -> bool:
+        """Track the newest generation; False if the caller's is already outdated"""
+        seen = self._generations.get(collection_name, -1)
+        if generation > seen:
+            if seen >= 0:
+                self.invalidate_collection(collection_name)
+            self._generations[collection_name] = generation
+        return generation >= seen
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[3]
+
+    def get(self, collection_name: str, generation: int, key: Hashable) -> Optional[Any]:
+        if not self._observe(collection_name, generation):
+            self.misses += 1
+            return None
+        full_key = (collection_name, key)
+        entry = self._entries.get(full_key)
+        if entry is None or entry[0] < time.monotonic() or entry[1] != generation:
+            if entry is not None:
+                self._drop(full_key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(full_key)
+        self.hits += 1
+        return entry[2]
+
+    def set(self, collection_name: str, generation: int, key: Hashable, value: Any, size: int):
+        ttl = self.ttl_for(collection_name)
+        if ttl <= 0 or size > self.max_bytes or not self._observe(collection_name, generation):
+            return
+        full_key = (collection_name, key)
+        self._drop(full_key)
+        self._entries[full_key] = (time.monotonic() + ttl, generation, value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def invalidate_collection(self, collection_name: str):
+        for key in [key for key in self._entries if key[0] == collection_name]:
+            self._drop(key)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "default_ttl": self.default_ttl,
+            "ttls": self.ttls,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+        }
+
+
+InvalidationHandler = Callable[[str, Optional[List[str]]], None]
+
+
+class LocalInvalidationBus:
+    """Delivers write notices to handlers in this process only (single worker)"""
+
+    def __init__(self):
+        self._handlers: List[InvalidationHandler] = []
+
+    def subscribe(self, handler: InvalidationHandler):
+        self._handlers.append(handler)
+
+    def _deliver(self, collection_name: str, item_ids: Optional[List[str]]):
+        for handler in self._handlers:
+            try:
+                handler(collection_name, item_ids)
+            except Exception as e:
+                logger.error(f"Invalidation handler failed: {str(e)}")
+
+    async def publish(self, collection_name: str, item_ids: Optional[List[str]] = None):
+        self._deliver(collection_name, item_ids)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class MongoInvalidationBus(LocalInvalidationBus):
+    """Shares write notices between uvicorn workers through a capped collection.
+
+    publish() applies the notice locally right away and appends it to the
+    capped collection; every worker tails that collection and applies notices
+    that came from other workers. Entry TTLs bound staleness if a notice is
+    missed while a worker reconnects.
+    """
+
+    def __init__(self, db, collection_name: str = "cache_invalidations", size_bytes: int = 1024 * 1024):
+        super().__init__()
+        self.db = db
+        self.collection_name = collection_name
+        self.size_bytes = size_bytes
+        self.origin = uuid.uuid4().hex
+        self._task: Optional[asyncio.Task] = None
+
+    async def publish(self, collection_name: str, item_ids: Optional[List[str]] = None):
+        self._deliver(collection_name, item_ids)
+        try:
+            await self.db[self.collection_name].insert_one({
+                "origin": self.origin,
+                "collection": collection_name,
+                "ids": item_ids,
+            })
+        except Exception as e:
+            logger.error(f"Could not publish cache invalidation: {str(e)}")
+
+    async def start(self):
+        try:
+            await self.db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+        except CollectionInvalid:
+            pass
+        # Start after the newest notice so a restarting worker does not replay history
+        newest = await self.db[self.collection_name].find_one(sort=[("$natural", -1)])
+        self._task = asyncio.create_task(self._listen(newest["_id"] if newest else None))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _listen(self, last_id):
+        collection = self.db[self.collection_name]
+        while True:
+            try:
+                query = {"_id": {"$gt": last_id}} if last_id else {}
+                cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for notice in cursor:
+                        last_id = notice["_id"]
+                        if notice.get("origin") != self.origin:
+                            self._deliver(notice["collection"], notice.get("ids"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener error: {str(e)}")
+            # A tailable cursor on an empty capped collection dies immediately
+            await asyncio.sleep(1)
+
+
+def create_invalidation_bus(db, kind: Optional[str] = None) -> LocalInvalidationBus:
+    """CACHE_INVALIDATION_BUS=mongo when running more than one worker; local otherwise"""
+    kind = (kind or os.environ.get("CACHE_INVALIDATION_BUS", "local")).lower()
+    if kind == "mongo":
+        return MongoInvalidationBus(db)
+    if kind != "local":
+        raise ValueError(f"Unknown CACHE_INVALIDATION_BUS: {kind}")
+    return LocalInvalidationBus()
@@ -0,0 +1,192 @@
+# Change Stream Service for QualityStudio
+# Watches MongoDB change streams on the core quality collections and pushes
+# compact deltas to WebSocket rooms, so clients no longer need to poll
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from services.json_codec import to_jsonable
+from services.projection import SUMMARY_FIELDS, COMMON_FIELDS
+from services.websocket_service import (
+    manager, notify_critical_defect, notify_defect_created,
+    notify_complaint_created, notify_kpi_update
+)
+
+logger = logging.getLogger(__name__)
+
+WATCHED_COLLECTIONS = ("defect_tickets", "customer_complaints", "rca_records", "capa_plans", "kpis")
+
+STATE_COLLECTION = "change_stream_state"
+STREAM_NAME = "entity_changes"
+
+# Seconds between resume token saves; on restart at most this much is replayed
+RESUME_TOKEN_SAVE_INTERVAL = float(os.environ.get("RESUME_TOKEN_SAVE_INTERVAL", 2))
+# Resume tokens are stored per instance so workers do not overwrite each
+# other's position. Defaults to the host name; give each process its own
+# value when one host runs several workers
+CHANGE_STREAM_INSTANCE = os.environ.get("CHANGE_STREAM_INSTANCE") or socket.gethostname()
+# Retry delay after a failure doubles up to this many seconds
+CHANGE_STREAM_MAX_BACKOFF = float(os.environ.get("CHANGE_STREAM_MAX_BACKOFF", 300))
+CHANGE_STREAM_RETRY_DELAY = 5
+
+# Server error codes: not a replica set / resume point no longer in the oplog
+CHANGE_STREAMS_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+def room_for(collection_name: str) -> str:
+    """WebSocket room a client subscribes to for deltas of one collection"""
+    return f"entity:{collection_name}"
+
+
+def build_delta(change: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Compact message for one change event: changed fields only for updates,
+    summary fields for inserts/replaces, just the id for deletes"""
+    operation = change.get("operationType")
+    if operation not in ("insert", "update", "replace", "delete"):
+        return None
+    collection_name = change["ns"]["coll"]
+    delta = {
+        "type": "entity_change",
+        "collection": collection_name,
+        "operation": operation,
+        "id": str(change["documentKey"]["_id"]),
+        "timestamp": datetime.utcnow().isoformat(),
+    }
+    if operation == "update":
+        description = change.get("updateDescription", {})
+        delta["changes"] = description.get("updatedFields", {})
+        if description.get("removedFields"):
+            delta["removed"] = description["removedFields"]
+    elif operation in ("insert", "replace"):
+        document = change.get("fullDocument") or {}
+        fields = set(SUMMARY_FIELDS.get(collection_name, [])) | set(COMMON_FIELDS)
+        delta["document"] = {key: value for key, value in document.items() if key in fields}
+    return to_jsonable(delta)
+
+
+async def _notify_created(collection_name: str, document: Dict[str, Any]):
+    """Existing user-facing notifications for newly created records"""
+    data = {**to_jsonable({k: v for k, v in document.items() if k != "_id"}), "id": str(document["_id"])}
+    if collection_name == "defect_tickets":
+        if data.get("severity") == "critical":
+            await notify_critical_defect(data)
+        else:
+            await notify_defect_created(data)
+    elif collection_name == "customer_complaints":
+        await notify_complaint_created(data)
+    elif collection_name == "kpis":
+        await notify_kpi_update(data)
+
+
+class ChangeStreamWatcher:
+    """Background task that fans change events out to this worker's WebSocket clients.
+
+    Each uvicorn worker runs its own watcher because each holds its own
+    connections. The resume token is persisted under the instance id, so a
+    restart continues from the last delivered event instead of dropping what
+    happened meanwhile. Workers sharing an instance id (several workers on
+    one host without CHANGE_STREAM_INSTANCE) share one token and resume
+    from whichever saved last.
+    """
+
+    def __init__(self, db, instance: str = CHANGE_STREAM_INSTANCE):
+        self.db = db
+        self.state_id = f"{STREAM_NAME}:{instance}"
+        self._task: Optional[asyncio.Task] = None
+        self._token = None
+        self._saved_at = 0.0
+        self.events = 0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._save_token(force=True)
+
+    async def _load_token(self):
+        state = await self.db[STATE_COLLECTION].find_one({"_id": self.state_id})
+        return state.get("resume_token") if state else None
+
+    async def _save_token(self, force: bool = False):
+        if self._token is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._saved_at < RESUME_TOKEN_SAVE_INTERVAL:
+            return
+        self._saved_at = now
+        try:
+            await self.db[STATE_COLLECTION].update_one(
+                {"_id": self.state_id},
+                {"$set": {"resume_token": self._token, "updated_date": datetime.utcnow()}},
+                upsert=True
+            )
+        except PyMongoError as e:
+            logger.warning(f"Could not save change stream resume token: {str(e)}")
+
+    async def _run(self):
+        try:
+            self._token = await self._load_token()
+        except PyMongoError as e:
+            logger.warning(f"Could not load change stream resume token: {str(e)}")
+        pipeline = [{"$match": {"ns.coll": {"$in": list(WATCHED_COLLECTIONS)}}}]
+        delay = CHANGE_STREAM_RETRY_DELAY
+        last_error = None
+        while True:
+            try:
+                async with self.db.watch(pipeline, resume_after=self._token) as stream:
+                    logger.info("Change stream watcher started")
+                    async for change in stream:
+                        await self._dispatch(change)
+                        self._token = stream.resume_token
+                        await self._save_token()
+                        delay, last_error = CHANGE_STREAM_RETRY_DELAY, None
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    logger.warning("Change streams need a replica set; real-time deltas are disabled")
+                    return
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    logger.warning("Change stream resume point expired; continuing from now")
+                    self._token = None
+                    continue
+                last_error = self._log_failure(e, last_error, delay)
+            except PyMongoError as e:
+                last_error = self._log_failure(e, last_error, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, CHANGE_STREAM_MAX_BACKOFF)
+
+    def _log_failure(self, error: PyMongoError, last_error: Optional[str], delay: float) -> str:
+        """Log a failure once; identical repeats while backing off only at debug level"""
+        message = str(error)
+        if message != last_error:
+            logger.error(f"Change stream failed, retrying in {delay:.0f}s: {message}")
+        else:
+            logger.debug(f"Change stream still failing, retrying in {delay:.0f}s")
+        return message
+
+    async def _dispatch(self, change: Dict[str, Any]):
+        delta = build_delta(change)
+        if delta is None:
+            return
+        self.events += 1
+        try:
+            await manager.broadcast_to_room(room_for(delta["collection"]), delta)
+            if change["operationType"] == "insert":
+                await _notify_created(delta["collection"], change["fullDocument"])
+        except Exception as e:
+            logger.error(f"Change delta delivery failed: {str(e)}")
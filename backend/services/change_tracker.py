@@ -0,0 +1,40 @@
+# Change Tracker for QualityStudio
+# Per-collection change counters stored in MongoDB so every worker sees the
+# same value; list/filter ETags are derived from them
+
+import hashlib
+from typing import Any
+
+import orjson
+
+db = None
+
+COUNTERS_COLLECTION = "collection_versions"
+
+
+def set_database(database):
+    """Set the database instance for the change tracker"""
+    global db
+    db = database
+
+
+async def current_version(collection_name: str) -> int:
+    """Change counter for a collection (0 if it was never written through the API)"""
+    doc = await db[COUNTERS_COLLECTION].find_one({"_id": collection_name})
+    return doc["counter"] if doc else 0
+
+
+async def bump_version(collection_name: str):
+    """Advance the counter; must run after the data write has completed"""
+    await db[COUNTERS_COLLECTION].update_one(
+        {"_id": collection_name},
+        {"$inc": {"counter": 1}},
+        upsert=True
+    )
+
+
+def query_etag(collection_name: str, version: int, *query_parts: Any) -> str:
+    """Strong ETag for a query result: collection counter plus a digest of the query"""
+    digest = hashlib.sha1(orjson.dumps([collection_name, *query_parts], option=orjson.OPT_SORT_KEYS, default=str))
+    return f'"{version}-{digest.hexdigest()[:16]}"'
+
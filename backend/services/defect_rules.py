@@ -0,0 +1,155 @@
+# Defect Keyword Rules for QualityStudio
+# Editable keyword rules per defect type compiled into a single regular
+# expression, so a description is scanned once no matter how many rules
+# exist. classify_defect answers from here when the match is confident and
+# only asks the LLM otherwise.
+#
+# Rule set shape: {defect_type: {keyword: weight}}. A keyword matches at a
+# word start and may be followed by more letters ("delaminat" also matches
+# "delamination"); spaces match any whitespace. Weights of the distinct
+# keywords found for a type combine as 1 - prod(1 - weight). Half of the
+# runner-up's score is subtracted, so descriptions that fit two types stay
+# below the threshold.
+
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RULES_COLLECTION = "defect_rules"
+RULES_DOCUMENT_ID = "current"
+
+MAX_CONFIDENCE = 0.99
+RUNNER_UP_PENALTY = 0.5
+
+DEFAULT_RULES: Dict[str, Dict[str, float]] = {
+    "bubbles_voids": {"bubble": 0.9, "void": 0.88, "blister": 0.85, "air pocket": 0.9, "trapped air": 0.9, "pinhole": 0.7},
+    "delamination": {"delaminat": 0.92, "peel": 0.85, "layer separation": 0.9, "lifting": 0.7, "adhesion fail": 0.88},
+    "scratches": {"scratch": 0.93, "scuff": 0.85, "abrasion": 0.85, "gouge": 0.8, "mark": 0.6},
+    "haze": {"haze": 0.91, "hazy": 0.91, "cloudiness": 0.82, "cloudy": 0.82, "milky": 0.8, "foggy": 0.75},
+    "orange_peel": {"orange peel": 0.95, "orange-peel": 0.95, "dimpled surface": 0.75, "uneven texture": 0.6},
+    "fisheyes": {"fisheye": 0.9, "fish eye": 0.9, "crater": 0.7},
+    "gels_contamination": {"gel": 0.87, "contaminat": 0.85, "foreign particle": 0.88, "foreign material": 0.88, "inclusion": 0.75, "speck": 0.7},
+}
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class InvalidRulesError(ValueError):
+    """Raised when an edited rule set is malformed"""
+
+
+def _normalize(keyword: str) -> str:
+    return WHITESPACE.sub(" ", keyword.strip().lower())
+
+
+def validate_rules(rules: Any) -> Dict[str, Dict[str, float]]:
+    """Normalized copy of a rule set; raises InvalidRulesError"""
+    if not isinstance(rules, dict) or not rules:
+        raise InvalidRulesError("Rules must map defect types to {keyword: weight}")
+    validated: Dict[str, Dict[str, float]] = {}
+    owners: Dict[str, str] = {}
+    for defect_type, keywords in rules.items():
+        if not isinstance(keywords, dict) or not keywords:
+            raise InvalidRulesError(f"{defect_type}: expected a non-empty {{keyword: weight}} object")
+        validated[defect_type] = {}
+        for keyword, weight in keywords.items():
+            normalized = _normalize(str(keyword))
+            if not normalized:
+                raise InvalidRulesError(f"{defect_type}: empty keyword")
+            if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not 0 < weight < 1:
+                raise InvalidRulesError(f"{defect_type}.{keyword}: weight must be between 0 and 1")
+            if owners.setdefault(normalized, defect_type) != defect_type:
+                raise InvalidRulesError(f"Keyword '{normalized}' is used by {owners[normalized]} and {defect_type}")
+            validated[defect_type][normalized] = float(weight)
+    return validated
+
+
+class KeywordClassifier:
+    """All keywords of a rule set compiled into one alternation"""
+
+    def __init__(self, rules: Dict[str, Dict[str, float]]):
+        self.rules = validate_rules(rules)
+        self.keywords: Dict[str, Tuple[str, float]] = {
+            keyword: (defect_type, weight)
+            for defect_type, keywords in self.rules.items()
+            for keyword, weight in keywords.items()
+        }
+        # Longest first, so "orange peel" wins over "peel" at the same position
+        self.alternatives = sorted(self.keywords, key=len, reverse=True)
+        # One group per keyword: a match is mapped back by group number, since
+        # case-insensitive matches do not always lower() to the keyword ("İnclusion")
+        self.pattern = re.compile(
+            r"\b(?:" + "|".join(
+                "(" + re.escape(keyword).replace(r"\ ", r"\s+") + ")" for keyword in self.alternatives
+            ) + r")\w*",
+            re.IGNORECASE
+        )
+
+    def classify(self, description: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Best local classification, or None when no keyword matches"""
+        if not description:
+            return None
+        matched: Dict[str, Dict[str, float]] = {}
+        for match in self.pattern.finditer(description):
+            keyword = self.alternatives[match.lastindex - 1]
+            defect_type, weight = self.keywords[keyword]
+            matched.setdefault(defect_type, {})[keyword] = weight
+        if not matched:
+            return None
+
+        scores: List[Tuple[float, str]] = []
+        for defect_type, found in matched.items():
+            miss = 1.0
+            for weight in found.values():
+                miss *= 1 - weight
+            scores.append((1 - miss, defect_type))
+        scores.sort(reverse=True)
+        best, defect_type = scores[0]
+        runner_up = scores[1][0] if len(scores) > 1 else 0.0
+        confidence = round(min(MAX_CONFIDENCE, max(0.0, best - RUNNER_UP_PENALTY * runner_up)), 4)
+        keywords = sorted(matched[defect_type])
+        return {
+            "defect_type": defect_type,
+            "confidence": confidence,
+            "severity_suggestion": "major" if confidence > 0.85 else "minor",
+            "reasoning": f"Keyword rules matched: {', '.join(keywords)}",
+            "matched_terms": keywords,
+            "model": "rules",
+        }
+
+
+classifier = KeywordClassifier(DEFAULT_RULES)
+
+
+async def load_rules(db) -> Dict[str, Dict[str, float]]:
+    """Compile the stored rule set (or the defaults) into the module classifier"""
+    global classifier
+    doc = await db[RULES_COLLECTION].find_one({"_id": RULES_DOCUMENT_ID})
+    try:
+        classifier = KeywordClassifier(doc["rules"] if doc else DEFAULT_RULES)
+    except InvalidRulesError as e:
+        logger.error(f"Stored defect rules are invalid, using defaults: {str(e)}")
+        classifier = KeywordClassifier(DEFAULT_RULES)
+    return classifier.rules
+
+
+async def save_rules(db, rules: Any) -> Dict[str, Dict[str, float]]:
+    """Validate, store and compile an edited rule set"""
+    global classifier
+    compiled = KeywordClassifier(rules)
+    await db[RULES_COLLECTION].replace_one({"_id": RULES_DOCUMENT_ID}, {"rules": compiled.rules}, upsert=True)
+    classifier = compiled
+    return compiled.rules
+
+
+async def reset_rules(db) -> Dict[str, Dict[str, float]]:
+    global classifier
+    await db[RULES_COLLECTION].delete_one({"_id": RULES_DOCUMENT_ID})
+    classifier = KeywordClassifier(DEFAULT_RULES)
+    return classifier.rules
+
+
+def classify(description: Optional[str]) -> Optional[Dict[str, Any]]:
+    return classifier.classify(description)
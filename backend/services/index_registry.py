@@ -0,0 +1,183 @@
+# Index Registry for QualityStudio
+# Declares the indexes each entity collection needs, creates them at startup
+# and tracks query shapes that no declared index serves
+
+import logging
+from collections import Counter, deque
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Every list/filter query sorts on (sort key, _id), so the default
+# created_date ordering gets its own keyset index on every collection.
+CREATED_DATE = [("created_date", -1), ("_id", -1)]
+
+# collection -> list of index key specifications
+ENTITY_INDEXES: Dict[str, List[List[Tuple[str, int]]]] = {
+    "customer_complaints": [
+        CREATED_DATE,
+        [("status", 1), ("created_date", -1)],
+        [("severity", 1), ("created_date", -1)],
+        [("customerName", 1), ("created_date", -1)],
+        [("ticketNumber", 1)],
+    ],
+    "defect_tickets": [
+        CREATED_DATE,
+        [("status", 1), ("created_date", -1)],
+        [("line", 1), ("dateTime", -1)],
+        [("defectType", 1), ("created_date", -1)],
+        [("severity", 1), ("created_date", -1)],
+        [("linkedComplaintId", 1)],
+        [("ticketId", 1)],
+    ],
+    "rca_records": [
+        CREATED_DATE,
+        [("defectTicketId", 1)],
+        [("status", 1), ("created_date", -1)],
+    ],
+    "capa_plans": [
+        CREATED_DATE,
+        [("defectTicketId", 1)],
+        [("rcaRecordId", 1)],
+        [("approvalState", 1), ("created_date", -1)],
+    ],
+    "process_runs": [
+        CREATED_DATE,
+        [("dateTimeStart", -1), ("_id", -1)],
+        [("line", 1), ("dateTimeStart", -1)],
+        [("runId", 1)],
+    ],
+    "golden_batches": [
+        CREATED_DATE,
+        [("line", 1), ("materialType", 1)],
+        [("isActive", 1)],
+    ],
+    "sops": [
+        CREATED_DATE,
+        [("sopNumber", 1)],
+        [("status", 1), ("created_date", -1)],
+    ],
+    "does": [
+        CREATED_DATE,
+        [("status", 1), ("created_date", -1)],
+    ],
+    "knowledge_documents": [
+        CREATED_DATE,
+        [("category", 1), ("created_date", -1)],
+        [("tags", 1)],
+    ],
+    "equipment": [
+        CREATED_DATE,
+        [("equipmentId", 1)],
+        [("line", 1), ("status", 1)],
+    ],
+    "file_upload_history": [
+        CREATED_DATE,
+    ],
+    "kpis": [
+        CREATED_DATE,
+        [("recordDate", -1), ("_id", -1)],
+    ],
+    # Derived by services/kpi_rollup_service.py
+    "kpi_rollups": [
+        [("period", 1), ("dimension", 1), ("periodStart", 1), ("key", 1)],
+    ],
+}
+
+
+def index_name(keys: List[Tuple[str, int]]) -> str:
+    """Deterministic index name, matching MongoDB's default naming"""
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+async def ensure_indexes(db) -> Dict[str, List[str]]:
+    """Create all declared indexes. Safe to run on every startup."""
+    created = {}
+    for collection_name, specs in ENTITY_INDEXES.items():
+        models = [IndexModel(keys, name=index_name(keys)) for keys in specs]
+        try:
+            created[collection_name] = await db[collection_name].create_indexes(models)
+        except OperationFailure as e:
+            # An index with the same name but different options already exists;
+            # leave it for an operator rather than dropping data structures at boot
+            logger.warning(f"Index creation failed for {collection_name}: {e}")
+            created[collection_name] = []
+    return created
+
+
+class QueryShapeTracker:
+    """Remembers recent query shapes and flags those no declared index serves"""
+
+    def __init__(self, max_recent: int = 500):
+        self.recent: deque = deque(maxlen=max_recent)
+        self.uncovered: Counter = Counter()
+
+    @staticmethod
+    def filter_fields(filters: Dict[str, Any]) -> Tuple[str, ...]:
+        """Top-level field names of a filter, looking through $and"""
+        fields = set()
+        for key, value in (filters or {}).items():
+            if key == "$and" and isinstance(value, list):
+                for clause in value:
+                    fields.update(QueryShapeTracker.filter_fields(clause))
+            elif not key.startswith("$"):
+                fields.add(key)
+        return tuple(sorted(fields))
+
+    @staticmethod
+    def is_covered(collection_name: str, fields: Tuple[str, ...], sort_field: str) -> bool:
+        """True if some declared index has the filter fields as its key prefix.
+
+        With no filter fields, the sort key must lead an index instead.
+        """
+        for keys in ENTITY_INDEXES.get(collection_name, []) + [[("_id", 1)]]:
+            key_fields = [field for field, _ in keys]
+            if fields:
+                if set(key_fields[:len(fields)]) == set(fields):
+                    return True
+            elif key_fields[0] == sort_field:
+                return True
+        return False
+
+    def record(self, collection_name: str, filters: Dict[str, Any], sort_field: str):
+        fields = self.filter_fields(filters)
+        covered = self.is_covered(collection_name, fields, sort_field)
+        self.recent.append({
+            "collection": collection_name,
+            "filter_fields": list(fields),
+            "sort": sort_field,
+            "covered": covered,
+            "timestamp": datetime.utcnow().isoformat(),
+        })
+        if not covered:
+            self.uncovered[(collection_name, fields, sort_field)] += 1
+
+    def uncovered_report(self) -> List[Dict[str, Any]]:
+        return [
+            {"collection": coll, "filter_fields": list(fields), "sort": sort, "count": count}
+            for (coll, fields, sort), count in self.uncovered.most_common()
+        ]
+
+
+async def index_usage_report(db) -> Dict[str, Any]:
+    """$indexStats for every registered collection"""
+    report = {}
+    for collection_name in ENTITY_INDEXES:
+        stats = await db[collection_name].aggregate([{"$indexStats": {}}]).to_list(length=None)
+        report[collection_name] = [
+            {
+                "name": stat["name"],
+                "key": dict(stat["key"]),
+                "ops": stat.get("accesses", {}).get("ops", 0),
+                "since": stat.get("accesses", {}).get("since"),
+            }
+            for stat in stats
+        ]
+    return report
+
+
+# Global tracker instance
+query_tracker = QueryShapeTracker()
@@ -0,0 +1,50 @@
+# JSON Codec for QualityStudio
+# orjson-based encoding with native handling of BSON types at any depth
+
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from bson import ObjectId, Decimal128
+from fastapi.responses import JSONResponse
+
+# Mongo documents may carry int keys inside free-form dicts (parameters, qfirData)
+OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def _default(value: Any) -> Any:
+    """Fallback for types orjson does not serialize natively (datetime is native)"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """Encode content to JSON bytes"""
+    return orjson.dumps(content, default=_default, option=OPTIONS)
+
+
+def loads(data: Any) -> Any:
+    return orjson.loads(data)
+
+
+def to_jsonable(content: Any) -> Any:
+    """Round-trip through the codec to get plain JSON types (for non-HTTP consumers)"""
+    return orjson.loads(dumps(content))
+
+
+class CodecJSONResponse(JSONResponse):
+    """JSON response rendered with orjson.
+
+    Returning an instance directly from a route skips FastAPI's
+    jsonable_encoder pass entirely.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
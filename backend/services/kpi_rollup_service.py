@@ -0,0 +1,330 @@
+# KPI Rollup Service for QualityStudio
+# Maintains daily/weekly/monthly quality aggregates per line and per shift in
+# kpi_rollups, derived from defects, CAPA plans, process runs and complaints.
+#
+# Each source document's contribution (bucket -> counters) is remembered in
+# kpi_rollup_members, so a write applies only the difference between its old
+# and new contribution. A member is only replaced if its revision is still
+# the one that was read, and the difference is applied by whoever replaced
+# it, so several workers updating the same document do not double-count.
+# rebuild() recomputes everything from raw data.
+#
+# Full rebuild from the backend directory:
+#     python -m services.kpi_rollup_service rebuild
+
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+ROLLUPS_COLLECTION = "kpi_rollups"
+MEMBERS_COLLECTION = "kpi_rollup_members"
+
+PERIODS = ("day", "week", "month")
+DIMENSIONS = ("all", "line", "shift")
+
+# Raw collections feeding the rollups. Documents are bucketed by dateTime,
+# dateTimeStart and dateLogged (created_date if missing); CAPA actions by dueDate
+SOURCE_COLLECTIONS = ("defect_tickets", "process_runs", "customer_complaints", "capa_plans")
+
+REBUILD_BATCH_SIZE = 1000
+# Re-reads of a source document whose member another worker replaced meanwhile
+MEMBER_UPDATE_ATTEMPTS = 5
+
+
+def period_start(date: datetime, period: str) -> datetime:
+    day = datetime(date.year, date.month, date.day)
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+
+def bucket_id(period: str, start: datetime, dimension: str, key: str) -> str:
+    return f"{period}|{start:%Y-%m-%d}|{dimension}|{key}"
+
+
+def _as_date(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, str) and value:
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+        except ValueError:
+            return None
+    return None
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value)
+
+
+def _add(contributions: Dict[str, Dict[str, float]], date: Optional[datetime], line: Optional[str], shift: Optional[str], counters: Dict[str, float]):
+    """Add counters to every bucket a dated record falls into"""
+    if date is None:
+        return
+    keys = [("all", "all")]
+    if line:
+        keys.append(("line", str(line)))
+    if shift:
+        keys.append(("shift", str(shift)))
+    for period in PERIODS:
+        start = period_start(date, period)
+        for dimension, key in keys:
+            bucket = contributions.setdefault(bucket_id(period, start, dimension, key), {})
+            for name, value in counters.items():
+                if value:
+                    bucket[name] = bucket.get(name, 0) + value
+
+
+def contributions_for(collection_name: str, doc: Optional[Dict[str, Any]], defect: Optional[Dict[str, Any]] = None) -> Dict[str, Dict[str, float]]:
+    """Bucket id -> counters one source document adds to the rollups.
+
+    CAPA plans have no line/shift of their own; they use the linked defect's.
+    """
+    contributions: Dict[str, Dict[str, float]] = {}
+    if not doc:
+        return contributions
+
+    if collection_name == "defect_tickets":
+        date = _as_date(doc.get("dateTime")) or _as_date(doc.get("created_date"))
+        _add(contributions, date, doc.get("line"), doc.get("shift"), {
+            "defects": 1,
+            "criticalDefects": 1 if doc.get("severity") == "critical" else 0,
+        })
+
+    elif collection_name == "process_runs":
+        date = _as_date(doc.get("dateTimeStart")) or _as_date(doc.get("created_date"))
+        metrics = doc.get("qualityMetrics") or {}
+        fpy, defect_rate = _number(metrics.get("firstPassYield")), _number(metrics.get("defectRate"))
+        _add(contributions, date, doc.get("line"), doc.get("shift"), {
+            "runs": 1,
+            "fpySum": fpy or 0,
+            "fpyCount": 1 if fpy is not None else 0,
+            "defectRateSum": defect_rate or 0,
+            "defectRateCount": 1 if defect_rate is not None else 0,
+        })
+
+    elif collection_name == "customer_complaints":
+        date = _as_date(doc.get("dateLogged")) or _as_date(doc.get("created_date"))
+        _add(contributions, date, None, None, {"complaints": 1})
+
+    elif collection_name == "capa_plans":
+        line = defect.get("line") if defect else None
+        shift = defect.get("shift") if defect else None
+        actions = (doc.get("correctiveActions") or []) + (doc.get("preventiveActions") or [])
+        for action in actions:
+            if not isinstance(action, dict) or action.get("status") != "completed":
+                continue
+            due, completed = _as_date(action.get("dueDate")), _as_date(action.get("completedDate"))
+            on_time = due is not None and completed is not None and completed.date() <= due.date()
+            _add(contributions, due or completed, line, shift, {
+                "capaActionsClosed": 1,
+                "capaActionsOnTime": 1 if on_time else 0,
+            })
+
+    return contributions
+
+
+def _difference(old: Dict[str, Dict[str, float]], new: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    changes = {}
+    for bucket in set(old) | set(new):
+        before, after = old.get(bucket, {}), new.get(bucket, {})
+        delta = {name: after.get(name, 0) - before.get(name, 0) for name in set(before) | set(after)}
+        delta = {name: value for name, value in delta.items() if value}
+        if delta:
+            changes[bucket] = delta
+    return changes
+
+
+def _to_stored(contributions: Dict[str, Dict[str, float]]) -> List[Dict[str, Any]]:
+    # A list rather than a sub-document: line names may contain "." or "$"
+    return [{"bucket": bucket, "counters": counters} for bucket, counters in contributions.items()]
+
+
+def _from_stored(stored: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    return {entry["bucket"]: entry["counters"] for entry in stored}
+
+
+def _ratio(numerator: str, denominator: str, scale: float) -> Dict[str, Any]:
+    return {"$cond": [
+        {"$gt": [f"${denominator}", 0]},
+        {"$multiply": [{"$divide": [f"${numerator}", f"${denominator}"]}, scale]},
+        None
+    ]}
+
+
+# KPI values recomputed from the counters after every change
+DERIVED_FIELDS = {
+    "defectPPM": _ratio("defectRateSum", "defectRateCount", 10000),  # defectRate is a percentage
+    "firstPassYield": _ratio("fpySum", "fpyCount", 1),
+    "onTimeCAPA": _ratio("capaActionsOnTime", "capaActionsClosed", 100),
+}
+
+
+def _bucket_update(bucket: str, delta: Dict[str, float], now: datetime) -> UpdateOne:
+    """Pipeline upsert: add the deltas, then refresh the derived KPI fields"""
+    period, start, dimension, key = bucket.split("|", 3)
+    return UpdateOne({"_id": bucket}, [
+        {"$set": {
+            # Line and shift names come from users; "$..." must not be read as a field path
+            "period": {"$literal": period},
+            "periodStart": datetime.strptime(start, "%Y-%m-%d"),
+            "dimension": {"$literal": dimension},
+            "key": {"$literal": key},
+            **{name: {"$add": [{"$ifNull": [f"${name}", 0]}, value]} for name, value in delta.items()},
+            "updated_date": now,
+        }},
+        {"$set": DERIVED_FIELDS},
+    ], upsert=True)
+
+
+class KPIRollupEngine:
+    """Applies source writes to kpi_rollups and rebuilds it on demand"""
+
+    def __init__(self, db):
+        self.db = db
+        # Saves conflicting member swaps between this worker's own tasks
+        self._lock = asyncio.Lock()
+
+    async def _linked_defect(self, doc: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        defect_id = doc.get("defectTicketId") if doc else None
+        if not defect_id:
+            return None
+        try:
+            return await self.db.defect_tickets.find_one({"_id": ObjectId(defect_id)}, {"line": 1, "shift": 1})
+        except Exception:
+            return None
+
+    async def _swap_member(self, member_id: str, member: Optional[Dict[str, Any]],
+                           new: Dict[str, Dict[str, float]]) -> bool:
+        """Store a member's new contribution unless another writer changed it since it was read"""
+        members = self.db[MEMBERS_COLLECTION]
+        if member is None:
+            try:
+                await members.insert_one({"_id": member_id, "contributions": _to_stored(new), "revision": ObjectId()})
+            except DuplicateKeyError:
+                return False
+            return True
+        # A fresh ObjectId per write, so a deleted and re-created member never matches an old guard
+        guard = {"_id": member_id, "revision": member.get("revision")}
+        if new:
+            result = await members.update_one(guard, {"$set": {"contributions": _to_stored(new), "revision": ObjectId()}})
+            return result.matched_count == 1
+        result = await members.delete_one(guard)
+        return result.deleted_count == 1
+
+    async def apply(self, collection_name: str, item_ids: Iterable[str]):
+        """Bring the rollups up to date with the current state of the given documents"""
+        if collection_name not in SOURCE_COLLECTIONS:
+            return
+        now = datetime.utcnow()
+        async with self._lock:
+            for item_id in item_ids:
+                try:
+                    object_id = ObjectId(item_id)
+                except Exception:
+                    continue
+                member_id = f"{collection_name}:{item_id}"
+                for _ in range(MEMBER_UPDATE_ATTEMPTS):
+                    doc = await self.db[collection_name].find_one({"_id": object_id})
+                    defect = await self._linked_defect(doc) if collection_name == "capa_plans" else None
+                    new = contributions_for(collection_name, doc, defect)
+                    member = await self.db[MEMBERS_COLLECTION].find_one({"_id": member_id})
+                    old = _from_stored(member.get("contributions", [])) if member else {}
+
+                    changes = _difference(old, new)
+                    if not changes:
+                        break
+                    if not await self._swap_member(member_id, member, new):
+                        continue
+                    await self.db[ROLLUPS_COLLECTION].bulk_write(
+                        [_bucket_update(bucket, delta, now) for bucket, delta in changes.items()],
+                        ordered=False
+                    )
+                    break
+                else:
+                    logger.warning(f"KPI rollup member {member_id} kept changing; a rebuild will correct any drift")
+
+    async def rebuild(self) -> Dict[str, int]:
+        """Recompute every rollup from the raw collections"""
+        async with self._lock:
+            totals: Dict[str, Dict[str, float]] = defaultdict(dict)
+            members: List[Tuple[str, Dict[str, Dict[str, float]]]] = []
+            defects = {
+                str(doc["_id"]): doc
+                async for doc in self.db.defect_tickets.find({}, {"line": 1, "shift": 1})
+            }
+            for collection_name in SOURCE_COLLECTIONS:
+                async for doc in self.db[collection_name].find({}).batch_size(REBUILD_BATCH_SIZE):
+                    defect = defects.get(str(doc.get("defectTicketId"))) if collection_name == "capa_plans" else None
+                    contributions = contributions_for(collection_name, doc, defect)
+                    if not contributions:
+                        continue
+                    members.append((f"{collection_name}:{doc['_id']}", contributions))
+                    for bucket, counters in contributions.items():
+                        for name, value in counters.items():
+                            totals[bucket][name] = totals[bucket].get(name, 0) + value
+
+            await self.db[ROLLUPS_COLLECTION].delete_many({})
+            await self.db[MEMBERS_COLLECTION].delete_many({})
+            now = datetime.utcnow()
+            updates = [_bucket_update(bucket, counters, now) for bucket, counters in totals.items()]
+            for start in range(0, len(updates), REBUILD_BATCH_SIZE):
+                await self.db[ROLLUPS_COLLECTION].bulk_write(updates[start:start + REBUILD_BATCH_SIZE], ordered=False)
+            for start in range(0, len(members), REBUILD_BATCH_SIZE):
+                await self.db[MEMBERS_COLLECTION].insert_many([
+                    {"_id": member_id, "contributions": _to_stored(contributions), "revision": ObjectId()}
+                    for member_id, contributions in members[start:start + REBUILD_BATCH_SIZE]
+                ])
+            return {"rollups": len(updates), "members": len(members)}
+
+    async def query(self, period: str, dimension: str, key: Optional[str] = None,
+                    start: Optional[datetime] = None, end: Optional[datetime] = None, limit: int = 500) -> List[Dict[str, Any]]:
+        """Rollup rows for one period/dimension, optionally one key and a periodStart range"""
+        filters: Dict[str, Any] = {"period": period, "dimension": dimension}
+        if key:
+            filters["key"] = key
+        if start or end:
+            filters["periodStart"] = {}
+            if start:
+                filters["periodStart"]["$gte"] = start
+            if end:
+                filters["periodStart"]["$lt"] = end
+        # Latest `limit` buckets, returned oldest first for charting
+        cursor = self.db[ROLLUPS_COLLECTION].find(filters, {"_id": 0}).sort([("periodStart", -1), ("key", 1)]).limit(limit)
+        rows = await cursor.to_list(length=limit)
+        rows.reverse()
+        return rows
+
+
+async def _main(command: str):
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from services.index_registry import ensure_indexes
+
+    load_dotenv()
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL"))
+    db = client[os.environ.get("DB_NAME", "quality_studio")]
+    if command == "rebuild":
+        await ensure_indexes(db)
+        print(await KPIRollupEngine(db).rebuild())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="KPI rollup maintenance")
+    parser.add_argument("command", choices=["rebuild"])
+    asyncio.run(_main(parser.parse_args().command))
@@ -0,0 +1,121 @@
+# Keyset Pagination Service for QualityStudio
+# Builds opaque (sort key, _id) cursor tokens so deep pages stay index-bounded range scans
+
+import json
+import base64
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from bson import ObjectId
+
+DEFAULT_SORT = "-created_date"
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a cursor token cannot be decoded or does not match the requested sort"""
+
+
+def parse_sort(sort_by: Optional[str]) -> Tuple[str, int]:
+    """Turn a '-field' / 'field' sort string into (field, direction)"""
+    sort_by = sort_by or DEFAULT_SORT
+    if sort_by.startswith("-"):
+        return sort_by[1:], -1
+    return sort_by, 1
+
+
+def build_sort(sort_field: str, direction: int) -> List[Tuple[str, int]]:
+    """Sort specification with _id as tie-breaker so the order is total"""
+    if sort_field == "_id":
+        return [("_id", direction)]
+    return [(sort_field, direction), ("_id", direction)]
+
+
+def get_field(doc: Dict[str, Any], path: str) -> Any:
+    """Read a (possibly dotted) field path from a raw MongoDB document"""
+    value: Any = doc
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _encode_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, datetime):
+        return {"t": "date", "v": value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {"t": "oid", "v": str(value)}
+    return {"t": None, "v": value}
+
+
+def _decode_value(encoded: Dict[str, Any]) -> Any:
+    kind, value = encoded.get("t"), encoded.get("v")
+    if kind == "date":
+        return datetime.fromisoformat(value)
+    if kind == "oid":
+        return ObjectId(value)
+    return value
+
+
+def encode_cursor(doc: Dict[str, Any], sort_field: str, direction: int) -> str:
+    """Create an opaque cursor pointing just past the given raw document"""
+    payload = {
+        "s": sort_field,
+        "d": direction,
+        "k": _encode_value(get_field(doc, sort_field)),
+        "id": str(doc["_id"]),
+    }
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str, sort_field: str, direction: int) -> Tuple[Any, ObjectId]:
+    """Decode a cursor token into (last sort value, last _id)"""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        last_value = _decode_value(payload["k"])
+        last_id = ObjectId(payload["id"])
+    except Exception:
+        raise InvalidCursorError("Malformed cursor")
+
+    if payload.get("s") != sort_field or payload.get("d") != direction:
+        raise InvalidCursorError("Cursor does not match the requested sort order")
+    return last_value, last_id
+
+
+def keyset_filter(sort_field: str, direction: int, last_value: Any, last_id: ObjectId) -> Dict[str, Any]:
+    """Range condition selecting every document after (last_value, last_id) in sort order.
+
+    MongoDB sorts null/missing values first ascending and last descending, so
+    those positions are handled explicitly.
+    """
+    op = "$gt" if direction == 1 else "$lt"
+    if sort_field == "_id":
+        return {"_id": {op: last_id}}
+
+    if last_value is None:
+        if direction == 1:
+            return {"$or": [
+                {sort_field: None, "_id": {"$gt": last_id}},
+                {sort_field: {"$ne": None}},
+            ]}
+        return {sort_field: None, "_id": {"$lt": last_id}}
+
+    clauses = [
+        {sort_field: {op: last_value}},
+        {sort_field: last_value, "_id": {op: last_id}},
+    ]
+    if direction == -1:
+        clauses.append({sort_field: None})
+    return {"$or": clauses}
+
+
+def apply_cursor(filters: Dict[str, Any], cursor: Optional[str], sort_field: str, direction: int) -> Dict[str, Any]:
+    """Combine caller filters with the keyset range for the given cursor"""
+    if not cursor:
+        return filters
+    last_value, last_id = decode_cursor(cursor, sort_field, direction)
+    bound = keyset_filter(sort_field, direction, last_value, last_id)
+    if not filters:
+        return bound
+    return {"$and": [filters, bound]}
@@ -0,0 +1,76 @@
+# Field Projection Service for QualityStudio
+# Turns the `fields=` query parameter into a MongoDB find() projection
+
+import re
+from typing import Dict, List, Optional
+
+SUMMARY = "summary"
+
+FIELD_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+COMMON_FIELDS = ["created_date", "updated_date"]
+
+# Table-view columns per entity; heavy nested fields (qfirData, parameters,
+# qualityMetrics, maintenanceHistory, ishikawaData, ...) are left out
+SUMMARY_FIELDS: Dict[str, List[str]] = {
+    "customer_complaints": [
+        "ticketNumber", "dateLogged", "customerName", "productType",
+        "severity", "status", "assignedTo", "qfirCompleted",
+    ],
+    "defect_tickets": [
+        "ticketId", "dateTime", "line", "lane", "shift", "defectType",
+        "severity", "status", "inspectionMethod", "linkedComplaintId",
+    ],
+    "rca_records": ["defectTicketId", "analysisType", "rootCause", "status"],
+    "capa_plans": ["defectTicketId", "rcaRecordId", "approvalState"],
+    "process_runs": ["runId", "dateTimeStart", "dateTimeEnd", "line", "materialType"],
+    "golden_batches": ["batchId", "name", "line", "materialType", "dateCreated", "isActive"],
+    "sops": ["sopNumber", "title", "version", "department", "effectiveDate", "status"],
+    "does": ["experimentName", "objective", "status"],
+    "knowledge_documents": ["title", "category", "tags", "author"],
+    "equipment": ["equipmentId", "name", "type", "line", "status"],
+    "file_upload_history": ["fileName", "fileType", "uploadDate", "uploadedBy", "fileSize", "status"],
+    "kpis": [
+        "recordDate", "cpk", "firstPassYield", "defectPPM",
+        "onTimeCAPA", "scrapRate", "customerComplaints",
+    ],
+}
+
+
+class InvalidFieldsError(ValueError):
+    """Raised when the fields parameter names something that is not a plain field path"""
+
+
+def build_projection(collection_name: str, fields: Optional[str], sort_field: Optional[str] = None) -> Optional[Dict[str, int]]:
+    """Build an inclusion projection.
+
+    fields=None returns full documents, fields=summary uses the entity's
+    summary columns, otherwise a comma separated list of field paths.
+    The sort field is always kept so keyset cursors can be built.
+    """
+    if not fields:
+        return None
+
+    if fields == SUMMARY:
+        names = SUMMARY_FIELDS.get(collection_name, []) + COMMON_FIELDS
+    else:
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        for i, name in enumerate(names):
+            if not FIELD_NAME.match(name):
+                raise InvalidFieldsError(f"Invalid field name: {name}")
+            if _overlaps(name, names[:i]):
+                raise InvalidFieldsError(f"Field {name} overlaps another requested field")
+        names = ["_id" if name == "id" else name for name in names]
+
+    projection = {name: 1 for name in names}
+    if sort_field and sort_field != "_id" and not _overlaps(sort_field, names):
+        projection[sort_field] = 1
+    return projection
+
+
+def _overlaps(path: str, names: List[str]) -> bool:
+    """MongoDB rejects projections containing both a path and one of its parents"""
+    return any(
+        name == path or path.startswith(name + ".") or name.startswith(path + ".")
+        for name in names
+    )
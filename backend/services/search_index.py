@@ -0,0 +1,178 @@
+# Knowledge Search Index for QualityStudio
+# In-process inverted index with BM25 ranking over knowledge documents and
+# SOPs. Built at startup and refreshed from the write path, so searches never
+# scan the collections.
+
+import heapq
+import logging
+import math
+import re
+from collections import Counter
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+# collection -> {field: weight}; a weight repeats the field's terms (BM25F-style)
+INDEXED_FIELDS: Dict[str, Dict[str, int]] = {
+    "knowledge_documents": {"title": 3, "tags": 2, "content": 1},
+    "sops": {"title": 3, "content": 1},
+}
+
+# Returned with each hit so results can be shown without another lookup
+DISPLAY_FIELDS = ("title", "category", "sopNumber", "department")
+
+TOKEN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or that the
+this to was were will with
+""".split())
+
+
+def normalize(token: str) -> str:
+    """Light plural folding so 'bubbles' finds 'bubble'"""
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text: Any) -> List[str]:
+    if isinstance(text, list):
+        text = " ".join(str(item) for item in text)
+    if not text:
+        return []
+    return [normalize(token) for token in TOKEN.findall(str(text).lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """Inverted index of weighted term frequencies with Okapi BM25 scoring"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[Hashable, float]] = {}
+        self.doc_terms: Dict[Hashable, Counter] = {}
+        self.doc_length: Dict[Hashable, float] = {}
+        self.total_length = 0.0
+
+    def __len__(self):
+        return len(self.doc_terms)
+
+    def add(self, key: Hashable, fields: Dict[str, Any], weights: Dict[str, int]):
+        self.remove(key)
+        terms: Counter = Counter()
+        for field, weight in weights.items():
+            for token in tokenize(fields.get(field)):
+                terms[token] += weight
+        if not terms:
+            return
+        self.doc_terms[key] = terms
+        length = float(sum(terms.values()))
+        self.doc_length[key] = length
+        self.total_length += length
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[key] = frequency
+
+    def remove(self, key: Hashable):
+        terms = self.doc_terms.pop(key, None)
+        if terms is None:
+            return
+        self.total_length -= self.doc_length.pop(key)
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(key, None)
+                if not posting:
+                    del self.postings[term]
+
+    def search(self, query: str, k: int = 10, keep=None) -> Tuple[List[Tuple[Hashable, float, List[str]]], int]:
+        """Top-k (key, score, matched terms) and the number of matching documents"""
+        count = len(self.doc_terms)
+        if not count:
+            return [], 0
+        average_length = self.total_length / count
+        scores: Dict[Hashable, float] = {}
+        matched: Dict[Hashable, List[str]] = {}
+        for term in dict.fromkeys(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for key, frequency in posting.items():
+                if keep is not None and not keep(key):
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_length[key] / average_length)
+                scores[key] = scores.get(key, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+                matched.setdefault(key, []).append(term)
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(key, score, matched[key]) for key, score in top], len(scores)
+
+
+class KnowledgeSearchIndex:
+    """BM25 index over INDEXED_FIELDS, keyed by (collection, id)"""
+
+    def __init__(self, db):
+        self.db = db
+        self.index = BM25Index()
+        self.display: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    def _projection(self, collection_name: str) -> Dict[str, int]:
+        return {field: 1 for field in (*INDEXED_FIELDS[collection_name], *DISPLAY_FIELDS)}
+
+    def _add(self, collection_name: str, doc: Dict[str, Any]):
+        key = (collection_name, str(doc["_id"]))
+        self.index.add(key, doc, INDEXED_FIELDS[collection_name])
+        self.display[key] = {field: doc[field] for field in DISPLAY_FIELDS if doc.get(field) is not None}
+
+    def _remove(self, key: Tuple[str, str]):
+        self.index.remove(key)
+        self.display.pop(key, None)
+
+    async def load(self):
+        """(Re)build the whole index from the database"""
+        fresh = KnowledgeSearchIndex(self.db)
+        for collection_name in INDEXED_FIELDS:
+            async for doc in self.db[collection_name].find({}, self._projection(collection_name)):
+                fresh._add(collection_name, doc)
+        self.index, self.display = fresh.index, fresh.display
+        logger.info(f"Knowledge search index built with {len(self.index)} documents")
+
+    async def refresh(self, collection_name: str, item_ids: Optional[Iterable[str]]):
+        """Re-index documents after a write; item_ids None reloads everything"""
+        if collection_name not in INDEXED_FIELDS:
+            return
+        if item_ids is None:
+            await self.load()
+            return
+        ids = [item_id for item_id in item_ids if ObjectId.is_valid(item_id)]
+        docs = await self.db[collection_name].find(
+            {"_id": {"$in": [ObjectId(item_id) for item_id in ids]}},
+            self._projection(collection_name)
+        ).to_list(length=None)
+        found = {str(doc["_id"]) for doc in docs}
+        for doc in docs:
+            self._add(collection_name, doc)
+        for item_id in ids:
+            if item_id not in found:
+                self._remove((collection_name, item_id))
+
+    def search(self, query: str, k: int = 10, collections: Optional[Iterable[str]] = None) -> Tuple[List[Dict[str, Any]], int]:
+        wanted = set(collections) if collections else None
+        keep = (lambda key: key[0] in wanted) if wanted else None
+        hits, total = self.index.search(query, k, keep)
+        top_score = hits[0][1] if hits else 1.0
+        results = []
+        for (collection_name, item_id), score, terms in hits:
+            results.append({
+                "id": item_id,
+                "collection": collection_name,
+                **self.display.get((collection_name, item_id), {}),
+                "score": round(score, 4),
+                "relevance_score": round(score / top_score, 4),
+                "matched_terms": terms,
+            })
+        return results, total
@@ -0,0 +1,268 @@
+# Defect Similarity Index for QualityStudio
+# Hashed TF-IDF vectors of DefectTicket.description held in a NumPy matrix.
+# Small corpora are searched exhaustively; past IVF_MIN_ROWS tickets the rows
+# are grouped under k-means centroids (IVF) and only the nearest lists are
+# scored, keeping lookups in the low milliseconds at a million tickets.
+
+import asyncio
+import logging
+import math
+import os
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from bson import ObjectId
+
+from services.search_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Vector width. Memory is rows x dims x 4 bytes (1M tickets at 128 dims ~ 512 MB)
+SIMILARITY_DIMENSIONS = int(os.environ.get("SIMILARITY_DIMENSIONS", 128))
+# Ticket count from which the IVF partition is used instead of a full scan
+IVF_MIN_ROWS = int(os.environ.get("SIMILARITY_IVF_MIN_ROWS", 50000))
+# Lists scored per query; higher trades speed for recall
+SIMILARITY_NPROBE = int(os.environ.get("SIMILARITY_NPROBE", 8))
+
+INITIAL_CAPACITY = 1024
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLE_PER_LIST = 20
+ASSIGN_BATCH_SIZE = 65536
+
+
+def features(text: str) -> Counter:
+    """Unigrams plus bigrams, so 'edge crack' and 'crack edge' differ"""
+    tokens = tokenize(text)
+    grams = Counter(tokens)
+    grams.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+    return grams
+
+
+# Per-ticket features are kept as crc32 hashes with counts (8 bytes each)
+# instead of Counters of gram strings, so a million tickets fit in memory
+FEATURE_DTYPE = np.dtype([("hash", np.uint32), ("count", np.uint32)])
+SIGN_BIT = 0x80000000
+
+
+def hashed_features(text: str) -> np.ndarray:
+    """features() as a FEATURE_DTYPE array, one entry per distinct hash"""
+    grams = features(text)
+    hashes = np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint32, count=len(grams))
+    counts = np.fromiter(grams.values(), dtype=np.uint32, count=len(grams))
+    unique, inverse = np.unique(hashes, return_inverse=True)
+    hashed = np.zeros(len(unique), dtype=FEATURE_DTYPE)
+    hashed["hash"] = unique
+    hashed["count"] = np.bincount(inverse, weights=counts, minlength=len(unique))
+    return hashed
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first"""
+    if k >= len(scores):
+        return np.argsort(-scores)
+    top = np.argpartition(scores, -k)[-k:]
+    return top[np.argsort(-scores[top])]
+
+
+class VectorStore:
+    """Growable matrix of unit vectors keyed by id, with an optional IVF partition"""
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self.vectors = np.zeros((INITIAL_CAPACITY, dimensions), dtype=np.float32)
+        self.ids: List[Optional[str]] = []
+        self.rows: Dict[str, int] = {}
+        self.free_rows: List[int] = []
+        self.centroids: Optional[np.ndarray] = None
+        self.lists: List[Set[int]] = []
+        self.row_list: Dict[int, int] = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _row_for(self, item_id: str) -> int:
+        if item_id in self.rows:
+            return self.rows[item_id]
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.ids[row] = item_id
+        else:
+            row = len(self.ids)
+            if row >= len(self.vectors):
+                grown = np.zeros((len(self.vectors) * 2, self.dimensions), dtype=np.float32)
+                grown[:len(self.vectors)] = self.vectors
+                self.vectors = grown
+            self.ids.append(item_id)
+        self.rows[item_id] = row
+        return row
+
+    def put(self, item_id: str, vector: np.ndarray):
+        row = self._row_for(item_id)
+        self.vectors[row] = vector
+        if self.centroids is not None:
+            self._unassign(row)
+            target = int(np.argmax(self.centroids @ vector))
+            self.lists[target].add(row)
+            self.row_list[row] = target
+
+    def _unassign(self, row: int):
+        previous = self.row_list.pop(row, None)
+        if previous is not None:
+            self.lists[previous].discard(row)
+
+    def remove(self, item_id: str):
+        row = self.rows.pop(item_id, None)
+        if row is None:
+            return
+        self.vectors[row] = 0
+        self.ids[row] = None
+        self.free_rows.append(row)
+        self._unassign(row)
+
+    def train(self):
+        """Spherical k-means over a sample, then assign every row (CPU heavy; run in a thread)"""
+        active = np.fromiter(self.rows.values(), dtype=np.int64)
+        if len(active) < IVF_MIN_ROWS:
+            self.centroids, self.lists, self.row_list = None, [], {}
+            return
+        count = int(math.sqrt(len(active)) / 4) or 1
+        rng = np.random.default_rng(0)
+        sample = self.vectors[rng.choice(active, min(len(active), count * KMEANS_SAMPLE_PER_LIST), replace=False)]
+        centroids = sample[rng.choice(len(sample), count, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(count):
+                members = sample[labels == c]
+                if len(members):
+                    mean = members.sum(axis=0)
+                    norm = np.linalg.norm(mean)
+                    if norm:
+                        centroids[c] = mean / norm
+
+        lists: List[Set[int]] = [set() for _ in range(count)]
+        row_list: Dict[int, int] = {}
+        for start in range(0, len(active), ASSIGN_BATCH_SIZE):
+            batch = active[start:start + ASSIGN_BATCH_SIZE]
+            for row, label in zip(batch.tolist(), np.argmax(self.vectors[batch] @ centroids.T, axis=1).tolist()):
+                lists[label].add(row)
+                row_list[row] = label
+        self.centroids, self.lists, self.row_list = centroids, lists, row_list
+
+    def search(self, vector: np.ndarray, k: int, exclude_row: Optional[int] = None) -> List[Tuple[int, float]]:
+        if self.centroids is None:
+            candidates = None
+            scores = self.vectors[:len(self.ids)] @ vector
+        else:
+            probes = _top_k(self.centroids @ vector, SIMILARITY_NPROBE)
+            candidates = np.fromiter(
+                (row for probe in probes for row in self.lists[probe]), dtype=np.int64
+            )
+            scores = self.vectors[candidates] @ vector
+        if exclude_row is not None:
+            if candidates is None:
+                scores[exclude_row] = -1.0
+            else:
+                scores[candidates == exclude_row] = -1.0
+        top = _top_k(scores, k + 1)
+        rows = top if candidates is None else candidates[top]
+        return [(int(row), float(scores[i])) for row, i in zip(rows, top)]
+
+
+class DefectSimilarityIndex:
+    """Incremental nearest-neighbour index over defect descriptions.
+
+    IDF weights come from document frequencies at the time a ticket is
+    vectorized; load() re-vectorizes everything with the current weights
+    and retrains the IVF centroids.
+    """
+
+    def __init__(self, db, dimensions: int = SIMILARITY_DIMENSIONS):
+        self.db = db
+        self.dimensions = dimensions
+        self.store = VectorStore(dimensions)
+        self.doc_features: Dict[str, np.ndarray] = {}
+        self.document_frequency: Counter = Counter()
+
+    def __len__(self):
+        return len(self.store)
+
+    def vectorize(self, hashed: np.ndarray) -> np.ndarray:
+        """Signed, IDF-weighted sum of the features; the hash's top bit is the sign"""
+        hashes = hashed["hash"]
+        documents = len(self.doc_features) + 1
+        frequency = np.fromiter((self.document_frequency.get(h, 0) for h in hashes.tolist()),
+                                dtype=np.float64, count=len(hashes))
+        idf = np.log((1 + documents) / (1 + frequency)) + 1
+        signs = np.where(hashes & SIGN_BIT, 1.0, -1.0)
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        np.add.at(vector, hashes % self.dimensions, signs * (1 + np.log(hashed["count"])) * idf)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def upsert(self, item_id: str, description: Optional[str]):
+        self.remove(item_id)
+        hashed = hashed_features(description or "")
+        if not len(hashed):
+            return
+        self.doc_features[item_id] = hashed
+        self.document_frequency.update(hashed["hash"].tolist())
+        self.store.put(item_id, self.vectorize(hashed))
+
+    def remove(self, item_id: str):
+        hashed = self.doc_features.pop(item_id, None)
+        if hashed is not None:
+            self.document_frequency.subtract(hashed["hash"].tolist())
+        self.store.remove(item_id)
+
+    def neighbours(self, item_id: str, k: int = 10, min_score: float = 0.0) -> List[Tuple[str, float]]:
+        """Top-k (id, cosine similarity) excluding the ticket itself"""
+        row = self.store.rows.get(item_id)
+        if row is None:
+            return []
+        hits = self.store.search(self.store.vectors[row], k, exclude_row=row)
+        return [
+            (self.store.ids[hit_row], round(score, 4))
+            for hit_row, score in hits
+            if hit_row != row and self.store.ids[hit_row] is not None and score > min_score
+        ][:k]
+
+    def _build(self, descriptions: Dict[str, Optional[str]]) -> Tuple[VectorStore, Dict[str, np.ndarray], Counter]:
+        """Two passes so every vector sees corpus-wide IDF"""
+        doc_features = {item_id: hashed_features(text or "") for item_id, text in descriptions.items()}
+        doc_features = {item_id: hashed for item_id, hashed in doc_features.items() if len(hashed)}
+        frequency: Counter = Counter()
+        for hashed in doc_features.values():
+            frequency.update(hashed["hash"].tolist())
+        builder = DefectSimilarityIndex(self.db, self.dimensions)
+        builder.doc_features, builder.document_frequency = doc_features, frequency
+        store = VectorStore(self.dimensions)
+        for item_id, hashed in doc_features.items():
+            store.put(item_id, builder.vectorize(hashed))
+        store.train()
+        return store, doc_features, frequency
+
+    async def load(self):
+        descriptions = {
+            str(doc["_id"]): doc.get("description")
+            async for doc in self.db.defect_tickets.find({"description": {"$nin": [None, ""]}}, {"description": 1})
+        }
+        self.store, self.doc_features, self.document_frequency = await asyncio.to_thread(self._build, descriptions)
+        logger.info(f"Defect similarity index built with {len(self.store)} tickets")
+
+    async def refresh(self, item_ids: Optional[Iterable[str]]):
+        """Re-vectorize tickets after a write; item_ids None reloads everything"""
+        if item_ids is None:
+            await self.load()
+            return
+        ids = [item_id for item_id in item_ids if ObjectId.is_valid(item_id)]
+        docs = await self.db.defect_tickets.find(
+            {"_id": {"$in": [ObjectId(item_id) for item_id in ids]}}, {"description": 1}
+        ).to_list(length=None)
+        found = {str(doc["_id"]): doc.get("description") for doc in docs}
+        for item_id in ids:
+            if item_id in found:
+                self.upsert(item_id, found[item_id])
+            else:
+                self.remove(item_id)
@@ -0,0 +1,263 @@
+# Process Time-Series Service for QualityStudio
+# Optional MongoDB time-series collection holding one point per process run
+# parameter / quality metric, plus downsampled series queries for charts.
+#
+# Queries pre-aggregate in MongoDB into a bounded number of time buckets
+# (min and max point per bucket) and, for LTTB, thin those in Python. The
+# cost therefore depends on the requested number of points, not on the
+# length of the time range. Without the time-series collection the same
+# pipeline runs against process_runs directly.
+
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+from services.aggregation_service import server_version
+
+logger = logging.getLogger(__name__)
+
+SERIES_COLLECTION = "process_series"
+GROUPS = ("parameters", "qualityMetrics")
+METHODS = ("lttb", "minmax")
+MAX_POINTS = 5000
+
+# LTTB picks from this many min/max buckets per requested point
+LTTB_OVERSAMPLING = 4
+
+PARAMETER_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+
+INSERT_BATCH_SIZE = 1000
+
+# sync_runs deletes a run's points by runId, a measurement field; time-series
+# collections only allow that from MongoDB 7.0
+SERIES_MIN_SERVER_VERSION = (7, 0)
+
+
+class InvalidSeriesQueryError(ValueError):
+    """Raised for unknown parameters, groups or methods in a series query"""
+
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value)
+
+
+def points_for_run(run: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """One time-series point per numeric parameter / quality metric of a run"""
+    ts = run.get("dateTimeStart") or run.get("created_date")
+    if not isinstance(ts, datetime):
+        return []
+    points = []
+    for group in GROUPS:
+        for name, value in (run.get(group) or {}).items():
+            value = _number(value)
+            if value is None:
+                continue
+            points.append({
+                "ts": ts,
+                "meta": {
+                    "line": run.get("line"),
+                    "materialType": run.get("materialType"),
+                    "group": group,
+                    "parameter": name,
+                },
+                "value": value,
+                "runId": str(run["_id"]),
+            })
+    return points
+
+
+def lttb(points: List[Tuple[float, float]], threshold: int) -> List[Tuple[float, float]]:
+    """Largest-Triangle-Three-Buckets downsampling of (x, y) points sorted by x"""
+    if threshold >= len(points) or threshold < 3:
+        return points
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle vertex
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        next_bucket = points[next_start:next_end] or [points[-1]]
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        ax, ay = points[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+
+class ProcessSeriesStore:
+    """Maintains the process_series collection and answers downsampled queries"""
+
+    def __init__(self, db, enabled: bool):
+        self.db = db
+        self.enabled = enabled
+
+    async def ensure_collection(self):
+        """Create the time-series collection; disables the store below MongoDB 7.0 or if that fails"""
+        if not self.enabled:
+            return
+        version = await server_version(self.db)
+        if version < SERIES_MIN_SERVER_VERSION:
+            logger.warning(
+                f"Process series store needs MongoDB {'.'.join(map(str, SERIES_MIN_SERVER_VERSION))}+ "
+                f"(server is {'.'.join(map(str, version))}); querying process_runs instead"
+            )
+            self.enabled = False
+            return
+        try:
+            await self.db.create_collection(
+                SERIES_COLLECTION,
+                timeseries={"timeField": "ts", "metaField": "meta", "granularity": "hours"}
+            )
+        except CollectionInvalid:
+            pass
+        except OperationFailure as e:
+            logger.warning(f"Time-series collection unavailable, falling back to process_runs: {str(e)}")
+            self.enabled = False
+            return
+        await self.db[SERIES_COLLECTION].create_index([("meta.parameter", 1), ("meta.line", 1), ("ts", 1)])
+        await self.db[SERIES_COLLECTION].create_index([("runId", 1)])
+
+    async def sync_runs(self, run_ids: Iterable[str]):
+        """Replace the points of the given runs (deleted runs lose theirs)"""
+        if not self.enabled:
+            return
+        ids = [item_id for item_id in run_ids if ObjectId.is_valid(item_id)]
+        if not ids:
+            return
+        # Deleting by a measurement field: ensure_collection checked for MongoDB 7.0
+        await self.db[SERIES_COLLECTION].delete_many({"runId": {"$in": ids}})
+        runs = await self.db.process_runs.find({"_id": {"$in": [ObjectId(i) for i in ids]}}).to_list(length=None)
+        points = [point for run in runs for point in points_for_run(run)]
+        if points:
+            await self.db[SERIES_COLLECTION].insert_many(points, ordered=False)
+
+    async def rebuild(self) -> Dict[str, int]:
+        """Repopulate the whole collection from process_runs"""
+        if not self.enabled:
+            return {"runs": 0, "points": 0}
+        await self.db[SERIES_COLLECTION].delete_many({})
+        runs = inserted = 0
+        batch = []
+        async for run in self.db.process_runs.find({}).batch_size(INSERT_BATCH_SIZE):
+            runs += 1
+            batch.extend(points_for_run(run))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                await self.db[SERIES_COLLECTION].insert_many(batch, ordered=False)
+                inserted += len(batch)
+                batch = []
+        if batch:
+            await self.db[SERIES_COLLECTION].insert_many(batch, ordered=False)
+            inserted += len(batch)
+        return {"runs": runs, "points": inserted}
+
+    def _source(self, parameter: str, group: str, line: Optional[str], material_type: Optional[str],
+                start: Optional[datetime], end: Optional[datetime]) -> Tuple[Any, List[Dict[str, Any]]]:
+        """(collection, stages yielding {ts, value}) for the time-series or raw source"""
+        time_range = {}
+        if start:
+            time_range["$gte"] = start
+        if end:
+            time_range["$lt"] = end
+
+        if self.enabled:
+            match: Dict[str, Any] = {"meta.parameter": parameter, "meta.group": group}
+            if line:
+                match["meta.line"] = line
+            if material_type:
+                match["meta.materialType"] = material_type
+            if time_range:
+                match["ts"] = time_range
+            return self.db[SERIES_COLLECTION], [{"$match": match}, {"$project": {"_id": 0, "ts": 1, "value": 1}}]
+
+        field = f"{group}.{parameter}"
+        match = {field: {"$type": "number"}, "dateTimeStart": {"$type": "date", **time_range}}
+        if line:
+            match["line"] = line
+        if material_type:
+            match["materialType"] = material_type
+        return self.db.process_runs, [
+            {"$match": match},
+            {"$project": {"_id": 0, "ts": "$dateTimeStart", "value": f"${field}"}},
+        ]
+
+    async def query(self, parameter: str, group: str = "parameters", line: Optional[str] = None,
+                    material_type: Optional[str] = None, start: Optional[datetime] = None,
+                    end: Optional[datetime] = None, points: int = 500, method: str = "lttb") -> Dict[str, Any]:
+        """Downsampled [timestamp, value] series with at most `points` entries"""
+        if not PARAMETER_NAME.match(parameter or ""):
+            raise InvalidSeriesQueryError(f"Invalid parameter: {parameter}")
+        if group not in GROUPS:
+            raise InvalidSeriesQueryError(f"group must be one of {', '.join(GROUPS)}")
+        if method not in METHODS:
+            raise InvalidSeriesQueryError(f"method must be one of {', '.join(METHODS)}")
+        if not 3 <= points <= MAX_POINTS:
+            raise InvalidSeriesQueryError(f"points must be between 3 and {MAX_POINTS}")
+
+        collection, stages = self._source(parameter, group, line, material_type, start, end)
+        source = SERIES_COLLECTION if self.enabled else "process_runs"
+
+        bounds = await collection.aggregate(stages + [
+            {"$group": {"_id": None, "first": {"$min": "$ts"}, "last": {"$max": "$ts"}, "count": {"$sum": 1}}}
+        ]).to_list(length=1)
+        if not bounds:
+            return {"parameter": parameter, "method": method, "source": source, "count": 0, "points": []}
+        first, last, count = bounds[0]["first"], bounds[0]["last"], bounds[0]["count"]
+
+        # minmax keeps two points per bucket; LTTB chooses among oversampled buckets
+        buckets = points // 2 if method == "minmax" else points * LTTB_OVERSAMPLING
+        width_ms = max((last - first).total_seconds() * 1000 / buckets, 1)
+        rows = await collection.aggregate(stages + [
+            {"$group": {
+                # The row at `last` would open bucket `buckets`; fold it into the final one
+                "_id": {"$min": [{"$floor": {"$divide": [{"$subtract": ["$ts", first]}, width_ms]}}, buckets - 1]},
+                # Sub-documents compare field by field, value first: min/max point
+                # with its timestamp, on any server version ($top needs 5.2)
+                "low": {"$min": {"value": "$value", "ts": "$ts"}},
+                "high": {"$max": {"value": "$value", "ts": "$ts"}},
+            }},
+            {"$sort": {"_id": 1}},
+        ], allowDiskUse=True).to_list(length=None)
+
+        series: List[Tuple[datetime, float]] = []
+        for row in rows:
+            low = (row["low"]["ts"], row["low"]["value"])
+            high = (row["high"]["ts"], row["high"]["value"])
+            series.extend(sorted({low, high}))
+
+        if method == "lttb":
+            numeric = [(ts.timestamp(), value) for ts, value in series]
+            lookup = dict(zip(numeric, series))
+            series = [lookup[p] for p in lttb(numeric, points)]
+
+        return {
+            "parameter": parameter,
+            "group": group,
+            "method": method,
+            "source": source,
+            "count": count,
+            "points": [[ts, value] for ts, value in series],
+        }
+
+
+def create_series_store(db) -> ProcessSeriesStore:
+    """PROCESS_TIMESERIES_ENABLED=true stores run data in a time-series collection (MongoDB 7.0+)"""
+    enabled = os.environ.get("PROCESS_TIMESERIES_ENABLED", "false").lower() == "true"
+    return ProcessSeriesStore(db, enabled)
@@ -0,0 +1,54 @@
+# Document Versioning for QualityStudio
+# Optimistic concurrency: every write bumps doc_version, exposed as a strong ETag
+
+from typing import Any, Dict, Optional
+
+VERSION_FIELD = "doc_version"
+
+
+class VersionConflictError(Exception):
+    """Raised when If-Match does not match the stored document version"""
+
+
+def current_version(doc: Dict[str, Any]) -> int:
+    """Documents written before versioning existed count as version 0"""
+    return doc.get(VERSION_FIELD) or 0
+
+
+def etag_for(doc: Dict[str, Any]) -> str:
+    return f'"{current_version(doc)}"'
+
+
+def parse_if_match(header: Optional[str]) -> Optional[int]:
+    """Expected version from an If-Match header.
+
+    Returns None when there is no precondition (header absent or '*').
+    Raises VersionConflictError for tags that can never match a version.
+    """
+    if header is None:
+        return None
+    tag = header.strip()
+    if tag == "*":
+        return None
+    if tag.startswith("W/"):
+        # Weak tags never satisfy If-Match (RFC 9110 strong comparison)
+        raise VersionConflictError("Weak ETags cannot be used with If-Match")
+    try:
+        return int(tag.strip('"'))
+    except ValueError:
+        raise VersionConflictError(f"Invalid If-Match value: {header}")
+
+
+def version_query(expected_version: int) -> Any:
+    """Match condition for the version field; version 0 also matches unversioned documents"""
+    return expected_version if expected_version else None
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match evaluation (weak comparison, '*' and lists allowed)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
@@ -118,6 +118,9 @@ class NotificationType:
     CAPA_APPROVED = "capa_approved"
     KPI_UPDATE = "kpi_update"
     SYSTEM_ALERT = "system_alert"
+    AI_JOB_PROGRESS = "ai_job_progress"
+    AI_JOB_COMPLETED = "ai_job_completed"
+    AI_JOB_FAILED = "ai_job_failed"
 
 
 async def send_notification(
@@ -57,6 +57,28 @@ class LocalAPIClient {
     }
   }
 
+  // Like request(), but also returns the keyset token for the next page
+  async requestPage(endpoint, options = {}) {
+    const url = `${this.baseURL}${endpoint}`;
+    const response = await fetch(url, {
+      ...options,
+      headers: {
+        'Content-Type': 'application/json',
+        ...getAuthHeaders(),
+        ...options.headers,
+      },
+    });
+
+    if (!response.ok) {
+      const errorData = await response.json().catch(() => ({}));
+      throw new Error(errorData.detail || `HTTP error! status: ${response.status}`);
+    }
+    return {
+      items: await response.json(),
+      nextCursor: response.headers.get('X-Next-Cursor'),
+    };
+  }
+
   // Entity class factory
   createEntityClass(collectionName) {
     return {
@@ -65,6 +87,13 @@ class LocalAPIClient {
         return await this.request(`/${collectionName}${sort}`);
       },
 
+      listPage: async (sortBy = '-created_date', limit = 100, cursor = null) => {
+        const params = new URLSearchParams({ limit: String(limit) });
+        if (sortBy) params.set('sort', sortBy);
+        if (cursor) params.set('cursor', cursor);
+        return await this.requestPage(`/${collectionName}?${params}`);
+      },
+
       create: async (data) => {
         return await this.request(`/${collectionName}`, {
           method: 'POST',
@@ -76,9 +105,13 @@ class LocalAPIClient {
         return await this.request(`/${collectionName}/${id}`);
       },
 
-      update: async (id, data) => {
+      // Pass { ifMatch: record.doc_version } to fail with 412 instead of
+      // overwriting someone else's newer edit
+      update: async (id, data, { ifMatch } = {}) => {
+        const headers = ifMatch !== undefined && ifMatch !== null ? { 'If-Match': `"${ifMatch}"` } : {};
         return await this.request(`/${collectionName}/${id}`, {
           method: 'PUT',
+          headers,
           body: JSON.stringify(data),
         });
       },
@@ -95,6 +128,32 @@ class LocalAPIClient {
           body: JSON.stringify(filters),
         });
       },
+
+      // Mixed [{ op: 'insert'|'update'|'upsert'|'delete', id, filter, document }]
+      // in one request; returns per-operation results
+      bulk: async (operations) => {
+        return await this.request(`/bulk/${collectionName}`, {
+          method: 'POST',
+          body: JSON.stringify({ operations }),
+        });
+      },
+
+      // Server-side group-by, e.g. { groupBy: ['defectType'], metrics: [{ op: 'count' }] }
+      aggregate: async (spec) => {
+        return await this.request(`/${collectionName}/aggregate`, {
+          method: 'POST',
+          body: JSON.stringify(spec),
+        });
+      },
+
+      filterPage: async (filters, sortBy = '-created_date', limit = 100, cursor = null) => {
+        const params = new URLSearchParams({ sort: sortBy, limit: String(limit) });
+        if (cursor) params.set('cursor', cursor);
+        return await this.requestPage(`/${collectionName}/filter?${params}`, {
+          method: 'POST',
+          body: JSON.stringify(filters),
+        });
+      },
     };
   }
 }
@@ -104,8 +163,23 @@ const apiClient = new LocalAPIClient(API_BASE_URL);
 
 // Create entity classes
 export const entities = {
-  CustomerComplaint: apiClient.createEntityClass('customer_complaints'),
-  DefectTicket: apiClient.createEntityClass('defect_tickets'),
+  CustomerComplaint: {
+    ...apiClient.createEntityClass('customer_complaints'),
+    // Likely duplicates of one complaint (MinHash/LSH)
+    duplicates: async (id) => {
+      return await apiClient.request(`/customer_complaints/${id}/duplicates`);
+    },
+    duplicatesReport: async () => {
+      return await apiClient.request('/customer_complaints/duplicates/report');
+    },
+  },
+  DefectTicket: {
+    ...apiClient.createEntityClass('defect_tickets'),
+    // Past tickets with similar descriptions, with rootCause and linked CAPA plans
+    similar: async (id, k = 10) => {
+      return await apiClient.request(`/defect_tickets/${id}/similar?k=${k}`);
+    },
+  },
   RCARecord: apiClient.createEntityClass('rca_records'),
   CAPAPlan: apiClient.createEntityClass('capa_plans'),
   ProcessRun: apiClient.createEntityClass('process_runs'),
@@ -216,24 +290,34 @@ export const auth = {
 
 // AI Service API
 export const ai = {
-  getRCASuggestions: async (description, defectType, severity) => {
+  // options: { bypassCache } skips the server's LLM response cache;
+  // { forceModel } skips the keyword-rule fast path of classifyDefect(s)
+  getRCASuggestions: async (description, defectType, severity, options = {}) => {
     return await apiClient.request('/ai/rca-suggestions', {
       method: 'POST',
-      body: JSON.stringify({ description, defectType, severity }),
+      body: JSON.stringify({ description, defectType, severity, ...options }),
     });
   },
   
-  classifyDefect: async (description, imageUrl = null) => {
+  classifyDefect: async (description, imageUrl = null, options = {}) => {
     return await apiClient.request('/ai/classify-defect', {
       method: 'POST',
-      body: JSON.stringify({ description, imageUrl }),
+      body: JSON.stringify({ description, imageUrl, ...options }),
+    });
+  },
+  
+  // Results come back in the order of `descriptions`
+  classifyDefects: async (descriptions, options = {}) => {
+    return await apiClient.request('/ai/classify-defects/batch', {
+      method: 'POST',
+      body: JSON.stringify({ descriptions, ...options }),
     });
   },
   
-  generateCAPA: async (rootCause, defectType) => {
+  generateCAPA: async (rootCause, defectType, options = {}) => {
     return await apiClient.request('/ai/generate-capa', {
       method: 'POST',
-      body: JSON.stringify({ rootCause, defectType }),
+      body: JSON.stringify({ rootCause, defectType, ...options }),
     });
   },
   
@@ -244,12 +328,44 @@ export const ai = {
     });
   },
   
-  searchKnowledge: async (query) => {
+  // options: { limit, collections: ['knowledge_documents', 'sops'], rerank }
+  searchKnowledge: async (query, options = {}) => {
     return await apiClient.request('/ai/search-knowledge', {
       method: 'POST',
-      body: JSON.stringify({ query }),
+      body: JSON.stringify({ query, ...options }),
     });
   },
+  
+  metrics: async () => {
+    return await apiClient.request('/ai/metrics');
+  },
+  
+  // Queued AI work. kind: rca | capa | classify | invoke | chain;
+  // target: { collection: 'rca_records' | 'capa_plans', id } for attach().
+  // Progress and completion arrive on notificationSocket (room `ai_job:<id>`).
+  jobs: {
+    submit: async (kind, params, target = null) => {
+      return await apiClient.request('/ai/jobs', {
+        method: 'POST',
+        body: JSON.stringify({ kind, params, target }),
+      });
+    },
+    
+    get: async (id) => {
+      return await apiClient.request(`/ai/jobs/${id}`);
+    },
+    
+    forRecord: async (targetId) => {
+      return await apiClient.request(`/ai/jobs?targetId=${encodeURIComponent(targetId)}`);
+    },
+    
+    attach: async (id, recordId = null) => {
+      return await apiClient.request(`/ai/jobs/${id}/attach`, {
+        method: 'POST',
+        body: JSON.stringify(recordId ? { id: recordId } : {}),
+      });
+    },
+  },
 };
 
 // Statistics API
@@ -257,6 +373,25 @@ export const statistics = {
   get: async () => {
     return await apiClient.request('/statistics');
   },
+  
+  // Precomputed KPI buckets: period day|week|month, dimension all|line|shift
+  kpiRollups: async ({ period = 'day', dimension = 'all', key, start, end, limit } = {}) => {
+    const params = new URLSearchParams({ period, dimension });
+    if (key) params.append('key', key);
+    if (start) params.append('start', start);
+    if (end) params.append('end', end);
+    if (limit) params.append('limit', limit);
+    return await apiClient.request(`/kpi-rollups?${params}`);
+  },
+  
+  // Downsampled trend of one run parameter: { parameter, group, line, materialType, start, end, points, method }
+  processSeries: async ({ parameter, ...options }) => {
+    const params = new URLSearchParams({ parameter });
+    Object.entries(options).forEach(([name, value]) => {
+      if (value !== undefined && value !== null) params.append(name, value);
+    });
+    return await apiClient.request(`/process-series?${params}`);
+  },
 };
 
 // File Upload API
@@ -395,6 +530,7 @@ export class NotificationSocket {
     this.reconnectAttempts = 0;
     this.maxReconnectAttempts = 5;
     this.listeners = new Set();
+    this.rooms = new Set();
     this.connected = false;
   }
   
@@ -413,6 +549,8 @@ export class NotificationSocket {
         console.log('WebSocket connected');
         this.connected = true;
         this.reconnectAttempts = 0;
+        // Rooms are per connection on the server, so rejoin them after a reconnect
+        this.rooms.forEach(room => this.ws.send(JSON.stringify({ action: 'subscribe', room })));
         this.notifyListeners({ type: 'connection', status: 'connected' });
       };
       
@@ -449,17 +587,34 @@ export class NotificationSocket {
   }
   
   subscribe(room) {
+    this.rooms.add(room);
     if (this.ws && this.connected) {
       this.ws.send(JSON.stringify({ action: 'subscribe', room }));
     }
   }
   
   unsubscribe(room) {
+    this.rooms.delete(room);
     if (this.ws && this.connected) {
       this.ws.send(JSON.stringify({ action: 'unsubscribe', room }));
     }
   }
   
+  // Receive change deltas ({operation, id, changes|document}) for one collection
+  watchCollection(collection, callback) {
+    const room = `entity:${collection}`;
+    this.subscribe(room);
+    const removeListener = this.addListener(data => {
+      if (data.type === 'entity_change' && data.collection === collection) {
+        callback(data);
+      }
+    });
+    return () => {
+      removeListener();
+      this.unsubscribe(room);
+    };
+  }
+  
   addListener(callback) {
     this.listeners.add(callback);
     return () => this.listeners.delete(callback);
@@ -492,14 +647,15 @@ export const notificationSocket = new NotificationSocket();
 export const integrations = {
   Core: {
     // AI LLM invocation - routes to backend AI service
-    InvokeLLM: async ({ prompt, response_json_schema, add_context_from_user_data }) => {
+    InvokeLLM: async ({ prompt, response_json_schema, add_context_from_user_data, bypassCache }) => {
       try {
         const response = await apiClient.request('/ai/invoke-llm', {
           method: 'POST',
           body: JSON.stringify({ 
             prompt, 
             response_json_schema,
-            add_context_from_user_data 
+            add_context_from_user_data,
+            bypassCache 
           }),
         });
         return response;
@@ -509,6 +665,43 @@ export const integrations = {
       }
     },
     
+    // Streaming variant: onChunk(text) is called as tokens arrive; resolves with
+    // the final {response, parsed} event (parsed only when a schema was given)
+    InvokeLLMStream: async ({ prompt, response_json_schema, bypassCache, onChunk }) => {
+      const response = await fetch(`${API_BASE_URL}/ai/invoke-llm`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Accept': 'text/event-stream',
+          ...getAuthHeaders(),
+        },
+        body: JSON.stringify({ prompt, response_json_schema, bypassCache, stream: true }),
+      });
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+          const block = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+          const event = /^event: (.*)$/m.exec(block)?.[1];
+          const data = JSON.parse(/^data: (.*)$/m.exec(block)?.[1] || 'null');
+          if (event === 'chunk') onChunk?.(data.text);
+          if (event === 'done') return data;
+          if (event === 'error') throw new Error(data.error);
+        }
+      }
+      throw new Error('Stream ended without a result');
+    },
+    
     // File upload - routes to backend file service
     UploadFile: async ({ file }) => {
       try {
@@ -0,0 +1,1209 @@
+"""
+Test suite for QualityStudio data access scaling features:
+- Keyset (cursor) pagination on list and filter endpoints
+- Index registry and index usage report
+- Field projection (fields=) on list, filter and get-by-id
+- NDJSON streaming (format=ndjson)
+- Optimistic concurrency with ETag / If-Match
+- Bulk write endpoint with per-operation results
+- Server-side aggregation API
+- Cached /api/statistics with per-status breakdowns
+- Conditional GET (ETag / If-None-Match / 304) on entity reads
+- Read-through entity cache with write invalidation
+- Filter-result cache with per-collection generations
+- KPI rollups maintained on write, with full rebuild
+- Downsampled process parameter series
+- BM25 knowledge search kept current by writes
+- Similar past defects via hashed TF-IDF vectors
+- Near-duplicate complaint detection (MinHash/LSH)
+- LLM response cache with per-request bypass
+- Single-flight coalescing of identical AI requests
+- Batched defect classification
+- AI gateway metrics (bulkhead, latency, circuit breaker)
+- Server-Sent Events streaming for invoke-llm
+- Persistent AI job queue with attach to RCA records
+- Keyword-rule fast path for defect classification
+- Change stream deltas (offline, no server needed)
+- LSH recall near the dedup threshold (offline)
+- AI jobs failing on fallback answers, CAPA attach merging (offline)
+"""
+
+import pytest
+import requests
+import os
+import json
+import sys
+import time
+import asyncio
+from datetime import datetime
+
+from bson import ObjectId
+
+# Get base URL from environment
+BASE_URL = os.environ.get('VITE_API_BASE_URL', 'http://localhost:8001/api')
+
+# Pure service helpers are also tested offline, straight from the backend package
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+# Test credentials
+TEST_EMAIL = "shubhrangshub@gmail.com"
+TEST_PASSWORD = "admin123"
+
+
+@pytest.fixture(scope="module")
+def auth_token():
+    """Get authentication token for tests"""
+    response = requests.post(f"{BASE_URL}/auth/login", json={
+        "email": TEST_EMAIL,
+        "password": TEST_PASSWORD
+    })
+    if response.status_code == 200:
+        return response.json().get("access_token")
+    pytest.skip("Authentication failed - skipping authenticated tests")
+
+
+@pytest.fixture
+def auth_headers(auth_token):
+    """Get headers with auth token"""
+    return {"Authorization": f"Bearer {auth_token}"}
+
+
+class TestCursorPagination:
+    """Keyset pagination via the X-Next-Cursor header"""
+
+    created_ids = []
+
+    def test_create_defects_for_paging(self):
+        """Create enough defects to span several pages"""
+        stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        for i in range(5):
+            response = requests.post(f"{BASE_URL}/defect_tickets", json={
+                "ticketId": f"TEST-PAGE-{stamp}-{i}",
+                "line": "TEST_LINE_PAGING",
+                "defectType": "haze",
+                "severity": "minor",
+                "status": "open"
+            })
+            assert response.status_code == 200
+            TestCursorPagination.created_ids.append(response.json()["id"])
+        print(f"✓ Created {len(TestCursorPagination.created_ids)} defects for paging")
+
+    def test_filter_pages_do_not_overlap(self):
+        """Walking the cursor returns every record exactly once"""
+        seen = []
+        cursor = None
+        for _ in range(10):
+            params = {"limit": 2}
+            if cursor:
+                params["cursor"] = cursor
+            response = requests.post(
+                f"{BASE_URL}/defect_tickets/filter",
+                params=params,
+                json={"line": "TEST_LINE_PAGING"}
+            )
+            assert response.status_code == 200
+            page = response.json()
+            assert len(page) <= 2
+            seen.extend(item["id"] for item in page)
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+
+        assert len(seen) == len(set(seen))
+        assert set(TestCursorPagination.created_ids).issubset(set(seen))
+        print(f"✓ Paged through {len(seen)} defects without duplicates")
+
+    def test_list_returns_next_cursor(self):
+        """List endpoint exposes a cursor when more rows exist"""
+        response = requests.get(f"{BASE_URL}/defect_tickets", params={"limit": 1})
+        assert response.status_code == 200
+        assert isinstance(response.json(), list)
+        if len(TestCursorPagination.created_ids) > 1:
+            assert response.headers.get("X-Next-Cursor")
+
+    def test_invalid_cursor_rejected(self):
+        """Garbage cursor tokens return 400"""
+        response = requests.get(f"{BASE_URL}/defect_tickets", params={"cursor": "not-a-cursor"})
+        assert response.status_code == 400
+
+    def test_non_positive_limit_rejected(self):
+        """limit=0 or below is a 400 on list and filter routes, not a 500"""
+        for limit in (0, -5):
+            assert requests.get(f"{BASE_URL}/defect_tickets", params={"limit": limit}).status_code == 400
+            response = requests.post(f"{BASE_URL}/defect_tickets/filter", params={"limit": limit}, json={})
+            assert response.status_code == 400
+        # NDJSON keeps limit=0 as "no limit"
+        response = requests.get(f"{BASE_URL}/kpis", params={"limit": 0, "format": "ndjson"})
+        assert response.status_code == 200
+
+    def test_cursor_sort_mismatch_rejected(self):
+        """A cursor issued for one sort order cannot be replayed on another"""
+        response = requests.get(f"{BASE_URL}/defect_tickets", params={"limit": 1})
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            pytest.skip("Not enough defects to obtain a cursor")
+        response = requests.get(
+            f"{BASE_URL}/defect_tickets",
+            params={"limit": 1, "sort": "ticketId", "cursor": cursor}
+        )
+        assert response.status_code == 400
+
+    def test_cleanup_paging_defects(self):
+        """Delete the defects created for paging"""
+        for item_id in TestCursorPagination.created_ids:
+            response = requests.delete(f"{BASE_URL}/defect_tickets/{item_id}")
+            assert response.status_code == 200
+        print("✓ Cleaned up paging defects")
+
+
+class TestIndexReport:
+    """Admin index usage report"""
+
+    def test_index_report_requires_auth(self):
+        """Index report is admin only"""
+        response = requests.get(f"{BASE_URL}/admin/indexes")
+        assert response.status_code == 401
+
+    def test_index_report(self, auth_headers):
+        """Declared indexes exist and report usage"""
+        requests.post(f"{BASE_URL}/defect_tickets/filter", json={"line": "TEST_LINE"})
+        response = requests.get(f"{BASE_URL}/admin/indexes", headers=auth_headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert "defect_tickets" in data["declared"]
+        names = [index["name"] for index in data["usage"]["defect_tickets"]]
+        assert "line_1_dateTime_-1" in names
+        assert isinstance(data["uncovered_queries"], list)
+        print(f"✓ Index report: {len(names)} indexes on defect_tickets")
+
+
+class TestFieldProjection:
+    """fields= projection pushed down into MongoDB"""
+
+    def test_summary_projection_drops_heavy_fields(self):
+        """Summary view of process runs omits parameters/qualityMetrics"""
+        response = requests.get(f"{BASE_URL}/process_runs", params={"fields": "summary", "limit": 5})
+        assert response.status_code == 200
+        for run in response.json():
+            assert "id" in run
+            assert "parameters" not in run
+            assert "qualityMetrics" not in run
+
+    def test_explicit_fields_on_filter(self):
+        """Explicit field list returns only those fields plus id and sort key"""
+        response = requests.post(
+            f"{BASE_URL}/defect_tickets/filter",
+            params={"fields": "line,status", "limit": 5},
+            json={}
+        )
+        assert response.status_code == 200
+        for defect in response.json():
+            assert set(defect.keys()) <= {"id", "line", "status", "created_date"}
+
+    def test_fields_on_get_by_id(self):
+        """Projection applies to single item fetches"""
+        create = requests.post(f"{BASE_URL}/customer_complaints", json={
+            "customerName": "TEST_Projection Corp",
+            "complaintDescription": "Projection test",
+            "qfirData": {"large": "payload"}
+        })
+        assert create.status_code == 200
+        item_id = create.json()["id"]
+
+        response = requests.get(f"{BASE_URL}/customer_complaints/{item_id}", params={"fields": "customerName"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["customerName"] == "TEST_Projection Corp"
+        assert "qfirData" not in data
+
+        requests.delete(f"{BASE_URL}/customer_complaints/{item_id}")
+
+    def test_invalid_field_rejected(self):
+        """Operator injection through fields is rejected"""
+        response = requests.get(f"{BASE_URL}/defect_tickets", params={"fields": "$where"})
+        assert response.status_code == 400
+
+
+class TestNDJSONStreaming:
+    """format=ndjson streams one document per line"""
+
+    def test_stream_list(self):
+        """Streamed list parses line by line and matches the JSON list"""
+        response = requests.get(f"{BASE_URL}/defect_tickets", params={"format": "ndjson", "limit": 20}, stream=True)
+        assert response.status_code == 200
+        assert response.headers.get("content-type", "").startswith("application/x-ndjson")
+        rows = [json.loads(line) for line in response.iter_lines() if line]
+
+        plain = requests.get(f"{BASE_URL}/defect_tickets", params={"limit": 20}).json()
+        assert [row["id"] for row in rows] == [row["id"] for row in plain]
+        print(f"✓ Streamed {len(rows)} defects as NDJSON")
+
+    def test_stream_filter_with_projection(self):
+        """Filter endpoint streams with projection applied"""
+        response = requests.post(
+            f"{BASE_URL}/process_runs/filter",
+            params={"format": "ndjson", "limit": 0, "fields": "summary"},
+            json={},
+            stream=True
+        )
+        assert response.status_code == 200
+        for line in response.iter_lines():
+            if line:
+                assert "parameters" not in json.loads(line)
+
+    def test_unknown_format_rejected(self):
+        """Only json and ndjson formats are supported"""
+        response = requests.get(f"{BASE_URL}/defect_tickets", params={"format": "xml"})
+        assert response.status_code == 400
+
+
+class TestOptimisticConcurrency:
+    """doc_version ETags and If-Match preconditions on PUT"""
+
+    created_id = None
+
+    def test_create_returns_version(self):
+        """New documents start at version 1"""
+        response = requests.post(f"{BASE_URL}/capa_plans", json={"approvalState": "draft"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["doc_version"] == 1
+        assert response.headers.get("ETag") == '"1"'
+        TestOptimisticConcurrency.created_id = data["id"]
+
+    def test_update_with_matching_etag(self):
+        """Matching If-Match updates and bumps the version"""
+        if not TestOptimisticConcurrency.created_id:
+            pytest.skip("No CAPA created")
+        item_url = f"{BASE_URL}/capa_plans/{TestOptimisticConcurrency.created_id}"
+        etag = requests.get(item_url).headers.get("ETag")
+        response = requests.put(item_url, json={"approvalState": "pending_approval"}, headers={"If-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["doc_version"] == 2
+        assert response.headers.get("ETag") == '"2"'
+
+    def test_update_with_stale_etag(self):
+        """Stale If-Match is rejected with 412 and nothing is written"""
+        if not TestOptimisticConcurrency.created_id:
+            pytest.skip("No CAPA created")
+        item_url = f"{BASE_URL}/capa_plans/{TestOptimisticConcurrency.created_id}"
+        response = requests.put(item_url, json={"approvalState": "closed"}, headers={"If-Match": '"1"'})
+        assert response.status_code == 412
+        assert requests.get(item_url).json()["approvalState"] == "pending_approval"
+
+    def test_update_missing_item_with_etag(self):
+        """Missing item is still 404, not 412"""
+        response = requests.put(
+            f"{BASE_URL}/capa_plans/000000000000000000000000",
+            json={"approvalState": "closed"},
+            headers={"If-Match": '"1"'}
+        )
+        assert response.status_code == 404
+
+    def test_cleanup_capa(self):
+        if TestOptimisticConcurrency.created_id:
+            requests.delete(f"{BASE_URL}/capa_plans/{TestOptimisticConcurrency.created_id}")
+
+
+class TestBulkWrite:
+    """POST /api/bulk/{collection}"""
+
+    def test_mixed_operations(self):
+        """Insert, update, upsert and delete in one call with per-item status"""
+        stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        response = requests.post(f"{BASE_URL}/bulk/process_runs", json={"operations": [
+            {"op": "insert", "document": {"runId": f"TEST-BULK-{stamp}-1", "line": "TEST_LINE_BULK"}},
+            {"op": "insert", "document": {"runId": f"TEST-BULK-{stamp}-2", "line": "TEST_LINE_BULK"}},
+            {"op": "insert", "document": {"runId": 12345, "parameters": "not-a-dict"}},
+            {"op": "upsert", "filter": {"runId": f"TEST-BULK-{stamp}-3"}, "document": {"line": "TEST_LINE_BULK"}},
+            {"op": "delete", "id": "000000000000000000000000"},
+        ]})
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [r["status"] for r in results] == ["ok", "ok", "invalid", "ok", "not_found"]
+        assert results[3].get("upserted") is True
+
+        first_id, second_id, upserted_id = results[0]["id"], results[1]["id"], results[3]["id"]
+        response = requests.post(f"{BASE_URL}/bulk/process_runs", json={"operations": [
+            {"op": "update", "id": first_id, "document": {"materialType": "PET"}},
+            {"op": "delete", "id": second_id},
+            {"op": "delete", "id": upserted_id},
+        ]})
+        assert [r["status"] for r in response.json()["results"]] == ["ok", "ok", "ok"]
+
+        updated = requests.get(f"{BASE_URL}/process_runs/{first_id}").json()
+        assert updated["materialType"] == "PET"
+        assert updated["line"] == "TEST_LINE_BULK"
+        assert updated["doc_version"] == 2
+        requests.delete(f"{BASE_URL}/process_runs/{first_id}")
+        print("✓ Bulk mixed operations reported per-item status")
+
+    def test_matched_upsert_reports_id(self):
+        """Re-upserting by filter returns the existing id and refreshes its cached copy"""
+        run_id = f"TEST-BULK-REUP-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        first = requests.post(f"{BASE_URL}/bulk/process_runs", json={"operations": [
+            {"op": "upsert", "filter": {"runId": run_id}, "document": {"line": "TEST_LINE_BULK"}},
+        ]}).json()["results"][0]
+        item_id = first["id"]
+        assert requests.get(f"{BASE_URL}/process_runs/{item_id}").json()["line"] == "TEST_LINE_BULK"
+
+        second = requests.post(f"{BASE_URL}/bulk/process_runs", json={"operations": [
+            {"op": "upsert", "filter": {"runId": run_id}, "document": {"line": "TEST_LINE_BULK_2"}},
+        ]}).json()["results"][0]
+        assert second["status"] == "ok"
+        assert second["id"] == item_id
+        assert "upserted" not in second
+        assert requests.get(f"{BASE_URL}/process_runs/{item_id}").json()["line"] == "TEST_LINE_BULK_2"
+        requests.delete(f"{BASE_URL}/process_runs/{item_id}")
+
+    def test_unknown_collection(self):
+        """Only entity collections accept bulk writes"""
+        response = requests.post(f"{BASE_URL}/bulk/users", json={"operations": []})
+        assert response.status_code == 404
+
+
+class TestAggregation:
+    """POST /api/{collection}/aggregate"""
+
+    def test_defect_pareto(self):
+        """Count by defect type across the full history"""
+        response = requests.post(f"{BASE_URL}/defect_tickets/aggregate", json={
+            "groupBy": ["defectType"],
+            "metrics": [{"op": "count"}],
+            "sort": "-count"
+        })
+        assert response.status_code == 200
+        rows = response.json()
+        counts = [row["count"] for row in rows]
+        assert counts == sorted(counts, reverse=True)
+        print(f"✓ Pareto over {sum(counts)} defects in {len(rows)} groups")
+
+    def test_date_bucketed_kpis(self):
+        """Weekly averages with percentile"""
+        response = requests.post(f"{BASE_URL}/kpis/aggregate", json={
+            "match": {"recordDate": {"$gte": "2020-01-01"}},
+            "dateBucket": {"field": "recordDate", "unit": "week"},
+            "metrics": [
+                {"op": "avg", "field": "cpk", "as": "avgCpk"},
+                {"op": "percentile", "field": "defectPPM", "p": 0.95, "as": "p95PPM"}
+            ]
+        })
+        if response.status_code == 400:
+            assert "MongoDB 7.0" in response.json()["detail"]
+            pytest.skip("percentile needs MongoDB 7.0+")
+        assert response.status_code == 200
+        for row in response.json():
+            assert "period" in row and "avgCpk" in row and "p95PPM" in row
+
+    def test_unknown_timezone_rejected(self):
+        """Date buckets only accept known zones or fixed offsets"""
+        for timezone, status in (("Mars/Olympus_Mons", 400), ("+05:30", 200), ("Europe/Berlin", 200)):
+            response = requests.post(f"{BASE_URL}/defect_tickets/aggregate", json={
+                "dateBucket": {"field": "dateTime", "unit": "day", "timezone": timezone},
+                "metrics": [{"op": "count"}]
+            })
+            assert response.status_code == status, timezone
+
+    def test_disallowed_operator(self):
+        """Operators outside the whitelist are rejected"""
+        response = requests.post(f"{BASE_URL}/defect_tickets/aggregate", json={
+            "match": {"$where": "sleep(1000)"}
+        })
+        assert response.status_code == 400
+
+
+class TestStatisticsBreakdowns:
+    """Concurrent, cached statistics"""
+
+    def test_breakdowns_present(self):
+        """Defects, complaints and CAPAs carry per-field counts"""
+        response = requests.get(f"{BASE_URL}/statistics")
+        assert response.status_code == 200
+        breakdowns = response.json()["breakdowns"]
+        assert set(breakdowns["DefectTicket"]) == {"status", "severity"}
+        assert set(breakdowns["CustomerComplaint"]) == {"status", "severity"}
+        assert "approvalState" in breakdowns["CAPAPlan"]
+
+    def test_write_invalidates_cache(self):
+        """A create is visible in the next statistics call despite the cache"""
+        before = requests.get(f"{BASE_URL}/statistics", params={"exact": "true"}).json()
+        create = requests.post(f"{BASE_URL}/defect_tickets", json={"status": "open", "severity": "minor"})
+        item_id = create.json()["id"]
+        after = requests.get(f"{BASE_URL}/statistics", params={"exact": "true"}).json()
+        assert after["DefectTicket"] == before["DefectTicket"] + 1
+        requests.delete(f"{BASE_URL}/defect_tickets/{item_id}")
+
+
+class TestConditionalGet:
+    """If-None-Match revalidation of lists, filters and single items"""
+
+    def test_unchanged_list_returns_304(self):
+        """Revalidating an unchanged list returns 304 with the same ETag"""
+        first = requests.get(f"{BASE_URL}/defect_tickets", params={"limit": 5})
+        etag = first.headers["ETag"]
+        second = requests.get(f"{BASE_URL}/defect_tickets", params={"limit": 5}, headers={"If-None-Match": etag})
+        assert second.status_code == 304
+        assert second.headers["ETag"] == etag
+
+    def test_etag_varies_with_query(self):
+        """Different query parameters produce different list ETags"""
+        a = requests.get(f"{BASE_URL}/defect_tickets", params={"limit": 5})
+        b = requests.get(f"{BASE_URL}/defect_tickets", params={"limit": 6})
+        assert a.headers["ETag"] != b.headers["ETag"]
+
+    def test_write_changes_filter_etag(self):
+        """A write to the collection invalidates earlier filter ETags"""
+        filters = {"status": "open"}
+        etag = requests.post(f"{BASE_URL}/defect_tickets/filter", json=filters).headers["ETag"]
+        create = requests.post(f"{BASE_URL}/defect_tickets", json={"status": "open", "severity": "minor"})
+        item_id = create.json()["id"]
+        response = requests.post(f"{BASE_URL}/defect_tickets/filter", json=filters, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        requests.delete(f"{BASE_URL}/defect_tickets/{item_id}")
+
+    def test_item_revalidation(self):
+        """Single items revalidate against their version ETag"""
+        create = requests.post(f"{BASE_URL}/defect_tickets", json={"status": "open", "severity": "minor"})
+        item_id = create.json()["id"]
+        etag = create.headers["ETag"]
+        assert "Last-Modified" in create.headers
+
+        unchanged = requests.get(f"{BASE_URL}/defect_tickets/{item_id}", headers={"If-None-Match": etag})
+        assert unchanged.status_code == 304
+
+        requests.put(f"{BASE_URL}/defect_tickets/{item_id}", json={"status": "closed"})
+        changed = requests.get(f"{BASE_URL}/defect_tickets/{item_id}", headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.headers["ETag"] != etag
+        requests.delete(f"{BASE_URL}/defect_tickets/{item_id}")
+
+
+class TestEntityCache:
+    """Cached get-by-id stays consistent with writes"""
+
+    def test_update_visible_after_cached_read(self):
+        """An update invalidates the cached copy of the item"""
+        create = requests.post(f"{BASE_URL}/rca_records", json={"rootCause": "Cache test"})
+        item_id = create.json()["id"]
+        requests.get(f"{BASE_URL}/rca_records/{item_id}")
+        requests.get(f"{BASE_URL}/rca_records/{item_id}")
+
+        requests.put(f"{BASE_URL}/rca_records/{item_id}", json={"rootCause": "Cache test updated"})
+        response = requests.get(f"{BASE_URL}/rca_records/{item_id}")
+        assert response.json()["rootCause"] == "Cache test updated"
+
+        requests.delete(f"{BASE_URL}/rca_records/{item_id}")
+        assert requests.get(f"{BASE_URL}/rca_records/{item_id}").status_code == 404
+
+    def test_cache_report(self, auth_headers):
+        """Admins can read entity cache hit rates"""
+        response = requests.get(f"{BASE_URL}/admin/cache", headers=auth_headers)
+        assert response.status_code == 200
+        stats = response.json()["entity"]
+        assert {"hits", "misses", "hit_rate", "entries"} <= set(stats)
+
+
+class TestResultCache:
+    """Cached list/filter results are superseded by writes"""
+
+    def test_filter_sees_new_item(self):
+        """A create shows up in a filter that was cached just before"""
+        filters = {"status": "open", "line": "CACHE-TEST"}
+        before = requests.post(f"{BASE_URL}/defect_tickets/filter", json=filters).json()
+        create = requests.post(f"{BASE_URL}/defect_tickets", json={**filters, "severity": "minor"})
+        item_id = create.json()["id"]
+        after = requests.post(f"{BASE_URL}/defect_tickets/filter", json=filters).json()
+        assert len(after) == len(before) + 1
+        assert item_id in [item["id"] for item in after]
+        requests.delete(f"{BASE_URL}/defect_tickets/{item_id}")
+
+    def test_key_order_does_not_matter(self):
+        """Equivalent filters with different key order share one ETag"""
+        a = requests.post(f"{BASE_URL}/defect_tickets/filter", json={"status": "open", "severity": "minor"})
+        b = requests.post(f"{BASE_URL}/defect_tickets/filter", json={"severity": "minor", "status": "open"})
+        assert a.headers["ETag"] == b.headers["ETag"]
+
+    def test_cache_report(self, auth_headers):
+        """Result cache usage is reported next to the entity cache"""
+        stats = requests.get(f"{BASE_URL}/admin/cache", headers=auth_headers).json()["results"]
+        assert {"bytes", "max_bytes", "hit_rate", "evictions"} <= set(stats)
+
+
+class TestKPIRollups:
+    """kpi_rollups buckets derived from raw quality data"""
+
+    def test_rebuild_and_query(self, auth_headers):
+        """A rebuild produces per-line weekly buckets with derived KPIs"""
+        rebuild = requests.post(f"{BASE_URL}/admin/kpi-rollups/rebuild", headers=auth_headers)
+        assert rebuild.status_code == 200
+        assert "rollups" in rebuild.json()
+
+        response = requests.get(f"{BASE_URL}/kpi-rollups", params={"period": "week", "dimension": "line"})
+        assert response.status_code == 200
+        for row in response.json():
+            assert row["period"] == "week"
+            assert {"periodStart", "key", "defectPPM", "firstPassYield", "onTimeCAPA"} <= set(row)
+
+    def test_defect_write_updates_rollup(self):
+        """Creating and deleting a defect moves its day bucket up and back down"""
+        params = {"period": "day", "dimension": "line", "key": "ROLLUP-TEST"}
+        create = requests.post(f"{BASE_URL}/defect_tickets", json={
+            "line": "ROLLUP-TEST", "dateTime": "2026-01-15T08:00:00", "severity": "critical"
+        })
+        item_id = create.json()["id"]
+        time.sleep(1)
+        rows = requests.get(f"{BASE_URL}/kpi-rollups", params=params).json()
+        assert rows and rows[-1]["defects"] >= 1
+
+        requests.delete(f"{BASE_URL}/defect_tickets/{item_id}")
+        time.sleep(1)
+        after = requests.get(f"{BASE_URL}/kpi-rollups", params=params).json()
+        assert after[-1]["defects"] == rows[-1]["defects"] - 1
+
+    def test_dollar_line_name_stored_literally(self):
+        """A line named like a field path is stored as its own bucket key"""
+        params = {"period": "day", "dimension": "line", "key": "$ROLLUP-TEST"}
+        create = requests.post(f"{BASE_URL}/defect_tickets", json={"line": "$ROLLUP-TEST", "dateTime": "2026-01-16T08:00:00"})
+        item_id = create.json()["id"]
+        time.sleep(1)
+        rows = requests.get(f"{BASE_URL}/kpi-rollups", params=params).json()
+        assert rows and rows[-1]["key"] == "$ROLLUP-TEST" and rows[-1]["defects"] >= 1
+        requests.delete(f"{BASE_URL}/defect_tickets/{item_id}")
+
+    def test_invalid_period(self):
+        """Unknown bucket sizes are rejected"""
+        response = requests.get(f"{BASE_URL}/kpi-rollups", params={"period": "hour"})
+        assert response.status_code == 400
+
+
+class TestProcessSeries:
+    """Downsampled parameter trends from process runs"""
+
+    def test_series_is_bounded(self):
+        """A series never returns more than the requested number of points"""
+        run_ids = []
+        for hour in range(12):
+            create = requests.post(f"{BASE_URL}/process_runs", json={
+                "line": "SERIES-TEST",
+                "dateTimeStart": f"2026-02-01T{hour:02d}:00:00",
+                "parameters": {"lineSpeed": 100 + hour}
+            })
+            run_ids.append(create.json()["id"])
+        time.sleep(1)
+
+        for method in ("lttb", "minmax"):
+            response = requests.get(f"{BASE_URL}/process-series", params={
+                "parameter": "lineSpeed", "line": "SERIES-TEST", "points": 6, "method": method
+            })
+            assert response.status_code == 200
+            data = response.json()
+            assert data["count"] == 12
+            assert 0 < len(data["points"]) <= 6
+
+        for run_id in run_ids:
+            requests.delete(f"{BASE_URL}/process_runs/{run_id}")
+
+    def test_many_rows_stay_within_points(self):
+        """With far more runs than points, the row at the end of the range still fits the last bucket"""
+        operations = [{"op": "insert", "document": {
+            "line": "SERIES-TEST-MANY",
+            "dateTimeStart": f"2026-03-01T{minute // 60:02d}:{minute % 60:02d}:00",
+            "parameters": {"lineSpeed": 100 + minute}
+        }} for minute in range(0, 600, 3)]
+        results = requests.post(f"{BASE_URL}/bulk/process_runs", json={"operations": operations}).json()["results"]
+        time.sleep(1)
+
+        for method in ("lttb", "minmax"):
+            for points in (7, 10):
+                data = requests.get(f"{BASE_URL}/process-series", params={
+                    "parameter": "lineSpeed", "line": "SERIES-TEST-MANY", "points": points, "method": method
+                }).json()
+                assert data["count"] == 200
+                assert len(data["points"]) <= points
+                assert data["points"][-1][1] == 100 + 597
+
+        requests.post(f"{BASE_URL}/bulk/process_runs", json={"operations": [
+            {"op": "delete", "id": r["id"]} for r in results
+        ]})
+
+    def test_invalid_method(self):
+        """Only lttb and minmax are supported"""
+        response = requests.get(f"{BASE_URL}/process-series", params={"parameter": "lineSpeed", "method": "avg"})
+        assert response.status_code == 400
+
+
+class TestKnowledgeSearch:
+    """Local BM25 search over knowledge documents and SOPs"""
+
+    def test_index_follows_writes(self):
+        """New documents become searchable and deleted ones disappear"""
+        create = requests.post(f"{BASE_URL}/knowledge_documents", json={
+            "title": "Zirconium nozzle fouling",
+            "content": "Fouled zirconium nozzles leave streaks on the coated web.",
+            "tags": ["nozzle", "streaks"]
+        })
+        item_id = create.json()["id"]
+        time.sleep(1)
+
+        response = requests.post(f"{BASE_URL}/ai/search-knowledge", json={"query": "zirconium nozzles"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["model"] == "bm25"
+        assert data["results"][0]["id"] == item_id
+        assert data["results"][0]["relevance_score"] == 1.0
+
+        requests.delete(f"{BASE_URL}/knowledge_documents/{item_id}")
+        time.sleep(1)
+        data = requests.post(f"{BASE_URL}/ai/search-knowledge", json={"query": "zirconium"}).json()
+        assert item_id not in [hit["id"] for hit in data["results"]]
+
+    def test_collection_filter(self):
+        """Results can be restricted to SOPs"""
+        data = requests.post(f"{BASE_URL}/ai/search-knowledge", json={
+            "query": "procedure", "collections": ["sops"]
+        }).json()
+        assert all(hit["collection"] == "sops" for hit in data["results"])
+
+    def test_invalid_parameters_rejected(self):
+        """Non-integer limits and non-list or unknown collections are 400s"""
+        for body in ({"query": "procedure", "limit": "ten"},
+                     {"query": "procedure", "collections": "sops"},
+                     {"query": "procedure", "collections": ["defect_tickets"]},
+                     {"query": 42}):
+            response = requests.post(f"{BASE_URL}/ai/search-knowledge", json=body)
+            assert response.status_code == 400, body
+
+
+class TestSimilarDefects:
+    """Nearest-neighbour lookup over defect descriptions"""
+
+    def test_similar_description_ranks_first(self):
+        """A near-identical description is the top neighbour and carries its root cause"""
+        first = requests.post(f"{BASE_URL}/defect_tickets", json={
+            "description": "Silicone fisheyes clustered along the drive side edge after recoat",
+            "rootCause": "Contaminated recoat pan"
+        }).json()["id"]
+        second = requests.post(f"{BASE_URL}/defect_tickets", json={
+            "description": "Fisheyes clustered along drive side edge following recoat, silicone suspected"
+        }).json()["id"]
+        time.sleep(1)
+
+        response = requests.get(f"{BASE_URL}/defect_tickets/{second}/similar", params={"k": 5})
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert results[0]["id"] == first
+        assert results[0]["rootCause"] == "Contaminated recoat pan"
+        assert 0 < results[0]["score"] <= 1
+        assert "capaPlans" in results[0]
+
+        for item_id in (first, second):
+            requests.delete(f"{BASE_URL}/defect_tickets/{item_id}")
+
+    def test_unknown_ticket(self):
+        """Unknown ids return 404"""
+        response = requests.get(f"{BASE_URL}/defect_tickets/000000000000000000000000/similar")
+        assert response.status_code == 404
+
+
+class TestComplaintDuplicates:
+    """MinHash/LSH duplicate detection for customer complaints"""
+
+    COMPLAINT = {
+        "customerName": "Dedup Test Glazing",
+        "productType": "Dedup Test Film 35",
+        "complaintDescription": "Film edges lifting and peeling within two weeks of installation on curved glass"
+    }
+
+    def test_create_reports_duplicates(self):
+        """Logging the same failure twice flags the first complaint"""
+        first = requests.post(f"{BASE_URL}/customer_complaints", json=self.COMPLAINT).json()
+        second = requests.post(f"{BASE_URL}/customer_complaints", json={
+            **self.COMPLAINT,
+            "complaintDescription": self.COMPLAINT["complaintDescription"] + " again"
+        }).json()
+        assert first["id"] in [dup["id"] for dup in second["possibleDuplicates"]]
+        time.sleep(1)
+
+        report = requests.get(f"{BASE_URL}/customer_complaints/duplicates/report").json()
+        assert {"threshold", "bands", "rows", "groups"} <= set(report)
+        grouped = [
+            {complaint["id"] for complaint in group["complaints"]}
+            for group in report["groups"]
+        ]
+        assert any({first["id"], second["id"]} <= ids for ids in grouped)
+
+        for item in (first, second):
+            requests.delete(f"{BASE_URL}/customer_complaints/{item['id']}")
+
+    def test_unrelated_complaint(self):
+        """A different complaint has no duplicates"""
+        item = requests.post(f"{BASE_URL}/customer_complaints", json={
+            "customerName": "Unrelated Buyer",
+            "productType": "Clear Guard",
+            "complaintDescription": "Invoice quantity does not match delivered pallets"
+        }).json()
+        assert item["possibleDuplicates"] == []
+        requests.delete(f"{BASE_URL}/customer_complaints/{item['id']}")
+
+    def test_unknown_complaint(self):
+        """Unknown or malformed ids return 404 rather than an empty list"""
+        for item_id in ("000000000000000000000000", "not-an-id"):
+            response = requests.get(f"{BASE_URL}/customer_complaints/{item_id}/duplicates")
+            assert response.status_code == 404
+
+
+class TestLLMCache:
+    """Repeated AI requests are answered from the response cache"""
+
+    def _misses(self):
+        return requests.get(f"{BASE_URL}/ai/metrics").json()["cache"]["misses"]
+
+    def test_repeat_classification_is_cached(self):
+        """The second identical classification does not reach the model"""
+        body = {"description": f"Large air bubbles trapped under the liner, lot {time.time()}", "forceModel": True}
+        first = requests.post(f"{BASE_URL}/ai/classify-defect", json=body).json()
+        if first.get("model") == "fallback":
+            pytest.skip("LLM provider unavailable")
+        misses = self._misses()
+
+        started = time.perf_counter()
+        second = requests.post(f"{BASE_URL}/ai/classify-defect", json=body).json()
+        assert time.perf_counter() - started < 0.5
+        assert second == first
+        assert self._misses() == misses
+
+    def test_bypass_flag(self):
+        """bypassCache forces a fresh completion"""
+        before = requests.get(f"{BASE_URL}/ai/metrics").json()["cache"]["bypassed"]
+        requests.post(f"{BASE_URL}/ai/classify-defect", json={"description": "haze", "bypassCache": True})
+        after = requests.get(f"{BASE_URL}/ai/metrics").json()["cache"]["bypassed"]
+        assert after == before + 1
+
+
+class TestAICoalescing:
+    """Concurrent identical AI requests share one model call"""
+
+    def test_concurrent_requests_coalesce(self):
+        """Ten simultaneous RCA requests produce one leader call"""
+        from concurrent.futures import ThreadPoolExecutor
+        body = {
+            "description": f"Edge delamination after lamination, roll {time.time()}",
+            "defectType": "delamination",
+            "severity": "major",
+            "bypassCache": True
+        }
+        before = requests.get(f"{BASE_URL}/ai/metrics").json()["coalescing"]
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            results = list(pool.map(
+                lambda _: requests.post(f"{BASE_URL}/ai/rca-suggestions", json=body).json(), range(10)
+            ))
+        after = requests.get(f"{BASE_URL}/ai/metrics").json()["coalescing"]
+        assert all(result == results[0] for result in results)
+        assert after["leaders"] - before["leaders"] < 10
+        assert after["followers"] > before["followers"]
+
+
+class TestBatchClassification:
+    """Many descriptions classified per request, in input order"""
+
+    def test_results_in_input_order(self):
+        """One result per description, duplicates classified once"""
+        descriptions = [
+            "Air bubbles trapped between film and liner",
+            "Film layers peeling apart at the edge",
+            "Cloudy appearance across the web",
+            "Air bubbles trapped between film and liner",
+        ]
+        response = requests.post(f"{BASE_URL}/ai/classify-defects/batch", json={"descriptions": descriptions})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["count"] == 4
+        assert data["unique"] == 3
+        assert len(data["results"]) == 4
+        assert all("defect_type" in result for result in data["results"])
+        assert data["results"][0] == data["results"][3]
+
+    def test_rejects_non_list(self):
+        """descriptions must be a list of strings"""
+        response = requests.post(f"{BASE_URL}/ai/classify-defects/batch", json={"descriptions": "haze"})
+        assert response.status_code == 400
+
+
+class TestAIGateway:
+    """Gateway state is published and fallbacks use the local rules"""
+
+    def test_gateway_metrics(self):
+        """Breaker state and concurrency limits are reported"""
+        data = requests.get(f"{BASE_URL}/ai/metrics").json()["gateway"]
+        assert data["breaker"]["state"] in ("closed", "open", "half_open")
+        assert data["max_concurrency"] >= 1
+        assert data["active"] <= data["max_concurrency"]
+
+    def test_fallback_uses_rules(self):
+        """A fallback classification still comes from the keyword rules"""
+        data = requests.post(f"{BASE_URL}/ai/classify-defect", json={
+            "description": "Fisheye spots across the coated surface", "bypassCache": True, "forceModel": True
+        }).json()
+        if data.get("model") != "fallback":
+            pytest.skip("LLM provider answered")
+        assert data["defect_type"] == "fisheyes"
+
+
+class TestInvokeLLMStreaming:
+    """stream=true returns the completion as Server-Sent Events"""
+
+    def _events(self, response):
+        events = []
+        for block in response.text.strip().split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in block.splitlines())
+            events.append((lines["event"], json.loads(lines["data"])))
+        return events
+
+    def test_event_sequence(self):
+        """start first, then chunks, then done with parsed JSON"""
+        response = requests.post(f"{BASE_URL}/ai/invoke-llm", json={
+            "prompt": "Give one cause of haze in PET film.",
+            "response_json_schema": {"type": "object", "properties": {"cause": {"type": "string"}}},
+            "stream": True
+        })
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = self._events(response)
+        assert events[0][0] == "start"
+        assert events[-1][0] in ("done", "error")
+        if events[-1][0] == "done":
+            text = "".join(data["text"] for event, data in events if event == "chunk")
+            assert text == events[-1][1]["response"]
+            assert "parsed" in events[-1][1]
+
+
+class TestAIJobs:
+    """Queued AI jobs run in the background and can be attached to records"""
+
+    def _wait(self, job_id, timeout=120):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = requests.get(f"{BASE_URL}/ai/jobs/{job_id}").json()
+            if job["status"] in ("completed", "failed"):
+                return job
+            time.sleep(1)
+        pytest.fail("AI job did not finish")
+
+    def test_rca_job_attaches_to_record(self):
+        """Submit returns 202 at once; the result lands on the RCA record"""
+        rca = requests.post(f"{BASE_URL}/rca_records", json={"rootCause": "Under investigation"}).json()
+        response = requests.post(f"{BASE_URL}/ai/jobs", json={
+            "kind": "rca",
+            "params": {"description": "Bubbles along the web edge", "defectType": "bubbles_voids", "severity": "major"},
+            "target": {"collection": "rca_records", "id": rca["id"]}
+        })
+        assert response.status_code == 202
+        job = response.json()
+        assert job["status"] == "queued"
+
+        job = self._wait(job["id"])
+        assert job["status"] == "completed"
+        assert job["result"]["suggestions"]
+        assert job["id"] in [item["id"] for item in requests.get(f"{BASE_URL}/ai/jobs", params={"targetId": rca["id"]}).json()]
+
+        attached = requests.post(f"{BASE_URL}/ai/jobs/{job['id']}/attach")
+        assert attached.status_code == 200
+        assert attached.json()["aiSuggestions"] == job["result"]["suggestions"]
+        requests.delete(f"{BASE_URL}/rca_records/{rca['id']}")
+
+    def test_capa_attach_keeps_manual_actions(self):
+        """AI actions are appended to the plan's own; attaching again does not duplicate them"""
+        manual = {"action": "Replace worn nip roller", "owner": "Maintenance"}
+        plan = requests.post(f"{BASE_URL}/capa_plans", json={
+            "correctiveActions": [manual], "preventiveActions": []
+        }).json()
+        job = requests.post(f"{BASE_URL}/ai/jobs", json={
+            "kind": "capa",
+            "params": {"rootCause": "Nip pressure drift", "defectType": "bubbles_voids"},
+            "target": {"collection": "capa_plans", "id": plan["id"]}
+        }).json()
+        job = self._wait(job["id"])
+        assert job["status"] == "completed"
+
+        for _ in range(2):
+            attached = requests.post(f"{BASE_URL}/ai/jobs/{job['id']}/attach")
+            assert attached.status_code == 200
+            corrective = attached.json()["correctiveActions"]
+            assert corrective[0] == manual
+            ai_actions = [a for a in corrective if a.get("source") == "ai"]
+            assert [a["action"] for a in ai_actions] == job["result"]["corrective_actions"]
+            assert all(a["aiJobId"] == job["id"] for a in ai_actions)
+        requests.delete(f"{BASE_URL}/capa_plans/{plan['id']}")
+
+    def test_invalid_kind(self):
+        """Unknown kinds are rejected up front"""
+        response = requests.post(f"{BASE_URL}/ai/jobs", json={"kind": "translate", "params": {}})
+        assert response.status_code == 400
+
+    def test_unknown_job(self):
+        response = requests.get(f"{BASE_URL}/ai/jobs/000000000000000000000000")
+        assert response.status_code == 404
+
+
+class TestClassificationFastPath:
+    """Confident keyword matches are answered without the model"""
+
+    def test_confident_match_uses_rules(self):
+        """An unambiguous description is classified by the rules"""
+        before = requests.get(f"{BASE_URL}/ai/metrics").json()["fast_path"]
+        started = time.perf_counter()
+        data = requests.post(f"{BASE_URL}/ai/classify-defect", json={
+            "description": "Delamination: outer layer peeling away from the substrate"
+        }).json()
+        assert time.perf_counter() - started < 0.5
+        assert data["model"] == "rules"
+        assert data["defect_type"] == "delamination"
+        assert data["confidence"] >= before["threshold"]
+        after = requests.get(f"{BASE_URL}/ai/metrics").json()["fast_path"]
+        assert after["rules"] == before["rules"] + 1
+
+    def test_ambiguous_description_goes_to_model(self):
+        """Descriptions without a confident match are not answered by the rules"""
+        data = requests.post(f"{BASE_URL}/ai/classify-defect", json={
+            "description": "Hazy patch next to a scratch on the slit edge"
+        }).json()
+        assert data["model"] != "rules"
+
+    def test_force_model(self):
+        """forceModel skips the fast path"""
+        data = requests.post(f"{BASE_URL}/ai/classify-defect", json={
+            "description": "Delamination and peeling", "forceModel": True
+        }).json()
+        assert data["model"] != "rules"
+
+    def test_non_ascii_case_variants(self):
+        """Case-insensitive matches that do not lower() to the keyword still map to their rule (offline)"""
+        from services.defect_rules import classify
+        for description, defect_type, term in (("İnclusion near the core", "gels_contamination", "inclusion"),
+                                               ("ſcratch across the web", "scratches", "scratch"),
+                                               ("ORANGE  PEEL texture", "orange_peel", "orange peel")):
+            result = classify(description)
+            assert result["defect_type"] == defect_type, description
+            assert result["matched_terms"] == [term]
+
+
+class TestChangeStreamDeltas:
+    """build_delta / room fan-out, offline"""
+
+    def change(self, operation, **extra):
+        return {"operationType": operation, "ns": {"db": "quality_studio", "coll": "defect_tickets"},
+                "documentKey": {"_id": ObjectId("65a000000000000000000001")}, **extra}
+
+    def test_insert_sends_summary_fields(self):
+        """Inserts carry the table-view fields only, JSON-ready"""
+        from services.change_stream_service import build_delta
+        delta = build_delta(self.change("insert", fullDocument={
+            "_id": ObjectId("65a000000000000000000001"), "ticketId": "DT-1", "severity": "critical",
+            "dateTime": datetime(2024, 1, 5, 8, 30), "qfirData": {"heavy": True},
+        }))
+        assert delta["type"] == "entity_change"
+        assert delta["collection"] == "defect_tickets"
+        assert delta["operation"] == "insert"
+        assert delta["id"] == "65a000000000000000000001"
+        assert delta["document"] == {"ticketId": "DT-1", "severity": "critical", "dateTime": "2024-01-05T08:30:00"}
+        assert "timestamp" in delta
+
+    def test_update_sends_changes_and_removed_fields(self):
+        """Updates carry only the changed and removed fields"""
+        from services.change_stream_service import build_delta
+        delta = build_delta(self.change("update", updateDescription={
+            "updatedFields": {"status": "closed", "doc_version": 3}, "removedFields": ["assignedTo"],
+        }))
+        assert delta["operation"] == "update"
+        assert delta["changes"] == {"status": "closed", "doc_version": 3}
+        assert delta["removed"] == ["assignedTo"]
+        assert "document" not in delta
+
+        delta = build_delta(self.change("update", updateDescription={"updatedFields": {"status": "open"},
+                                                                     "removedFields": []}))
+        assert "removed" not in delta
+
+    def test_replace_and_delete(self):
+        """Replaces send the new summary; deletes just the id"""
+        from services.change_stream_service import build_delta
+        replaced = build_delta(self.change("replace", fullDocument={"ticketId": "DT-2", "notes": "x"}))
+        assert replaced["operation"] == "replace"
+        assert replaced["document"] == {"ticketId": "DT-2"}
+
+        deleted = build_delta(self.change("delete"))
+        assert deleted["operation"] == "delete"
+        assert deleted["id"] == "65a000000000000000000001"
+        assert not {"changes", "document"} & set(deleted)
+
+        assert build_delta(self.change("invalidate")) is None
+
+    def test_delta_sent_to_collection_room(self, monkeypatch):
+        """Deltas go to entity:<collection> as one JSON-serializable message"""
+        from services import change_stream_service
+        sent = []
+
+        async def broadcast_to_room(room, message):
+            sent.append((room, message))
+
+        monkeypatch.setattr(change_stream_service.manager, "broadcast_to_room", broadcast_to_room)
+        watcher = change_stream_service.ChangeStreamWatcher(db=None)
+        asyncio.run(watcher._dispatch(self.change("update", updateDescription={"updatedFields": {"status": "closed"}})))
+        asyncio.run(watcher._dispatch(self.change("drop")))
+
+        assert change_stream_service.room_for("defect_tickets") == "entity:defect_tickets"
+        assert len(sent) == 1
+        room, message = sent[0]
+        assert room == "entity:defect_tickets"
+        assert {"type", "collection", "operation", "id", "timestamp", "changes"} == set(message)
+        json.dumps(message)
+        assert watcher.events == 1
+
+    def test_resume_token_per_instance_and_backoff(self, monkeypatch):
+        """Each instance keeps its own token; repeated failures back off up to the cap"""
+        from pymongo.errors import OperationFailure
+        from services import change_stream_service
+
+        class FailingDb:
+            def __getitem__(self, name):
+                return self
+
+            async def find_one(self, query):
+                return None
+
+            def watch(self, *args, **kwargs):
+                raise OperationFailure("not authorized", code=13)
+
+        delays = []
+
+        async def sleep(seconds):
+            delays.append(seconds)
+            if len(delays) == 9:
+                raise asyncio.CancelledError()
+
+        monkeypatch.setattr(change_stream_service.asyncio, "sleep", sleep)
+        first = change_stream_service.ChangeStreamWatcher(FailingDb(), instance="web-1")
+        second = change_stream_service.ChangeStreamWatcher(FailingDb(), instance="web-2")
+        assert first.state_id != second.state_id
+
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(first._run())
+        assert delays == [5, 10, 20, 40, 80, 160, 300, 300, 300]
+
+
+class TestDedupRecall:
+    """LSH banding finds pairs just above DEDUP_THRESHOLD, offline"""
+
+    def test_recall_at_jaccard_055(self):
+        """Pairs with Jaccard 0.55 are proposed and confirmed"""
+        from services.dedup_index import MinHashLSH, DEDUP_LSH_BANDS, DEDUP_LSH_ROWS, DEDUP_THRESHOLD
+        assert (1 / DEDUP_LSH_BANDS) ** (1 / DEDUP_LSH_ROWS) < DEDUP_THRESHOLD
+
+        lsh = MinHashLSH()
+        queries = []
+        for pair in range(300):
+            # 11 shared of 20 distinct shingles: Jaccard 0.55
+            shared = {f"{pair}-shared-{i}" for i in range(11)}
+            lsh.add(f"{pair}", lsh.signature(shared | {f"{pair}-first-{i}" for i in range(5)}))
+            queries.append((f"{pair}", lsh.signature(shared | {f"{pair}-second-{i}" for i in range(4)})))
+
+        proposed = sum(any(key == pair for key, _ in lsh.query(signature, 0.0)) for pair, signature in queries)
+        confirmed = sum(any(key == pair for key, _ in lsh.query(signature, DEDUP_THRESHOLD)) for pair, signature in queries)
+        assert proposed / len(queries) >= 0.9
+        assert confirmed / len(queries) >= 0.75
+
+
+class MemoryJobs:
+    """Just enough of a collection for AIJobQueue._process"""
+
+    def __init__(self, job):
+        self.job = job
+        self.updates = []
+
+    async def update_one(self, query, update):
+        self.updates.append(update)
+        self.job.update(update.get("$set", {}))
+
+
+class TestAIJobFailures:
+    """Fallback answers fail jobs; CAPA results merge into plans (offline)"""
+
+    def process(self, monkeypatch, kind, params, attempts):
+        pytest.importorskip("emergentintegrations")
+        from services import ai_job_queue
+        from services.ai_gateway import gateway, OPEN
+        # An open circuit makes every AI call return the local fallback
+        monkeypatch.setattr(gateway.breaker, "state", OPEN)
+        monkeypatch.setattr(gateway.breaker, "opened_at", time.monotonic())
+
+        job = {"_id": ObjectId(), "kind": kind, "params": params, "target": None, "status": ai_job_queue.RUNNING,
+               "attempts": attempts, "progress": None, "result": None, "error": None, "created_by": None}
+        stored = dict(job)
+        queue = ai_job_queue.AIJobQueue({ai_job_queue.JOBS_COLLECTION: MemoryJobs(stored)})
+        asyncio.run(queue._process(job))
+        return ai_job_queue, stored
+
+    def test_fallback_is_retried_then_failed(self, monkeypatch):
+        """A fallback answer requeues the job until its last attempt, then fails it"""
+        params = {"description": "Bubbles along the web edge", "defectType": "bubbles_voids"}
+        ai_job_queue, stored = self.process(monkeypatch, "rca", params, attempts=1)
+        assert stored["status"] == ai_job_queue.QUEUED
+        assert stored["result"] is None
+
+        ai_job_queue, stored = self.process(monkeypatch, "rca", params, attempts=ai_job_queue.AI_JOB_MAX_ATTEMPTS)
+        assert stored["status"] == ai_job_queue.FAILED
+        assert stored["result"] is None
+        assert "AI circuit open" in stored["error"]
+        # attach_ai_job only writes completed jobs (409 otherwise)
+        assert stored["status"] != ai_job_queue.COMPLETED
+
+    def test_every_kind_checks_for_fallback(self, monkeypatch):
+        """capa, classify and invoke fail the same way on a fallback answer"""
+        for kind, params in (("capa", {"rootCause": "Low nip pressure", "defectType": "bubbles_voids"}),
+                             ("classify", {"description": "Unusual streak, cause unclear"}),
+                             ("invoke", {"prompt": "Summarize the last shift"})):
+            ai_job_queue, stored = self.process(monkeypatch, kind, params, attempts=99)
+            assert stored["status"] == ai_job_queue.FAILED, kind
+            assert stored["result"] is None
+
+    def test_running_job_sends_heartbeats(self, monkeypatch):
+        """A slow job keeps refreshing updated_date, so requeue_stale leaves it to its worker"""
+        pytest.importorskip("emergentintegrations")
+        from services import ai_job_queue
+
+        async def slow(params, progress):
+            await asyncio.sleep(0.2)
+            return {"model": "test"}
+
+        monkeypatch.setitem(ai_job_queue.JOB_KINDS, "slow", slow)
+        monkeypatch.setattr(ai_job_queue, "AI_JOB_HEARTBEAT_INTERVAL", 0.02)
+        job = {"_id": ObjectId(), "kind": "slow", "params": {}, "target": None, "status": ai_job_queue.RUNNING,
+               "attempts": 1, "progress": None, "result": None, "error": None, "created_by": None}
+        jobs = MemoryJobs(dict(job))
+        asyncio.run(ai_job_queue.AIJobQueue({ai_job_queue.JOBS_COLLECTION: jobs})._process(job))
+
+        heartbeats = [u for u in jobs.updates if set(u["$set"]) == {"updated_date"}]
+        assert len(heartbeats) >= 3
+        assert jobs.job["status"] == ai_job_queue.COMPLETED
+
+    def test_capa_attachment_merges_by_job(self):
+        """attachment_for appends after manual actions and replaces the same job's earlier entries"""
+        pytest.importorskip("emergentintegrations")
+        from services.ai_job_queue import attachment_for
+        job_id = ObjectId()
+        job = {"_id": job_id, "kind": "capa",
+               "result": {"corrective_actions": ["Recalibrate nip"], "preventive_actions": ["Weekly nip audit"]}}
+        record = {"correctiveActions": [
+            {"action": "Replace roller"},
+            {"action": "Old suggestion", "source": "ai", "aiJobId": str(job_id)},
+            {"action": "Other job", "source": "ai", "aiJobId": "other"},
+        ]}
+        fields = attachment_for(job, record)
+        assert [a["action"] for a in fields["correctiveActions"]] == ["Replace roller", "Other job", "Recalibrate nip"]
+        assert fields["preventiveActions"] == [{"action": "Weekly nip audit", "source": "ai", "aiJobId": str(job_id)}]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v", "--tb=short"])